@@ -0,0 +1,61 @@
+# -*- coding: utf-8 -*-
+"""
+Benchmark grade posts of a certificate-authenticated consumer over new
+connections, loading the client certificate for every post against
+sharing the cached SSL context with TLS session resumption.
+
+Run from the repository root::
+
+    PYTHONPATH=. python benchmarks/bench_client_cert.py
+"""
+from __future__ import print_function
+
+import ssl
+import time
+
+from pylti.common import generate_request_xml, post_message
+from pylti.fake_lms import FakeLMS
+from pylti.tests.util import TEST_SERVER_CERT
+from pylti.transport import TLS_CONTEXTS, create_transport
+
+CONSUMERS = {'__consumer_key__': {'secret': '__lti_secret__',
+                                  'cert': TEST_SERVER_CERT}}
+POSTS = 50
+
+
+def run(lms, cached):
+    """
+    Post POSTS grades, each with a new transport
+
+    :return: milliseconds per post
+    """
+    xml = generate_request_xml(u'bench', u'replaceResult', u'sourced', 0.5)
+    started = time.time()
+    for _ in range(POSTS):
+        if not cached:
+            TLS_CONTEXTS.configure(cafile=TEST_SERVER_CERT)
+        transport = create_transport(CONSUMERS, '__consumer_key__')
+        assert post_message(CONSUMERS, '__consumer_key__', lms.outcome_url,
+                            xml, transport=transport)
+        transport.close()
+    return (time.time() - started) / POSTS * 1000
+
+
+def main():
+    """
+    Print per post latency with and without the context cache.
+    """
+    server_context = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
+    server_context.load_cert_chain(TEST_SERVER_CERT)
+    server_context.verify_mode = ssl.CERT_REQUIRED
+    server_context.load_verify_locations(TEST_SERVER_CERT)
+    with FakeLMS(CONSUMERS, ssl_context=server_context) as lms:
+        for name, cached in (('uncached', False), ('cached', True)):
+            TLS_CONTEXTS.configure(cafile=TEST_SERVER_CERT)
+            print("{:<10} {:8.2f} ms/post".format(name, run(lms, cached)))
+        print("resumed {} of {} connections".format(lms.resumed_count,
+                                                    lms.connection_count))
+
+
+if __name__ == '__main__':
+    main()
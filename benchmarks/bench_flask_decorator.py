@@ -0,0 +1,83 @@
+# -*- coding: utf-8 -*-
+"""
+Benchmark per request overhead of the Flask LTI decorator, building an
+LTI object from app.config for every request against routes of the
+PyLTI extension compiled once per app.
+
+Run from the repository root::
+
+    PYTHONPATH=. python benchmarks/bench_flask_decorator.py
+"""
+from __future__ import print_function
+
+import time
+
+from flask import Flask, session
+
+from pylti.common import LTI_SESSION_KEY
+from pylti.flask import PyLTI, lti
+
+CONSUMERS = {'__consumer_key__': {'secret': '__lti_secret__'}}
+CALLS = 20000
+
+
+def error(exception):
+    """ Fail loudly, the benchmark requests are all valid """
+    raise exception['exception']
+
+
+def view(lti):  # pylint: disable=redefined-outer-name
+    """ Read what a typical view reads """
+    return lti.response_url
+
+
+def create_app():
+    """
+    App with one decorated and one extension view of a staff session
+
+    :return: app, decorated view, extension view
+    """
+    app = Flask(__name__)
+    app.config['SECRET_KEY'] = 'secret'
+    app.config['PYLTI_CONFIG'] = {'consumers': CONSUMERS}
+    app.config['PYLTI_URL_FIX'] = {
+        "https://localhost:8000/": {
+            "https://localhost:8000/": "http://localhost:8000/"
+        }
+    }
+    decorated = lti(app=app, request='session', error=error,
+                    role='staff')(view)
+    extension = PyLTI(app).lti(request='session', error=error,
+                               role='staff')(view)
+    return app, decorated, extension
+
+
+def run(function):
+    """
+    Call view CALLS times
+
+    :return: microseconds per call
+    """
+    started = time.time()
+    for _ in range(CALLS):
+        function()
+    return (time.time() - started) / CALLS * 1e6
+
+
+def main():
+    """
+    Print per call overhead of both decorators.
+    """
+    app, decorated, extension = create_app()
+    with app.test_request_context('/'):
+        session[LTI_SESSION_KEY] = True
+        session['roles'] = u'Instructor'
+        session['lis_outcome_service_url'] = (
+            u'https://localhost:8000/courses/grade_handler')
+        for name, function in (('lti', decorated), ('PyLTI', extension)):
+            run(function)
+            print("{:<6} {:8.2f} us/request".format(name, run(function)))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,40 @@
+# -*- coding: utf-8 -*-
+"""
+Benchmark pylti.common.generate_request_xml against the ElementTree
+implementation it replaced.
+
+Run from the repository root::
+
+    PYTHONPATH=. python benchmarks/bench_generate_request_xml.py
+"""
+from __future__ import print_function
+
+import timeit
+
+from pylti.common import generate_request_xml
+from pylti.tests.util import generate_request_xml_etree
+
+NUMBER = 20000
+ARGS = (
+    u'edX_fix',
+    u'replaceResult',
+    u'MITx/ODL_ENG/2014_T1:edge.edx.org-i4x-MITx-ODL_ENG-lti-'
+    u'94173d3e79d145fd8ec2e83f15836ac8:008437924c9852377e8994829aaac7a1',
+    0.75,
+)
+
+
+def main():
+    """
+    Time both serializers and print per call cost.
+    """
+    assert generate_request_xml(*ARGS) == generate_request_xml_etree(*ARGS)
+    for name, function in (('elementtree', generate_request_xml_etree),
+                           ('template', generate_request_xml)):
+        best = min(timeit.repeat(lambda: function(*ARGS),
+                                 number=NUMBER, repeat=5))
+        print("{:<12} {:8.2f} us/call".format(name, best / NUMBER * 1e6))
+
+
+if __name__ == '__main__':
+    main()
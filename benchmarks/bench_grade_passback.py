@@ -0,0 +1,64 @@
+# -*- coding: utf-8 -*-
+"""
+Benchmark grade passback throughput against the in-process fake LMS,
+with a new connection per post, pooled httplib2 transports and pooled
+urllib3 transports.
+
+Run from the repository root::
+
+    PYTHONPATH=. python benchmarks/bench_grade_passback.py
+"""
+from __future__ import print_function
+
+import time
+from multiprocessing.pool import ThreadPool
+
+from pylti.common import generate_request_xml, post_message
+from pylti.fake_lms import FakeLMS
+from pylti.transport import TransportPool
+from pylti.urllib3 import Urllib3Transport
+
+CONSUMERS = {'__consumer_key__': {'secret': '__lti_secret__'}}
+POSTS = 400
+WORKERS = 8
+LATENCY = (0.002, 0.01)
+
+
+def run(lms, pool):
+    """
+    Post POSTS grades with WORKERS threads
+
+    :return: posts per second
+    """
+    def post(number):
+        """ Post one grade """
+        xml = generate_request_xml(u'bench', u'replaceResult',
+                                   u'sourced-{}'.format(number), 0.5)
+        transport = pool.get('__consumer_key__') if pool else None
+        return bool(post_message(CONSUMERS, '__consumer_key__',
+                                 lms.outcome_url, xml, transport=transport))
+
+    threads = ThreadPool(WORKERS)
+    started = time.time()
+    results = threads.map(post, range(POSTS))
+    elapsed = time.time() - started
+    threads.close()
+    threads.join()
+    assert all(results)
+    return POSTS / elapsed
+
+
+def main():
+    """
+    Print throughput of every transport setup.
+    """
+    with FakeLMS(CONSUMERS, latency=LATENCY, seed=1) as lms:
+        for name, pool in (
+                ('new client', None),
+                ('httplib2', TransportPool(CONSUMERS)),
+                ('urllib3', TransportPool(CONSUMERS, Urllib3Transport))):
+            print("{:<12} {:8.1f} posts/s".format(name, run(lms, pool)))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,64 @@
+# -*- coding: utf-8 -*-
+"""
+Benchmark latency of the first grade post after a launch, with and
+without warming the connection to the outcome host at launch time.
+The fake LMS delays the first response of every connection to stand in
+for DNS, TCP and TLS setup.
+
+Run from the repository root::
+
+    PYTHONPATH=. python benchmarks/bench_prewarm.py
+"""
+from __future__ import print_function
+
+import time
+
+from pylti.common import generate_request_xml, post_message
+from pylti.fake_lms import FakeLMS
+from pylti.transport import ConnectionWarmer, TransportPool
+from pylti.urllib3 import Urllib3Transport
+
+CONSUMERS = {'__consumer_key__': {'secret': '__lti_secret__'}}
+TRIALS = 20
+CONNECT_LATENCY = 0.05
+LATENCY = 0.005
+# Time between launch and first grade post
+THINK_TIME = 0.1
+
+
+def first_post(lms, prewarm):
+    """
+    Launch with a cold transport pool and time the first grade post
+
+    :return: seconds
+    """
+    pool = TransportPool(factory=Urllib3Transport, shared=True)
+    if prewarm:
+        warmer = ConnectionWarmer(pool)
+        warmer.warm(CONSUMERS, '__consumer_key__', lms.outcome_url)
+    time.sleep(THINK_TIME)
+    xml = generate_request_xml(u'bench', u'replaceResult', u'sourced', 0.5)
+    started = time.time()
+    assert post_message(CONSUMERS, '__consumer_key__', lms.outcome_url, xml,
+                        transport=pool.get('__consumer_key__', CONSUMERS))
+    elapsed = time.time() - started
+    if prewarm:
+        warmer.close()
+    pool.get('__consumer_key__', CONSUMERS).close()
+    return elapsed
+
+
+def main():
+    """
+    Print average first post latency with and without warming.
+    """
+    with FakeLMS(CONSUMERS, latency=LATENCY,
+                 connect_latency=CONNECT_LATENCY) as lms:
+        for name, prewarm in (('cold', False), ('prewarmed', True)):
+            total = sum(first_post(lms, prewarm) for _ in range(TRIALS))
+            print("{:<10} {:8.1f} ms first post".format(
+                name, total / TRIALS * 1000))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,20 @@
+# -*- coding: utf-8 -*-
+"""
+pytest configuration of PyLTI
+"""
+import sys
+
+# pylti.asgi and its tests use async syntax of Python 3.5+, which earlier
+# versions can neither import nor check with pytest-flakes
+collect_ignore = []  # pylint: disable=invalid-name
+if sys.version_info < (3, 5):
+    collect_ignore += ['pylti/asgi.py', 'pylti/tests/test_asgi.py']
+
+
+def pytest_report_header(config):  # pylint: disable=unused-argument
+    """
+    Tell that the ASGI tests are skipped
+    """
+    if collect_ignore:
+        return 'pylti.asgi skipped, it requires Python 3.5 or newer'
+    return None
@@ -0,0 +1,356 @@
+# -*- coding: utf-8 -*-
+"""
+    PyLTI middleware and decorator for ASGI applications, requires
+    Python 3.5 or newer
+"""
+from __future__ import absolute_import
+
+import asyncio
+import functools
+import logging
+from functools import wraps
+
+from six.moves.urllib.parse import parse_qsl
+
+from .common import (
+    LTI_SESSION_KEY,
+    URL_REWRITERS,
+    LTIBase,
+    LTIException,
+    LTINotInSessionException,
+    LaunchContext,
+    create_oauth_server,
+    verify_request_common,
+)
+from .wsgi import MAX_LAUNCH_SIZE
+
+log = logging.getLogger('pylti.asgi')  # pylint: disable=invalid-name
+
+# ASGI scope key of the LaunchContext of a verified launch
+LAUNCH_SCOPE_KEY = 'pylti.launch'
+
+
+async def _respond(send, status, message):
+    """
+    Send plain text response
+    """
+    body = message.encode('utf-8')
+    await send({'type': 'http.response.start', 'status': status,
+                'headers': [(b'content-type', b'text/plain; charset=utf-8'),
+                            (b'content-length',
+                             str(len(body)).encode('ascii'))]})
+    await send({'type': 'http.response.body', 'body': body})
+
+
+def _headers(scope):
+    """
+    Request headers of scope, by their WSGI names
+
+    :return: dict
+    """
+    headers = {}
+    for name, value in scope.get('headers', ()):
+        name = name.decode('latin-1')
+        value = value.decode('latin-1')
+        headers['HTTP_' + name.upper().replace('-', '_')] = value
+        if name.lower() == 'authorization':
+            headers['Authorization'] = value
+    return headers
+
+
+def _url(scope, headers):
+    """
+    Request url of scope, including the query string
+
+    :return: url
+    """
+    host = headers.get('HTTP_HOST')
+    if host is None:
+        server = scope.get('server') or ('localhost', None)
+        host = server[0] if server[1] is None else '{}:{}'.format(*server)
+    url = u'{}://{}{}{}'.format(scope.get('scheme', 'http'), host,
+                                scope.get('root_path', ''), scope['path'])
+    if scope.get('query_string'):
+        url += u'?' + scope['query_string'].decode('latin-1')
+    return url
+
+
+class LTIMiddleware(object):
+    """
+    ASGI middleware verifying LTI launch POSTs to ``paths`` before they
+    reach the application.  The form body is buffered up to
+    ``max_size`` bytes and passed on to the application.  Invalid
+    launches are answered with 403 and forms that are not UTF-8 with
+    400, verified launches carry their
+    :py:class:`pylti.common.LaunchContext` under
+    :py:data:`LAUNCH_SCOPE_KEY` in the scope.
+
+    Usage::
+
+        app = LTIMiddleware(app, consumers, paths=['/launch'])
+    """
+    # pylint: disable=too-few-public-methods
+
+    def __init__(self, app, consumers, paths=None, max_size=MAX_LAUNCH_SIZE,
+                 capture_custom=False, offload=False, nonce_store=None):
+        """
+        :param app: ASGI application
+        :param consumers: consumers from config
+        :param paths: launch paths, or None for every form POST that
+            carries an lti_message_type; forms without a Content-Length,
+            larger than ``max_size`` or not UTF-8 then pass on unverified
+        :param max_size: largest launch form in bytes
+        :param capture_custom: keep custom_* parameters in the context
+        :param offload: verify signatures in the default executor
+            instead of on the event loop
+        :param nonce_store: store of seen nonces like
+            :py:class:`pylti.session.MemoryNonceStore`, rejecting
+            replayed launches
+        """
+        # pylint: disable=too-many-arguments
+        self.app = app
+        self.consumers = consumers
+        self.paths = frozenset(paths) if paths is not None else None
+        self.max_size = max_size
+        self.capture_custom = capture_custom
+        self.offload = offload
+        self.nonce_store = nonce_store
+        self._oauth_server = create_oauth_server(consumers)
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] != 'http' or scope.get('method') != 'POST' or (
+                self.paths is not None and scope['path'] not in self.paths):
+            return await self.app(scope, receive, send)
+        headers = _headers(scope)
+        if not headers.get('HTTP_CONTENT_TYPE', '').startswith(
+                'application/x-www-form-urlencoded'):
+            return await self.app(scope, receive, send)
+
+        if self.paths is None:
+            try:
+                length = int(headers.get('HTTP_CONTENT_LENGTH', ''))
+            except ValueError:
+                length = -1
+            if not 0 <= length <= self.max_size:
+                # Without launch paths, forms of unknown or too large size
+                # are not read and pass on untouched
+                return await self.app(scope, receive, send)
+
+        chunks, size, more_body = [], 0, True
+        while more_body and size <= self.max_size:
+            message = await receive()
+            if message['type'] != 'http.request':
+                return None
+            chunks.append(message.get('body', b''))
+            size += len(chunks[-1])
+            more_body = message.get('more_body', False)
+        body = b''.join(chunks)
+        params = None
+        if size > self.max_size:
+            if self.paths is not None:
+                log.info('Rejected launch of more than %s bytes', size)
+                return await _respond(send, 413, u'LTI launch too large')
+        else:
+            try:
+                params = dict(parse_qsl(body.decode('utf-8'),
+                                        keep_blank_values=True))
+            except UnicodeDecodeError:
+                if self.paths is not None:
+                    log.info('Rejected launch that is not UTF-8')
+                    return await _respond(send, 400,
+                                          u'LTI launch is not UTF-8')
+        if params is not None and (self.paths is not None or
+                                   'lti_message_type' in params):
+            verify = functools.partial(
+                verify_request_common, self.consumers,
+                _url(scope, headers), 'POST', headers, params,
+                oauth_server=self._oauth_server,
+                nonce_store=self.nonce_store)
+            try:
+                if self.offload:
+                    await asyncio.get_event_loop().run_in_executor(
+                        None, verify)
+                else:
+                    verify()
+            except LTIException:
+                log.debug('launch verification failed')
+                return await _respond(send, 403,
+                                      u'LTI launch verification failed')
+            scope = dict(scope)
+            scope[LAUNCH_SCOPE_KEY] = LaunchContext.from_params(
+                params, self.capture_custom)
+
+        replayed = []
+
+        async def replay():
+            """ Pass the buffered body on, then the original messages """
+            if not replayed:
+                replayed.append(True)
+                return {'type': 'http.request', 'body': body,
+                        'more_body': more_body}
+            return await receive()
+
+        return await self.app(scope, replay, send)
+
+
+class LTI(LTIBase):
+    """
+    LTI object of a launch verified by :py:class:`LTIMiddleware`,
+    offering the :py:class:`pylti.common.LTIBase` API with grades also
+    posted without blocking the event loop.
+
+    ASGI has no sessions, so only ``initial`` requests are supported.
+    """
+
+    def __init__(self, scope, consumers, **lti_kwargs):
+        """
+        :param scope: ASGI scope
+        :param consumers: consumers from config
+        :param lti_kwargs: wrapper attributes like ``role``,
+            ``transport_pool``, ``ack_cache`` and ``url_fix``, the
+            PYLTI_URL_FIX mapping
+        """
+        self.scope = scope
+        self.consumers = consumers
+        self.session = {}
+        LTIBase.__init__(self, (), lti_kwargs)
+
+    def _consumers(self):
+        """
+        Consumers given to the wrapper
+
+        :return: consumers map
+        """
+        return self.consumers
+
+    def verify_request(self):
+        """
+        Take launch verified by :py:class:`LTIMiddleware`
+
+        :raises: LTIException if the launch was not verified
+        """
+        launch = self.scope.get(LAUNCH_SCOPE_KEY)
+        if launch is None:
+            raise LTIException('This page requires a verified LTI launch, '
+                               'is LTIMiddleware installed?')
+        self._launch = launch
+        self.session[LTI_SESSION_KEY] = True
+        self._prewarm()
+        self._record_grade_target()
+        return True
+
+    @property
+    def response_url(self):
+        """
+        Returns lis_outcome_service_url remapped by the ``url_fix``
+        wrapper attribute
+
+        :return: remapped lis_outcome_service_url
+        """
+        return URL_REWRITERS.get(self.lti_kwargs.get('url_fix')).rewrite(
+            self.launch.lis_outcome_service_url)
+
+    def _verify_any(self):
+        """
+        Verify initial request, there are no sessions to fall back to
+
+        :raises: LTIException
+        """
+        self.verify_request()
+
+    @staticmethod
+    def _verify_session():
+        """
+        Sessions are not supported
+
+        :raises: LTINotInSessionException
+        """
+        raise LTINotInSessionException('ASGI does not support sessions, '
+                                       'use request type initial')
+
+    async def _run(self, method, *args, **kwargs):
+        """
+        Run blocking method in the ``executor`` wrapper attribute, or
+        the default executor
+        """
+        return await asyncio.get_event_loop().run_in_executor(
+            self.lti_kwargs.get('executor'),
+            functools.partial(method, *args, **kwargs))
+
+    async def post_grade_async(self, grade, **kwargs):
+        """
+        :py:meth:`pylti.common.LTIBase.post_grade` without blocking the
+        event loop
+        """
+        return await self._run(self.post_grade, grade, **kwargs)
+
+    async def post_grade2_async(self, grade, **kwargs):
+        """
+        :py:meth:`pylti.common.LTIBase.post_grade2` without blocking the
+        event loop
+        """
+        return await self._run(self.post_grade2, grade, **kwargs)
+
+    async def read_grade_async(self):
+        """
+        :py:meth:`pylti.common.LTIBase.read_grade` without blocking the
+        event loop
+        """
+        return await self._run(self.read_grade)
+
+    async def delete_grade_async(self):
+        """
+        :py:meth:`pylti.common.LTIBase.delete_grade` without blocking the
+        event loop
+        """
+        return await self._run(self.delete_grade)
+
+
+async def default_error(scope, receive, send, exception):
+    """
+    Answer requests failing LTI checks with 403
+    """
+    # pylint: disable=unused-argument
+    await _respond(send, 403, u'There was an LTI communication error')
+
+
+def lti(consumers, request='initial', error=default_error, role='any',
+        **lti_kwargs):
+    """
+    LTI decorator of ASGI handlers called as
+    ``await handler(scope, receive, send, lti=lti)``
+
+    :param: consumers - consumers from config
+    :param: error - coroutine called as
+        ``await error(scope, receive, send, exception)`` if LTI throws
+        exception (optional)
+    :param: request - Request type, ``initial`` or ``any``
+    :param: role - LTI Role (default: any)
+    :return: wrapper
+    """
+    lti_kwargs.update(request=request, error=error, role=role)
+
+    def _lti(function):
+        """
+        Inner LTI decorator
+
+        :param: function:
+        :return: ASGI application
+        """
+
+        @wraps(function)
+        async def wrapper(scope, receive, send):
+            """
+            Pass LTI reference to function or answer with error.
+            """
+            try:
+                the_lti = LTI(scope, consumers, **lti_kwargs)
+                the_lti.verify()
+                the_lti._check_role()  # pylint: disable=protected-access
+            except LTIException as lti_exception:
+                return await error(scope, receive, send, lti_exception)
+            return await function(scope, receive, send, lti=the_lti)
+
+        return wrapper
+
+    return _lti
@@ -19,8 +19,7 @@ except ImportError:
     from urlparse import urlunparse
 
 from .common import (
-    LTI_SESSION_KEY,
-    LTI_PROPERTY_LIST,
+    URL_REWRITERS,
     verify_request_common,
     default_error,
     LTIException,
@@ -101,43 +100,28 @@ class LTI(LTIBase):
 
             # All good to go, store all of the LTI params into a
             # session dict for use in views
-            for prop in LTI_PROPERTY_LIST:
-                if params.get(prop, None):
-                    log.debug("params %s=%s", prop, params.get(prop, None))
-                    self.session[prop] = params[prop]
-
-            # Set logged in session key
-            self.session[LTI_SESSION_KEY] = True
+            self._store_launch(params)
+            self._prewarm()
+            self._record_grade_target()
             return True
         except LTIException:
             log.debug('verify_request failed')
-            for prop in LTI_PROPERTY_LIST:
-                if self.session.get(prop, None):
-                    del self.session[prop]
-
-            self.session[LTI_SESSION_KEY] = False
+            self._clear_launch()
             raise
 
     @property
     def response_url(self):
         """
         Returns remapped lis_outcome_service_url
-        uses PYLTI_URL_FIX map to support edX dev-stack
+        uses the PYLTI_URL_FIX map, given as JSON in the Lambda environment
+        variable PYLTI_URL_FIX, to support edX dev-stack
 
         :return: remapped lis_outcome_service_url
         """
-        url = ""
-        url = self.session['lis_outcome_service_url']
-        # TODO: Remove this section if not needed
-        # app_config = self.config
-        # urls = app_config.get('PYLTI_URL_FIX', dict())
-        # # url remapping is useful for using devstack
-        # # devstack reports httpS://localhost:8000/ and listens on HTTP
-        # for prefix, mapping in urls.items():
-        #     if url.startswith(prefix):
-        #         for _from, _to in mapping.items():
-        #             url = url.replace(_from, _to)
-        return url
+        # url remapping is useful for using devstack
+        # devstack reports httpS://localhost:8000/ and listens on HTTP
+        rewriter = URL_REWRITERS.get(os.environ.get('PYLTI_URL_FIX', '{}'))
+        return rewriter.rewrite(self.launch.lis_outcome_service_url)
 
     def _verify_any(self):
         """
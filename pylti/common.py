@@ -5,13 +5,57 @@ Common classes and methods for PyLTI module
 
 from __future__ import absolute_import
 
+import base64
+import hashlib
+import hmac
 import logging
 import json
+import re
+import threading
+import time
 import oauth2
+from io import BytesIO
 from xml.etree import ElementTree as etree
+from xml.sax.saxutils import escape as xml_escape
 
 from oauth2 import STRING_TYPES
-from six.moves.urllib.parse import urlparse, urlencode
+from six import text_type
+from six.moves.urllib.parse import urlparse, urlunparse, urlencode
+
+from .exceptions import (  # noqa: F401 pylint: disable=unused-import
+    LTICircuitOpenException,
+    LTIException,
+    LTINotInSessionException,
+    LTIPostMessageException,
+    LTIRoleException,
+    LTITimeoutException,
+    LTITransportException,
+)
+from .transport import (  # noqa: F401 pylint: disable=unused-import
+    BACKGROUND_POSTS,
+    CIRCUIT_BREAKERS,
+    CONCURRENCY_LIMITERS,
+    GRADE_PENDING,
+    RATE_LIMITERS,
+    TLS_CONTEXTS,
+    BackgroundPoster,
+    CircuitBreaker,
+    CircuitBreakerRegistry,
+    ConcurrencyLimiter,
+    ConcurrencyLimiterRegistry,
+    ConnectionWarmer,
+    HostRegistry,
+    Httplib2Transport,
+    TLSContextCache,
+    TokenBucket,
+    TokenBucketRegistry,
+    Transport,
+    TransportPool,
+    _clock,
+    _remaining_timeout,
+    consumer_timeouts,
+    create_transport,
+)
 
 log = logging.getLogger('pylti.common')  # pylint: disable=invalid-name
 
@@ -47,10 +91,31 @@ LTI_ROLES = {
     # There is also a special role u'any' that ignores role check
 }
 
+# Prefixes of course (context) roles, shortened by normalize_role
+_COURSE_ROLE_URN = u'urn:lti:role:ims/lis/'
+_COURSE_ROLE_URL = u'http://purl.imsglobal.org/vocab/lis/v2/membership'
+
 LTI_SESSION_KEY = u'lti_authenticated'
 
+# Session key of the serialized LaunchContext
+LTI_CONTEXT_KEY = u'lti_context'
+
 LTI_REQUEST_TYPE = [u'any', u'initial', u'session']
 
+# Request header carrying a signed LaunchContext from a verifying gateway
+LAUNCH_HEADER = 'X-LTI-Launch'
+
+# Returned by post_grade/post_grade2 instead of True when the same score
+# was already acknowledged by the consumer and the post was not sent
+GRADE_SKIPPED = u'skipped'
+
+# Returned by post_grade/post_grade2 when the post was deferred until
+# after the response was sent
+GRADE_DEFERRED = u'deferred'
+
+# Outcome service responses larger than this are rejected without parsing
+MAX_OUTCOME_RESPONSE_SIZE = 64 * 1024
+
 
 def default_error(exception=None):
     """Render simple error page.  This should be overidden in applications."""
@@ -110,92 +175,101 @@ class LTIOAuthServer(oauth2.Server):
         return cert
 
 
-class LTIException(Exception):
+def _lookup_consumer(consumers, lti_key):
     """
-    Custom LTI exception for proper handling
-    of LTI specific errors
-    """
-    pass
-
+    OAuth consumer for key
 
-class LTINotInSessionException(LTIException):
-    """
-    Custom LTI exception for proper handling
-    of LTI specific errors
+    :param consumers: consumers from config
+    :param lti_key: key to find appropriate consumer
+    :return: oauth2.Consumer
+    :exception: LTIException if consumer is unknown
     """
-    pass
+    lti_consumer = LTIOAuthServer(consumers).lookup_consumer(lti_key)
+    if lti_consumer is None:
+        raise LTIException("Unknown consumer {}".format(lti_key))
+    return lti_consumer
 
 
-class LTIRoleException(LTIException):
-    """
-    Exception class for when LTI user doesn't have the
-    right role.
+def sign_request(consumer, url, method, body, content_type):
     """
-    pass
+    Sign outcome request with OAuth body hash
 
-
-class LTIPostMessageException(LTIException):
-    """
-    Exception class for when LTI user doesn't have the
-    right role.
+    :param consumer: oauth2.Consumer
+    :param url: request url
+    :param method: HTTP method
+    :param body: encoded request body
+    :param content_type: request content type
+    :return: (url, headers) to send
     """
-    pass
+    req = oauth2.Request.from_consumer_and_token(
+        consumer, token=None, http_method=method, http_url=url,
+        body=body, is_form_encoded=False)
+    req.sign_request(oauth2.SignatureMethod_HMAC_SHA1(), consumer, None)
+
+    headers = {'Content-Type': content_type}
+    if method == 'GET':
+        return req.to_url(), headers
+    scheme, netloc = urlparse(url)[:2]
+    realm = urlunparse((scheme, netloc, '', None, None, None))
+    headers.update(req.to_header(realm=realm))
+    return url, headers
 
 
 def _post_patched_request(consumers, lti_key, body,
-                          url, method, content_type):
+                          url, method, content_type, transport=None,
+                          deadline=None):
     """
     Authorization header needs to be capitalized for some LTI clients
-    this function ensures that header is capitalized
+    the transport ensures that header is capitalized
+
+    Every attempt waits for a token of the consumer's ``rate`` limit.
+    Connection errors and 5xx responses are retried as often as the
+    consumer's ``retries`` setting allows.  Timeouts of every attempt are
+    shortened so that all attempts together end by the deadline.
 
     :param body: body of the call
-    :param client: OAuth Client
+    :param transport: :py:class:`Transport`, created if not given
     :param url: outcome url
+    :param deadline: absolute time.time() by which the call must end
     :return: response
+    :exception: LTIPostMessageException on timeout or passed deadline
     """
-    # pylint: disable=too-many-locals, too-many-arguments
-    oauth_server = LTIOAuthServer(consumers)
-    oauth_server.add_signature_method(SignatureMethod_HMAC_SHA1_Unicode())
-    lti_consumer = oauth_server.lookup_consumer(lti_key)
-    lti_cert = oauth_server.lookup_cert(lti_key)
-    secret = lti_consumer.secret
-
-    consumer = oauth2.Consumer(key=lti_key, secret=secret)
-    client = oauth2.Client(consumer)
-
-    if lti_cert:
-        client.add_certificate(key=lti_cert, cert=lti_cert, domain='')
-        log.debug("cert %s", lti_cert)
-
-    import httplib2
-
-    http = httplib2.Http
-    # pylint: disable=protected-access
-    normalize = http._normalize_headers
-
-    def my_normalize(self, headers):
-        """ This function patches Authorization header """
-        ret = normalize(self, headers)
-        if 'authorization' in ret:
-            ret['Authorization'] = ret.pop('authorization')
-        log.debug("headers")
-        log.debug(headers)
-        return ret
-
-    http._normalize_headers = my_normalize
-    monkey_patch_function = normalize
-    response, content = client.request(
-        url,
-        method,
-        body=body.encode('utf-8'),
-        headers={'Content-Type': content_type})
-
-    http = httplib2.Http
-    # pylint: disable=protected-access
-    http._normalize_headers = monkey_patch_function
+    # pylint: disable=too-many-arguments, too-many-locals
+    consumer = _lookup_consumer(consumers, lti_key)
+    if transport is None:
+        transport = create_transport(consumers, lti_key)
+    connect_timeout, read_timeout = consumer_timeouts(consumers, lti_key)
+    config = consumers.get(lti_key) or {}
+    retries = config.get('retries', 0)
+    retry_delay = config.get('retry_delay', 0.1)
+    bucket = RATE_LIMITERS.get(consumers, lti_key)
+    body = body.encode('utf-8')
+
+    attempt = 0
+    while True:
+        if bucket is not None:
+            bucket.acquire(deadline)
+        try:
+            response, content = _send_request(
+                transport, consumer, body, url, method, content_type,
+                (connect_timeout, read_timeout), deadline)
+            if response.status < 500 or attempt >= retries:
+                break
+            log.info("Outcome service responded %s, retrying",
+                     response.status)
+        except LTICircuitOpenException:
+            raise
+        except LTITransportException as err:
+            if attempt >= retries:
+                raise
+            log.info("Outcome request failed, retrying: %s", err)
+        attempt += 1
+        delay = retry_delay * 2 ** (attempt - 1)
+        if deadline is not None:
+            delay = min(delay, max(deadline - time.time(), 0))
+        time.sleep(delay)
 
     log.debug("key %s", lti_key)
-    log.debug("secret %s", secret)
     log.debug("url %s", url)
     log.debug("response %s", response)
     log.debug("content %s", format(content))
@@ -203,7 +277,151 @@ def _post_patched_request(consumers, lti_key, body,
     return response, content
 
 
-def post_message(consumers, lti_key, url, body):
+def _send_request(transport, consumer, body, url, method, content_type,
+                  timeouts, deadline=None):
+    """
+    Sign and send single request within the host's concurrency limit and
+    through its circuit breaker
+
+    :param timeouts: configured (connect_timeout, read_timeout)
+    :param deadline: absolute time.time() by which the request must end
+    :return: (response, content)
+    """
+    # pylint: disable=too-many-arguments
+    limiter = CONCURRENCY_LIMITERS.get(url)
+    marker = limiter.acquire(deadline) if limiter is not None else None
+    success = None
+    try:
+        timeouts = [_remaining_timeout(timeout, deadline)
+                    for timeout in timeouts]
+        breaker = CIRCUIT_BREAKERS.get(url)
+        if breaker is not None:
+            breaker.before_request(CIRCUIT_BREAKERS.host(url))
+
+        signed_url, headers = sign_request(consumer, url, method, body,
+                                           content_type)
+        started = _clock()
+        try:
+            response, content = transport.request(
+                signed_url, method, body, headers, *timeouts)
+        except Exception as err:
+            if breaker is not None:
+                breaker.record(False, _clock() - started)
+            if isinstance(err, LTITimeoutException):
+                success = False
+            raise
+        if breaker is not None:
+            breaker.record(response.status < 500, _clock() - started)
+        success = response.status != 429 and response.status < 500
+        return response, content
+    finally:
+        if limiter is not None:
+            limiter.release(marker, success)
+
+
+class OutcomeResponse(object):
+    """
+    Status of an LTI 1.1 outcome service response.  Evaluates to True
+    when the consumer reported success.
+    """
+    # pylint: disable=too-few-public-methods, too-many-arguments
+
+    def __init__(self, code_major=None, severity=None, description=None,
+                 message_ref_identifier=None, score=None, error=None):
+        self.code_major = code_major
+        self.severity = severity
+        self.description = description
+        self.message_ref_identifier = message_ref_identifier
+        self.score = score
+        # Set when the response could not be read as an outcome response
+        self.error = error
+
+    @property
+    def is_success(self):
+        """
+        Consumer reported success
+
+        :return: True if imsx_codeMajor is success
+        """
+        return self.code_major == u'success'
+
+    def __bool__(self):
+        return self.is_success
+
+    __nonzero__ = __bool__
+
+    def __repr__(self):
+        return ('OutcomeResponse(code_major={!r}, severity={!r}, '
+                'description={!r}, error={!r})').format(
+                    self.code_major, self.severity, self.description,
+                    self.error)
+
+
+_OUTCOME_STATUS_FIELDS = {
+    'imsx_codeMajor': 'code_major',
+    'imsx_severity': 'severity',
+    'imsx_description': 'description',
+    'imsx_messageRefIdentifier': 'message_ref_identifier',
+}
+
+
+def parse_outcome_response(content, want_score=False,
+                           max_size=MAX_OUTCOME_RESPONSE_SIZE):
+    """
+    Parse LTI 1.1 outcome service response incrementally, stopping as
+    soon as the status (and the score if requested) has been read.
+    Element namespaces are ignored.  Oversized responses and responses
+    with a document type declaration are rejected without parsing.
+
+    :param content: response body
+    :param want_score: also read readResult resultScore as float,
+        None if the result has no score
+    :param max_size: largest accepted response in bytes
+    :return: :py:class:`OutcomeResponse`
+    """
+    if isinstance(content, text_type):
+        content = content.encode('utf-8')
+    if not content:
+        return OutcomeResponse(error='Empty response')
+    if len(content) > max_size:
+        log.warning("Outcome response of %d bytes rejected", len(content))
+        return OutcomeResponse(error='Response too large')
+    if b'<!DOCTYPE' in content or b'<!ENTITY' in content:
+        log.warning("Outcome response with DTD rejected")
+        return OutcomeResponse(error='Document type declarations '
+                                     'are not allowed')
+
+    response = OutcomeResponse()
+    status_read = False
+    try:
+        for _, element in etree.iterparse(BytesIO(content)):
+            tag = element.tag.rsplit('}', 1)[-1]
+            if tag in _OUTCOME_STATUS_FIELDS:
+                setattr(response, _OUTCOME_STATUS_FIELDS[tag],
+                        (element.text or u'').strip() or None)
+            elif tag == 'imsx_statusInfo':
+                status_read = True
+                if not want_score:
+                    break
+            elif tag == 'textString' and want_score:
+                text = (element.text or u'').strip()
+                response.score = float(text) if text else None
+                break
+            element.clear()
+    except etree.ParseError as err:
+        log.debug("Invalid outcome response %s", err)
+        return OutcomeResponse(error='Invalid XML')
+    except ValueError:
+        log.debug("Invalid resultScore in outcome response")
+        return OutcomeResponse(error='Invalid resultScore')
+
+    if not status_read:
+        response.error = 'Missing imsx_statusInfo'
+    return response
+
+
+def post_message(consumers, lti_key, url, body, want_score=False,
+                 transport=None, deadline=None):
     """
         Posts a signed message to LTI consumer
 
@@ -211,8 +429,12 @@ def post_message(consumers, lti_key, url, body):
     :param lti_key: key to find appropriate consumer
     :param url: post url
     :param body: xml body
-    :return: success
+    :param want_score: read resultScore of a readResult response
+    :param transport: :py:class:`Transport` to reuse
+    :param deadline: absolute time.time() by which the post must end
+    :return: :py:class:`OutcomeResponse`, True on success
     """
+    # pylint: disable=too-many-arguments
     content_type = 'application/xml'
     method = 'POST'
     (_, content) = _post_patched_request(
@@ -222,15 +444,18 @@ def post_message(consumers, lti_key, url, body):
         url,
         method,
         content_type,
+        transport=transport,
+        deadline=deadline,
     )
 
-    is_success = b"<imsx_codeMajor>success</imsx_codeMajor>" in content
-    log.debug("is success %s", is_success)
-    return is_success
+    outcome = parse_outcome_response(content, want_score=want_score)
+    log.debug("is success %s", outcome)
+    return outcome
 
 
 def post_message2(consumers, lti_key, url, body,
-                  method='POST', content_type='application/xml'):
+                  method='POST', content_type='application/xml',
+                  transport=None, deadline=None):
     """
         Posts a signed message to LTI consumer using LTI 2.0 format
 
@@ -238,6 +463,8 @@ def post_message2(consumers, lti_key, url, body,
     :param: lti_key: key to find appropriate consumer
     :param: url: post url
     :param: body: xml body
+    :param: transport: :py:class:`Transport` to reuse
+    :param: deadline: absolute time.time() by which the post must end
     :return: success
     """
     # pylint: disable=too-many-arguments
@@ -248,6 +475,8 @@ def post_message2(consumers, lti_key, url, body,
         url,
         method,
         content_type,
+        transport=transport,
+        deadline=deadline,
     )
 
     is_success = response.status == 200
@@ -256,7 +485,43 @@ def post_message2(consumers, lti_key, url, body,
     return is_success
 
 
-def verify_request_common(consumers, url, method, headers, params):
+def _run_deferred(function, callback=None):
+    """
+    Run post that was deferred until after the response, logging its
+    failure and passing its success to callback
+
+    :param function: post returning its result or raising
+    :param callback: called with True or False when the post ends
+    """
+    try:
+        result = bool(function())
+    except Exception as err:  # pylint: disable=broad-except
+        log.warning("Deferred grade post failed: %s", err)
+        result = False
+    if callback is not None:
+        try:
+            callback(result)
+        except Exception:  # pylint: disable=broad-except
+            log.exception("Deferred grade post callback failed")
+
+
+def create_oauth_server(consumers):
+    """
+    OAuth server verifying launches of consumers
+
+    :param consumers: consumers from config file
+    :return: :py:class:`LTIOAuthServer`
+    """
+    oauth_server = LTIOAuthServer(consumers)
+    oauth_server.add_signature_method(
+        SignatureMethod_PLAINTEXT_Unicode())
+    oauth_server.add_signature_method(
+        SignatureMethod_HMAC_SHA1_Unicode())
+    return oauth_server
+
+
+def verify_request_common(consumers, url, method, headers, params,
+                          oauth_server=None, nonce_store=None):
     """
     Verifies that request is valid
 
@@ -265,19 +530,22 @@ def verify_request_common(consumers, url, method, headers, params):
     :param method: request method
     :param headers: request headers
     :param params: request params
+    :param oauth_server: server from :py:func:`create_oauth_server` for
+        consumers, created when not given
+    :param nonce_store: store of seen nonces like
+        :py:class:`pylti.session.MemoryNonceStore`, rejecting replayed
+        requests
     :return: is request valid
     """
+    # pylint: disable=too-many-arguments
     log.debug("consumers %s", consumers)
     log.debug("url %s", url)
     log.debug("method %s", method)
     log.debug("headers %s", headers)
     log.debug("params %s", params)
 
-    oauth_server = LTIOAuthServer(consumers)
-    oauth_server.add_signature_method(
-        SignatureMethod_PLAINTEXT_Unicode())
-    oauth_server.add_signature_method(
-        SignatureMethod_HMAC_SHA1_Unicode())
+    if oauth_server is None:
+        oauth_server = create_oauth_server(consumers)
 
     # Check header for SSL before selecting the url
     if (
@@ -310,12 +578,47 @@ def verify_request_common(consumers, url, method, headers, params):
         # error message as it will contain the key
         raise LTIException("OAuth error: Please check your key and secret")
 
+    if nonce_store is not None and not nonce_store.add(
+            oauth_consumer_key, oauth_request.get('oauth_nonce')):
+        log.info('Rejected replayed launch of %s', oauth_consumer_key)
+        raise LTIException("OAuth error: Nonce was already used")
+
     return True
 
 
+# Fixed LTI 1.1 POX envelope, only the escaped values are inserted
+_REQUEST_XML_TEMPLATE = (
+    u"<?xml version='1.0' encoding='utf-8'?>\n"
+    u'<imsx_POXEnvelopeRequest xmlns="http://www.imsglobal.org/services/'
+    u'ltiv1p1/xsd/imsoms_v1p0"><imsx_POXHeader><imsx_POXRequestHeaderInfo>'
+    u'<imsx_version>V1.0</imsx_version>{message_identifier}'
+    u'</imsx_POXRequestHeaderInfo></imsx_POXHeader><imsx_POXBody>'
+    u'<{operation}Request><resultRecord><sourcedGUID>{sourcedid}'
+    u'</sourcedGUID>{result}</resultRecord></{operation}Request>'
+    u'</imsx_POXBody></imsx_POXEnvelopeRequest>'
+)
+
+_RESULT_XML_TEMPLATE = (
+    u'<result><resultScore><language>en</language>{text_string}'
+    u'</resultScore></result>'
+)
+
+
+def _xml_text_element(tag, text):
+    """
+    Serialize element with text content the same way ElementTree does
+
+    :param tag: element name
+    :param text: element text or None
+    :return: XML string
+    """
+    if not text:
+        return u'<{0} />'.format(tag)
+    return u'<{0}>{1}</{0}>'.format(tag, xml_escape(text))
+
+
 def generate_request_xml(message_identifier_id, operation,
                          lis_result_sourcedid, score):
-    # pylint: disable=too-many-locals
     """
     Generates LTI 1.1 XML for posting result to LTI consumer.
 
@@ -325,34 +628,19 @@ def generate_request_xml(message_identifier_id, operation,
     :param score:
     :return: XML string
     """
-    root = etree.Element(u'imsx_POXEnvelopeRequest',
-                         xmlns=u'http://www.imsglobal.org/services/'
-                               u'ltiv1p1/xsd/imsoms_v1p0')
-
-    header = etree.SubElement(root, 'imsx_POXHeader')
-    header_info = etree.SubElement(header, 'imsx_POXRequestHeaderInfo')
-    version = etree.SubElement(header_info, 'imsx_version')
-    version.text = 'V1.0'
-    message_identifier = etree.SubElement(header_info,
-                                          'imsx_messageIdentifier')
-    message_identifier.text = message_identifier_id
-    body = etree.SubElement(root, 'imsx_POXBody')
-    xml_request = etree.SubElement(body, '%s%s' % (operation, 'Request'))
-    record = etree.SubElement(xml_request, 'resultRecord')
-
-    guid = etree.SubElement(record, 'sourcedGUID')
-
-    sourcedid = etree.SubElement(guid, 'sourcedId')
-    sourcedid.text = lis_result_sourcedid
     if score is not None:
-        result = etree.SubElement(record, 'result')
-        result_score = etree.SubElement(result, 'resultScore')
-        language = etree.SubElement(result_score, 'language')
-        language.text = 'en'
-        text_string = etree.SubElement(result_score, 'textString')
-        text_string.text = score.__str__()
-    ret = "<?xml version='1.0' encoding='utf-8'?>\n{}".format(
-        etree.tostring(root, encoding='utf-8').decode('utf-8'))
+        result = _RESULT_XML_TEMPLATE.format(
+            text_string=_xml_text_element(u'textString',
+                                          u'{}'.format(score)))
+    else:
+        result = u''
+    ret = _REQUEST_XML_TEMPLATE.format(
+        message_identifier=_xml_text_element(u'imsx_messageIdentifier',
+                                             message_identifier_id),
+        operation=operation,
+        sourcedid=_xml_text_element(u'sourcedId', lis_result_sourcedid),
+        result=result,
+    )
 
     log.debug("XML Response: \n%s", ret)
     return ret
@@ -461,6 +749,375 @@ class Request_Fix_Duplicate(oauth2.Request):
         return encoded_str.replace('+', '%20').replace('%7E', '~')
 
 
+def normalize_role(role):
+    """
+    Short LIS role name of a course role, with LIS URN and vocabulary URL
+    prefixes removed, so that ``urn:lti:role:ims/lis/Instructor`` and
+    ``http://purl.imsglobal.org/vocab/lis/v2/membership#Instructor``
+    are both ``Instructor``.  Sub-roles keep their own name:
+    ``urn:lti:role:ims/lis/Instructor/TeachingAssistant`` and
+    ``.../membership/Instructor#TeachingAssistant`` are both
+    ``TeachingAssistant`` and do not pass checks of the principal role.
+    Institution and system roles, like
+    ``urn:lti:instrole:ims/lis/Instructor``, are left as they are.
+
+    :param role: role from the roles launch parameter
+    :return: short role name
+    """
+    role = role.strip()
+    if role.startswith(_COURSE_ROLE_URN):
+        role = role.rsplit(u'/', 1)[-1]
+    elif role.startswith(_COURSE_ROLE_URL):
+        role = role.rsplit(u'#', 1)[-1]
+    return role
+
+
+class RoleTable(object):
+    """
+    :py:data:`LTI_ROLES` compiled into one bit per role name and one
+    mask per role group, so that role checks are a single AND.  Parsed
+    roles launch parameters are remembered, up to ``maxsize`` distinct
+    values.  Groups added later are compiled when first checked; call
+    :py:meth:`compile` after changing the roles of a group.
+    """
+
+    def __init__(self, groups, maxsize=10000):
+        """
+        :param groups: dict mapping group names to lists of role names,
+            like :py:data:`LTI_ROLES`
+        :param maxsize: most parsed roles parameters remembered
+        """
+        self.groups = groups
+        self.maxsize = maxsize
+        self._lock = threading.Lock()
+        self.compile()
+
+    def compile(self):
+        """
+        Assign bits and masks to the normalized role names of the groups
+        """
+        groups = dict((group, set(normalize_role(role) for role in roles))
+                      for group, roles in list(self.groups.items()))
+        bits = {}
+        for roles in groups.values():
+            for role in sorted(roles):
+                bits.setdefault(role, 1 << len(bits))
+        with self._lock:
+            self.bits = bits
+            self.masks = dict((group, sum(bits[role] for role in roles))
+                              for group, roles in groups.items())
+            self._parsed = {}
+
+    def group_mask(self, group):
+        """
+        Mask of role group.  Get the group mask before parsing roles, so
+        that both use the same bits.
+
+        :param group: key of the role groups, e.g. ``staff``
+        :return: mask
+        :exception: LTIException if group is unknown
+        """
+        mask = self.masks.get(group)
+        if mask is None and group in self.groups:
+            self.compile()
+            mask = self.masks.get(group)
+        if mask is None:
+            raise LTIException("Unknown role {}.".format(group))
+        return mask
+
+    def parse(self, roles):
+        """
+        Normalized role names and mask of a roles launch parameter
+
+        :param roles: comma separated roles
+        :return: (frozenset of role names, mask)
+        """
+        parsed = self._parsed.get(roles)
+        if parsed is None:
+            names = frozenset(normalize_role(role)
+                              for role in (roles or u'').split(u',')
+                              if role.strip())
+            parsed = (names, sum(self.bits.get(name, 0) for name in names))
+            with self._lock:
+                if len(self._parsed) >= self.maxsize:
+                    self._parsed = {}
+                self._parsed[roles] = parsed
+        return parsed
+
+
+# Compiled LTI_ROLES used by role checks
+LTI_ROLE_TABLE = RoleTable(LTI_ROLES)
+
+
+class UrlRewriter(object):
+    """
+    PYLTI_URL_FIX mapping compiled once, rewriting outcome service urls.
+    Mapping keys are url prefixes, values map substrings of urls starting
+    with the prefix to their replacements; every matching prefix is
+    applied in mapping order.  Rewritten urls are remembered, up to
+    ``maxsize`` distinct urls.
+    """
+
+    def __init__(self, mapping=None, maxsize=10000):
+        """
+        :param mapping: PYLTI_URL_FIX mapping
+        :param maxsize: most rewritten urls remembered
+        """
+        self.rules = tuple((prefix, tuple(replacements.items()))
+                           for prefix, replacements in (mapping or {}).items())
+        self.maxsize = maxsize
+        self._prefixes = re.compile(u'|'.join(
+            re.escape(prefix) for prefix, _ in self.rules)) if self.rules \
+            else None
+        self._memo = {}
+        self._lock = threading.Lock()
+
+    def rewrite(self, url):
+        """
+        Apply mapping to url
+
+        :param url: lis_outcome_service_url
+        :return: remapped url
+        """
+        if self._prefixes is None or not url:
+            return url
+        rewritten = self._memo.get(url)
+        if rewritten is not None:
+            return rewritten
+        rewritten = url
+        # A single match tells urls without any rewrite apart
+        if self._prefixes.match(url):
+            for prefix, replacements in self.rules:
+                if rewritten.startswith(prefix):
+                    for _from, _to in replacements:
+                        rewritten = rewritten.replace(_from, _to)
+        with self._lock:
+            if len(self._memo) >= self.maxsize:
+                self._memo.clear()
+            self._memo[url] = rewritten
+        return rewritten
+
+
+class UrlRewriterRegistry(object):
+    """
+    Compiled :py:class:`UrlRewriter` of every PYLTI_URL_FIX mapping in
+    use, shared by the framework adapters.  Mappings are recognized by
+    identity, or by value for JSON text; call :py:meth:`clear` after
+    changing a mapping in place.
+    """
+    # Most mappings kept before all are compiled again
+    maxsize = 100
+
+    def __init__(self):
+        self._items = {}
+        self._lock = threading.Lock()
+
+    def get(self, mapping):
+        """
+        Rewriter of mapping, compiled on first use
+
+        :param mapping: PYLTI_URL_FIX dict, or its JSON text
+        :return: :py:class:`UrlRewriter`
+        """
+        is_text = isinstance(mapping, STRING_TYPES)
+        key = mapping if is_text else id(mapping)
+        item = self._items.get(key)
+        # Dict mappings are kept referenced so that their id is not reused
+        if item is not None and (is_text or item[0] is mapping):
+            return item[1]
+        rewriter = UrlRewriter(json.loads(mapping) if is_text else mapping)
+        with self._lock:
+            if len(self._items) >= self.maxsize:
+                self._items = {}
+            self._items[key] = (mapping, rewriter)
+        return rewriter
+
+    def clear(self):
+        """
+        Forget compiled rewriters
+        """
+        with self._lock:
+            self._items = {}
+
+
+# Compiled PYLTI_URL_FIX mappings of all adapters
+URL_REWRITERS = UrlRewriterRegistry()
+
+
+class LaunchContext(object):
+    """
+    Verified launch parameters, kept in the session as one compact value
+    under :py:data:`LTI_CONTEXT_KEY` when the ``lti`` wrapper is given
+    ``launch_context=True``.  Fields are named after
+    :py:data:`LTI_PROPERTY_LIST` and are None when not launched with;
+    ``custom`` holds the ``custom_*`` parameters when captured with
+    ``capture_custom=True``.
+    """
+    FIELDS = tuple(LTI_PROPERTY_LIST)
+    __slots__ = FIELDS + ('custom',)
+    # Serialization format, stored as first element
+    VERSION = 1
+
+    def __init__(self, custom=None, **fields):
+        """
+        :param custom: dict of custom_* parameters
+        :param fields: launch parameters
+        """
+        for name in self.FIELDS:
+            setattr(self, name, fields.pop(name, None))
+        if fields:
+            raise TypeError("Unknown launch fields {}".format(
+                sorted(fields)))
+        self.custom = custom or {}
+
+    @classmethod
+    def from_params(cls, params, capture_custom=False):
+        """
+        Context of launch parameters, empty values are left out
+
+        :param params: launch parameters or session
+        :param capture_custom: keep custom_* parameters
+        :return: :py:class:`LaunchContext`
+        """
+        context = cls.__new__(cls)
+        for name in cls.FIELDS:
+            setattr(context, name, params.get(name) or None)
+        context.custom = {}
+        if capture_custom:
+            context.custom = dict((name, value)
+                                  for name, value in params.items()
+                                  if name.startswith('custom_'))
+        return context
+
+    @classmethod
+    def from_session(cls, session):
+        """
+        Context stored in session, or built from the launch parameters
+        stored one per session key
+
+        :param session: session
+        :return: :py:class:`LaunchContext`
+        """
+        data = session.get(LTI_CONTEXT_KEY)
+        if data:
+            return cls.loads(data)
+        return cls.from_params(session)
+
+    def dumps(self):
+        """
+        Context serialized as a JSON list of field values, with 0 for
+        missing values
+
+        :return: JSON string
+        """
+        values = [self.VERSION]
+        values.extend(getattr(self, name) or 0 for name in self.FIELDS)
+        values.append(self.custom or 0)
+        while values[-1] == 0:
+            values.pop()
+        return json.dumps(values, separators=(',', ':'))
+
+    @classmethod
+    def loads(cls, data):
+        """
+        Context from :py:meth:`dumps` output
+
+        :param data: JSON string
+        :return: :py:class:`LaunchContext`
+        :exception: ValueError for data of another version
+        """
+        values = json.loads(data)
+        if not values or values[0] != cls.VERSION:
+            raise ValueError("Unsupported launch context version")
+        context = cls.__new__(cls)
+        values = values[1:]
+        values.extend([0] * (len(cls.__slots__) - len(values)))
+        for name, value in zip(cls.FIELDS, values):
+            setattr(context, name, value or None)
+        context.custom = values[len(cls.FIELDS)] or {}
+        return context
+
+    def get(self, name, default=None):
+        """
+        Field or custom parameter value
+
+        :param name: field name or custom_* parameter name
+        :param default: returned for missing values
+        :return: value
+        """
+        if name in self.FIELDS:
+            value = getattr(self, name)
+        else:
+            value = self.custom.get(name)
+        return default if value is None else value
+
+    def to_dict(self):
+        """
+        Fields and custom parameters with values
+
+        :return: dict
+        """
+        values = dict(self.custom)
+        values.update((name, getattr(self, name)) for name in self.FIELDS
+                      if getattr(self, name) is not None)
+        return values
+
+
+def _launch_signature(payload, secret):
+    """
+    Unpadded urlsafe base64 HMAC-SHA256 of payload
+    """
+    if isinstance(secret, text_type):
+        secret = secret.encode('utf-8')
+    digest = hmac.new(secret, payload, hashlib.sha256).digest()
+    return base64.urlsafe_b64encode(digest).rstrip(b'=')
+
+
+def sign_launch(context, secret, ttl=60):
+    """
+    Launch context as a :py:data:`LAUNCH_HEADER` value, signed with a
+    secret shared with the upstream application and valid for ttl
+    seconds
+
+    :param context: :py:class:`LaunchContext`
+    :param secret: shared secret
+    :param ttl: seconds the value is accepted
+    :return: header value
+    """
+    data = u'{}:{}'.format(int(time.time() + ttl), context.dumps())
+    payload = base64.urlsafe_b64encode(data.encode('utf-8')).rstrip(b'=')
+    return (payload + b'.' + _launch_signature(payload, secret)).decode(
+        'ascii')
+
+
+def verify_launch(value, secret):
+    """
+    Launch context of a :py:data:`LAUNCH_HEADER` value made by
+    :py:func:`sign_launch`
+
+    :param value: header value
+    :param secret: shared secret
+    :return: :py:class:`LaunchContext`
+    :exception: LTIException if the value is malformed, forged or expired
+    """
+    try:
+        payload, signature = value.encode('ascii').split(b'.')
+    except (AttributeError, UnicodeError, ValueError):
+        raise LTIException("Malformed launch header")
+    if not hmac.compare_digest(signature, _launch_signature(payload,
+                                                            secret)):
+        raise LTIException("Invalid launch header signature")
+    try:
+        data = base64.urlsafe_b64decode(
+            payload + b'=' * (-len(payload) % 4)).decode('utf-8')
+        expires, context = data.split(u':', 1)
+        if int(expires) < time.time():
+            raise LTIException("Expired launch header")
+        return LaunchContext.loads(context)
+    except (TypeError, ValueError):
+        raise LTIException("Malformed launch header")
+
+
 class LTIBase(object):
     """
     LTI Object represents abstraction of current LTI session. It provides
@@ -472,7 +1129,34 @@ class LTIBase(object):
     def __init__(self, lti_args, lti_kwargs):
         self.lti_args = lti_args
         self.lti_kwargs = lti_kwargs
-        self.nickname = self.name
+        self._launch = None
+        self._nickname = None
+
+    @property
+    def launch(self):
+        """
+        Launch parameters of the session, decoded on first use
+
+        :return: :py:class:`LaunchContext`
+        """
+        if self._launch is None:
+            self._launch = LaunchContext.from_session(self.session)
+        return self._launch
+
+    @property
+    def nickname(self):
+        """
+        Name to greet the user with, :py:attr:`name` unless set
+
+        :return: nickname
+        """
+        if self._nickname is None:
+            return self.name
+        return self._nickname
+
+    @nickname.setter
+    def nickname(self, value):
+        self._nickname = value
 
     @property
     def name(self):  # pylint: disable=no-self-use
@@ -480,14 +1164,10 @@ class LTIBase(object):
         Name returns user's name or user's email or user_id
         :return: best guess of name to use to greet user
         """
-        if 'lis_person_sourcedid' in self.session:
-            return self.session['lis_person_sourcedid']
-        elif 'lis_person_contact_email_primary' in self.session:
-            return self.session['lis_person_contact_email_primary']
-        elif 'user_id' in self.session:
-            return self.session['user_id']
-        else:
-            return ''
+        launch = self.launch
+        return (launch.lis_person_sourcedid or
+                launch.lis_person_contact_email_primary or
+                launch.user_id or '')
 
     def verify(self):
         """
@@ -514,7 +1194,7 @@ class LTIBase(object):
 
         :return: user_id
         """
-        return self.session['user_id']
+        return self.launch.user_id
 
     @property
     def key(self):  # pylint: disable=no-self-use
@@ -522,7 +1202,7 @@ class LTIBase(object):
         OAuth Consumer Key
         :return: key
         """
-        return self.session['oauth_consumer_key']
+        return self.launch.oauth_consumer_key
 
     @staticmethod
     def message_identifier_id():
@@ -540,7 +1220,7 @@ class LTIBase(object):
 
         :return: LTI lis_result_sourcedid
         """
-        return self.session['lis_result_sourcedid']
+        return self.launch.lis_result_sourcedid
 
     @property
     def role(self):  # pylint: disable=no-self-use
@@ -549,7 +1229,25 @@ class LTIBase(object):
 
         :return: roles
         """
-        return self.session.get('roles')
+        return self.launch.roles
+
+    @property
+    def roles(self):
+        """
+        Normalized LTI role names, see :py:func:`normalize_role`
+
+        :return: frozenset of role names
+        """
+        return LTI_ROLE_TABLE.parse(self.role)[0]
+
+    @property
+    def role_mask(self):
+        """
+        LTI roles as a mask of :py:data:`LTI_ROLE_TABLE`
+
+        :return: mask
+        """
+        return LTI_ROLE_TABLE.parse(self.role)[1]
 
     @staticmethod
     def is_role(self, role):
@@ -561,19 +1259,10 @@ class LTIBase(object):
         :exception: LTIException if role is unknown
         """
         log.debug("is_role %s", role)
-        roles = self.session['roles'].split(',')
-        if role in LTI_ROLES:
-            role_list = LTI_ROLES[role]
-            # find the intersection of the roles
-            roles = set(role_list) & set(roles)
-            is_user_role_there = len(roles) >= 1
-            log.debug(
-                "is_role roles_list=%s role=%s in list=%s", role_list,
-                roles, is_user_role_there
-            )
-            return is_user_role_there
-        else:
-            raise LTIException("Unknown role {}.".format(role))
+        mask = LTI_ROLE_TABLE.group_mask(role)
+        is_user_role_there = bool(self.role_mask & mask)
+        log.debug("is_role role=%s in list=%s", role, is_user_role_there)
+        return is_user_role_there
 
     def _check_role(self):
         """
@@ -590,41 +1279,242 @@ class LTIBase(object):
         if not (role == u'any' or self.is_role(self, role)):
             raise LTIRoleException('Not authorized.')
 
-    def post_grade(self, grade):
+    def _oauth_server(self):  # pylint: disable=no-self-use
+        """
+        OAuth server prepared for the consumers
+
+        :return: :py:class:`LTIOAuthServer` or None to create one per
+            request
+        """
+        return None
+
+    def _store_launch(self, params):
+        """
+        Store verified launch parameters in the session, as one
+        :py:class:`LaunchContext` value with the ``launch_context``
+        wrapper attribute and one session key per parameter otherwise
+
+        :param params: launch parameters
+        """
+        if self.lti_kwargs.get('launch_context'):
+            self._launch = LaunchContext.from_params(
+                params, self.lti_kwargs.get('capture_custom', False))
+            self.session[LTI_CONTEXT_KEY] = self._launch.dumps()
+        else:
+            for prop in LTI_PROPERTY_LIST:
+                if params.get(prop, None):
+                    log.debug("params %s=%s", prop, params.get(prop, None))
+                    self.session[prop] = params[prop]
+            self.session.pop(LTI_CONTEXT_KEY, None)
+            self._launch = None
+        # Set logged in session key
+        self.session[LTI_SESSION_KEY] = True
+
+    def _clear_launch(self):
+        """
+        Remove launch parameters from the session
+        """
+        for prop in LTI_PROPERTY_LIST:
+            if self.session.get(prop, None):
+                del self.session[prop]
+        self.session.pop(LTI_CONTEXT_KEY, None)
+        self.session[LTI_SESSION_KEY] = False
+        self._launch = None
+
+    def _ack_cache(self):
+        """
+        Acknowledged score cache passed as ``ack_cache`` wrapper attribute
+
+        :return: :py:class:`pylti.outcome.AcknowledgedScoreCache` or None
+        """
+        return self.lti_kwargs.get('ack_cache')
+
+    def _defer(self, function):
+        """
+        Run function after the response was sent, for frameworks that
+        support it
+
+        :param function: called without arguments
+        :exception: LTIException if posts can not be deferred
+        """
+        raise LTIException("{} can not defer grade posts".format(
+            type(self).__name__))
+
+    def _transport_pool(self):
+        """
+        Pool from the ``transport_pool`` wrapper attribute, or of the
+        ``prewarm`` connection warmer
+
+        :return: :py:class:`TransportPool` or None
+        """
+        pool = self.lti_kwargs.get('transport_pool')
+        if pool is None and self.lti_kwargs.get('prewarm') is not None:
+            pool = self.lti_kwargs['prewarm'].transport_pool
+        return pool
+
+    def _transport(self):
+        """
+        Transport of the current thread from the transport pool
+
+        :return: :py:class:`Transport` or None to use a new one
+        """
+        pool = self._transport_pool()
+        if pool is None:
+            return None
+        return pool.get(self.key, self._consumers())
+
+    def _prewarm(self):
+        """
+        Warm connection to the outcome service of a verified launch with
+        the ``prewarm`` :py:class:`ConnectionWarmer` wrapper attribute
+        """
+        warmer = self.lti_kwargs.get('prewarm')
+        if warmer is None or not self.launch.lis_outcome_service_url:
+            return
+        try:
+            warmer.warm(self._consumers(), self.key, self.response_url)
+        except Exception:  # pylint: disable=broad-except
+            log.exception("Scheduling connection warming failed")
+
+    def _record_grade_target(self):
+        """
+        Store grade target of a verified launch in the ``grade_targets``
+        :py:class:`pylti.target.GradeTargetIndex` wrapper attribute
+        """
+        index = self.lti_kwargs.get('grade_targets')
+        if index is None or not self.launch.lis_result_sourcedid:
+            return
+        try:
+            index.record_launch(self)
+        except Exception:  # pylint: disable=broad-except
+            log.exception("Recording grade target failed")
+
+    def post_grade(self, grade, deadline=None, budget=None, callback=None,
+                   defer=False):
         """
         Post grade to LTI consumer using XML
 
         :param: grade: 0 <= grade <= 1
-        :return: True if post successful and grade valid
+        :param: deadline: absolute time.time() by which posting,
+            including retries, must end
+        :param: budget: seconds to wait for the consumer; a slower post
+            continues in the background and GRADE_PENDING is returned
+        :param: callback: called with True or False when a pending or
+            deferred post ends
+        :param: defer: post after the response was sent and return
+            GRADE_DEFERRED
+        :return: True if post successful and grade valid,
+            GRADE_SKIPPED if the score was already acknowledged,
+            GRADE_PENDING if the post ran over budget,
+            GRADE_DEFERRED if the post was deferred
         :exception: LTIPostMessageException if call failed
         """
+        # pylint: disable=too-many-arguments
+        # pylint: disable=too-many-locals
         message_identifier_id = self.message_identifier_id()
         operation = 'replaceResult'
         lis_result_sourcedid = self.lis_result_sourcedid
         # # edX devbox fix
         score = float(grade)
         if 0 <= score <= 1.0:
+            ack_cache = self._ack_cache()
+            if ack_cache is not None and ack_cache.is_acknowledged(
+                    self.key, lis_result_sourcedid, score):
+                log.debug("post_grade skipped, %s already acknowledged",
+                          score)
+                return GRADE_SKIPPED
             xml = generate_request_xml(
                 message_identifier_id, operation, lis_result_sourcedid,
                 score)
-            ret = post_message(self._consumers(), self.key,
-                               self.response_url, xml)
-            if not ret:
-                raise LTIPostMessageException("Post Message Failed")
-            return True
+            consumers, lti_key = self._consumers(), self.key
+            url, pool = self.response_url, self._transport_pool()
+
+            def post():
+                """ Send replaceResult and record acknowledgement """
+                ret = post_message(
+                    consumers, lti_key, url, xml,
+                    transport=(pool.get(lti_key, consumers)
+                               if pool is not None else None),
+                    deadline=deadline)
+                if not ret:
+                    if ack_cache is not None:
+                        ack_cache.invalidate(lti_key, lis_result_sourcedid)
+                    raise LTIPostMessageException("Post Message Failed")
+                if ack_cache is not None:
+                    ack_cache.acknowledge(lti_key, lis_result_sourcedid,
+                                          score)
+                return True
+
+            if defer:
+                self._defer(lambda: _run_deferred(post, callback))
+                return GRADE_DEFERRED
+            if budget is None:
+                return post()
+            return BACKGROUND_POSTS.run(post, budget, callback)
 
         return False
 
-    def post_grade2(self, grade, user=None, comment=''):
+    def read_grade(self):
+        """
+        Read grade from LTI consumer using XML
+
+        :return: 0 <= grade <= 1, None if no grade has been set
+        :exception: LTIPostMessageException if call failed
+        """
+        xml = generate_request_xml(
+            self.message_identifier_id(), 'readResult',
+            self.lis_result_sourcedid, None)
+        ret = post_message(self._consumers(), self.key,
+                           self.response_url, xml, want_score=True,
+                           transport=self._transport())
+        if not ret:
+            raise LTIPostMessageException("Post Message Failed")
+        return ret.score
+
+    def delete_grade(self):
+        """
+        Delete grade from LTI consumer using XML
+
+        :return: True if post successful
+        :exception: LTIPostMessageException if call failed
+        """
+        lis_result_sourcedid = self.lis_result_sourcedid
+        xml = generate_request_xml(
+            self.message_identifier_id(), 'deleteResult',
+            lis_result_sourcedid, None)
+        ack_cache = self._ack_cache()
+        if ack_cache is not None:
+            ack_cache.invalidate(self.key, lis_result_sourcedid)
+        ret = post_message(self._consumers(), self.key,
+                           self.response_url, xml,
+                           transport=self._transport())
+        if not ret:
+            raise LTIPostMessageException("Post Message Failed")
+        return True
+
+    def post_grade2(self, grade, user=None, comment='', deadline=None,
+                    budget=None, callback=None, defer=False):
         """
         Post grade to LTI consumer using REST/JSON
         URL munging will is related to:
         https://openedx.atlassian.net/browse/PLAT-281
 
         :param: grade: 0 <= grade <= 1
-        :return: True if post successful and grade valid
+        :param: deadline: absolute time.time() by which posting,
+            including retries, must end
+        :param: budget: seconds to wait for the consumer; a slower post
+            continues in the background and GRADE_PENDING is returned
+        :param: callback: called with True or False when a pending or
+            deferred post ends
+        :param: defer: post after the response was sent and return
+            GRADE_DEFERRED
+        :return: True if post successful and grade valid,
+            GRADE_SKIPPED if the score was already acknowledged,
+            GRADE_PENDING if the post ran over budget,
+            GRADE_DEFERRED if the post was deferred
         :exception: LTIPostMessageException if call failed
         """
+        # pylint: disable=too-many-arguments,too-many-locals
         content_type = 'application/vnd.ims.lis.v2.result+json'
         if user is None:
             user = self.user_id
@@ -633,17 +1523,42 @@ class LTIBase(object):
             "/lti_2_0_result_rest_handler/user/{}".format(user))
         score = float(grade)
         if 0 <= score <= 1.0:
+            ack_cache = self._ack_cache()
+            if ack_cache is not None and ack_cache.is_acknowledged(
+                    self.key, lti2_url, score, comment):
+                log.debug("post_grade2 skipped, %s already acknowledged",
+                          score)
+                return GRADE_SKIPPED
             body = json.dumps({
                 "@context": "http://purl.imsglobal.org/ctx/lis/v2/Result",
                 "@type": "Result",
                 "resultScore": score,
                 "comment": comment
             })
-            ret = post_message2(self._consumers(), self.key, lti2_url, body,
-                                method='PUT',
-                                content_type=content_type)
-            if not ret:
-                raise LTIPostMessageException("Post Message Failed")
-            return True
+            consumers, lti_key = self._consumers(), self.key
+            pool = self._transport_pool()
+
+            def post():
+                """ Send result and record acknowledgement """
+                ret = post_message2(
+                    consumers, lti_key, lti2_url, body, method='PUT',
+                    content_type=content_type,
+                    transport=(pool.get(lti_key, consumers)
+                               if pool is not None else None),
+                    deadline=deadline)
+                if not ret:
+                    if ack_cache is not None:
+                        ack_cache.invalidate(lti_key, lti2_url)
+                    raise LTIPostMessageException("Post Message Failed")
+                if ack_cache is not None:
+                    ack_cache.acknowledge(lti_key, lti2_url, score, comment)
+                return True
+
+            if defer:
+                self._defer(lambda: _run_deferred(post, callback))
+                return GRADE_DEFERRED
+            if budget is None:
+                return post()
+            return BACKGROUND_POSTS.run(post, budget, callback)
 
         return False
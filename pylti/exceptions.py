@@ -0,0 +1,61 @@
+# -*- coding: utf-8 -*-
+"""
+Exceptions of PyLTI module, also available from :py:mod:`pylti.common`
+"""
+
+from __future__ import absolute_import
+
+
+class LTIException(Exception):
+    """
+    Custom LTI exception for proper handling
+    of LTI specific errors
+    """
+    pass
+
+
+class LTINotInSessionException(LTIException):
+    """
+    Custom LTI exception for proper handling
+    of LTI specific errors
+    """
+    pass
+
+
+class LTIRoleException(LTIException):
+    """
+    Exception class for when LTI user doesn't have the
+    right role.
+    """
+    pass
+
+
+class LTIPostMessageException(LTIException):
+    """
+    Exception class for when LTI user doesn't have the
+    right role.
+    """
+    pass
+
+
+class LTICircuitOpenException(LTIPostMessageException):
+    """
+    Exception class for when outcome service host is failing and
+    requests to it are refused without being sent.
+    """
+    pass
+
+
+class LTITransportException(LTIPostMessageException):
+    """
+    Exception class for when an outcome request could not be sent or
+    its response could not be received.
+    """
+    pass
+
+
+class LTITimeoutException(LTITransportException):
+    """
+    Exception class for when an outcome request timed out.
+    """
+    pass
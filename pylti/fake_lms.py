@@ -0,0 +1,383 @@
+# -*- coding: utf-8 -*-
+"""
+    In-process fake LMS serving the LTI outcome services, for tests,
+    load tests and benchmarks of grade passback without network
+"""
+from __future__ import absolute_import
+import base64
+import json
+import logging
+import random
+import re
+import ssl
+import threading
+import time
+from hashlib import sha1
+from xml.etree import ElementTree as etree
+from xml.sax.saxutils import escape as xml_escape
+
+import oauth2
+from six.moves import BaseHTTPServer, socketserver
+
+from .common import (
+    LTIOAuthServer,
+    Request_Fix_Duplicate,
+    SignatureMethod_HMAC_SHA1_Unicode,
+)
+
+log = logging.getLogger('pylti.fake_lms')  # pylint: disable=invalid-name
+
+_NAMESPACE = '{http://www.imsglobal.org/services/ltiv1p1/xsd/imsoms_v1p0}'
+_LTI2_PATH = re.compile(r'/lti_2_0_result_rest_handler/user/([^/]+)$')
+
+_RESPONSE_XML_TEMPLATE = (
+    u'<?xml version="1.0" encoding="UTF-8"?>\n'
+    u'<imsx_POXEnvelopeResponse xmlns="http://www.imsglobal.org/services/'
+    u'ltiv1p1/xsd/imsoms_v1p0"><imsx_POXHeader><imsx_POXResponseHeaderInfo>'
+    u'<imsx_version>V1.0</imsx_version>'
+    u'<imsx_messageIdentifier>{identifier}</imsx_messageIdentifier>'
+    u'<imsx_statusInfo><imsx_codeMajor>{code_major}</imsx_codeMajor>'
+    u'<imsx_severity>status</imsx_severity>'
+    u'<imsx_description>{description}</imsx_description>'
+    u'<imsx_messageRefIdentifier>{ref}</imsx_messageRefIdentifier>'
+    u'<imsx_operationRefIdentifier>{operation}</imsx_operationRefIdentifier>'
+    u'</imsx_statusInfo></imsx_POXResponseHeaderInfo></imsx_POXHeader>'
+    u'<imsx_POXBody>{body}</imsx_POXBody></imsx_POXEnvelopeResponse>'
+)
+
+
+class _ThreadingHTTPServer(socketserver.ThreadingMixIn,
+                           BaseHTTPServer.HTTPServer):
+    """
+    HTTP server handling every connection in its own thread
+    """
+    daemon_threads = True
+    allow_reuse_address = True
+    request_queue_size = 128
+    lms = None
+
+
+class _OutcomeHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    """
+    Request handler delegating to :py:class:`FakeLMS`
+    """
+    protocol_version = 'HTTP/1.1'
+    # Headers and body are written separately, avoid delayed ACK stalls
+    # on kept alive connections
+    disable_nagle_algorithm = True
+
+    def setup(self):
+        if isinstance(self.request, ssl.SSLSocket):
+            self.request.do_handshake()
+        BaseHTTPServer.BaseHTTPRequestHandler.setup(self)
+        self.server.lms.connected(self.request)
+
+    def do_POST(self):  # pylint: disable=invalid-name
+        """ LTI 1.1 outcome service """
+        self.server.lms.handle(self)
+
+    def do_PUT(self):  # pylint: disable=invalid-name
+        """ LTI 2.0 Result service """
+        self.server.lms.handle(self)
+
+    def do_GET(self):  # pylint: disable=invalid-name
+        """ LTI 2.0 Result service """
+        self.server.lms.handle(self)
+
+    def log_message(self, format, *args):
+        # pylint: disable=redefined-builtin
+        log.debug(format, *args)
+
+
+class FakeLMS(object):
+    """
+    Threaded HTTP server implementing replaceResult, readResult and
+    deleteResult of the LTI 1.1 outcome service at ``/grade_handler``
+    and the LTI 2.0 Result service at
+    ``/lti_2_0_result_rest_handler/user/<user>``.
+
+    Every new connection waits ``connect_latency`` seconds, standing in
+    for DNS and TLS setup, and every request waits ``latency`` seconds
+    and fails with ``failure_status`` with probability ``failure_rate``,
+    which lets grade passback be load tested and benchmarked on one
+    machine::
+
+        with FakeLMS(consumers, latency=(0.01, 0.05)) as lms:
+            post_message(consumers, key, lms.outcome_url, xml)
+            assert lms.grades[sourcedid] == 0.5
+    """
+    # pylint: disable=too-many-instance-attributes
+
+    def __init__(self, consumers=None, host='127.0.0.1', port=0,
+                 latency=0, failure_rate=0.0, failure_status=500,
+                 seed=None, connect_latency=0, ssl_context=None):
+        """
+        :param consumers: consumers from config, OAuth signatures and
+            body hashes are verified when given
+        :param host: interface to listen on
+        :param port: port to listen on, 0 picks a free port
+        :param latency: seconds added to every response, or (min, max)
+            range of uniformly distributed latencies
+        :param failure_rate: probability of failing a request
+        :param failure_status: HTTP status of failed requests
+        :param seed: seed of latency and failure randomness
+        :param connect_latency: seconds added to the first response of
+            every connection
+        :param ssl_context: server SSL context to serve HTTPS
+        """
+        # pylint: disable=too-many-arguments
+        self.consumers = consumers
+        self.latency = latency
+        self.failure_rate = failure_rate
+        self.failure_status = failure_status
+        self.connect_latency = connect_latency
+        self.grades = {}
+        self.results = {}
+        self.request_count = 0
+        self.connection_count = 0
+        self.resumed_count = 0
+        self.failure_count = 0
+        self.in_flight = 0
+        self.max_in_flight = 0
+        self._random = random.Random(seed)
+        self._lock = threading.Lock()
+        self._server = _ThreadingHTTPServer((host, port), _OutcomeHandler)
+        self._server.lms = self
+        self.scheme = 'http'
+        if ssl_context is not None:
+            # Handshakes happen in the connection threads
+            self._server.socket = ssl_context.wrap_socket(
+                self._server.socket, server_side=True,
+                do_handshake_on_connect=False)
+            self.scheme = 'https'
+        self._thread = None
+
+    @property
+    def url(self):
+        """
+        Base url of the server
+        """
+        host, port = self._server.server_address[:2]
+        return '{}://{}:{}'.format(self.scheme, host, port)
+
+    @property
+    def outcome_url(self):
+        """
+        LTI 1.1 outcome service url, used as lis_outcome_service_url
+        """
+        return self.url + '/grade_handler'
+
+    def start(self):
+        """
+        Serve requests in a background thread
+
+        :return: self
+        """
+        self._thread = threading.Thread(target=self._server.serve_forever,
+                                        name='pylti-fake-lms')
+        self._thread.daemon = True
+        self._thread.start()
+        return self
+
+    def stop(self):
+        """
+        Stop serving and close the listening socket
+        """
+        if self._thread is not None:
+            self._server.shutdown()
+            self._thread.join()
+            self._thread = None
+        self._server.server_close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.stop()
+
+    def connected(self, sock):
+        """
+        Account for a new connection
+
+        :param sock: connection socket
+        """
+        with self._lock:
+            self.connection_count += 1
+            if getattr(sock, 'session_reused', False):
+                self.resumed_count += 1
+        if self.connect_latency:
+            time.sleep(self.connect_latency)
+
+    def handle(self, handler):
+        """
+        Answer request of handler
+
+        :param handler: BaseHTTPRequestHandler of the request
+        """
+        length = int(handler.headers.get('Content-Length') or 0)
+        body = handler.rfile.read(length) if length else b''
+        with self._lock:
+            self.request_count += 1
+            self.in_flight += 1
+            self.max_in_flight = max(self.max_in_flight, self.in_flight)
+            delay = self._delay()
+            failed = self._random.random() < self.failure_rate
+        try:
+            if delay:
+                time.sleep(delay)
+            if failed:
+                with self._lock:
+                    self.failure_count += 1
+                status, content_type, content = (
+                    self.failure_status, 'text/plain', b'failure')
+            elif not self._verify(handler, body):
+                status, content_type, content = (
+                    401, 'text/plain', b'invalid signature')
+            else:
+                status, content_type, content = self._respond(handler, body)
+        finally:
+            with self._lock:
+                self.in_flight -= 1
+        handler.send_response(status)
+        handler.send_header('Content-Type', content_type)
+        handler.send_header('Content-Length', str(len(content)))
+        handler.end_headers()
+        handler.wfile.write(content)
+
+    def _delay(self):
+        """
+        Latency of the next response, called with the lock held
+        """
+        if isinstance(self.latency, (tuple, list)):
+            return self._random.uniform(*self.latency)
+        return self.latency
+
+    def _verify(self, handler, body):
+        """
+        Check OAuth signature and body hash of request
+        """
+        if not self.consumers:
+            return True
+        path, _, query = handler.path.partition('?')
+        headers = dict((name.title(), value)
+                       for name, value in handler.headers.items())
+        url = '{}://{}{}'.format(self.scheme, headers.get('Host'), path)
+        try:
+            oauth_request = Request_Fix_Duplicate.from_request(
+                handler.command, url, headers=headers, query_string=query)
+            if oauth_request is None:
+                return False
+            server = LTIOAuthServer(self.consumers)
+            server.add_signature_method(SignatureMethod_HMAC_SHA1_Unicode())
+            consumer = server.lookup_consumer(
+                oauth_request.get('oauth_consumer_key'))
+            if consumer is None:
+                return False
+            server.verify_request(oauth_request, consumer, None)
+        except (oauth2.Error, KeyError, ValueError) as err:
+            log.info("Rejected outcome request: %s", err)
+            return False
+        body_hash = base64.b64encode(sha1(body).digest()).decode('ascii')
+        return oauth_request.get('oauth_body_hash') == body_hash
+
+    def _respond(self, handler, body):
+        """
+        Process verified request
+
+        :return: (status, content type, content)
+        """
+        match = _LTI2_PATH.search(handler.path.partition('?')[0])
+        if match:
+            return self._respond_lti2(handler.command, match.group(1), body)
+        if handler.command != 'POST':
+            return 405, 'text/plain', b'method not allowed'
+        return 200, 'application/xml', self._respond_pox(body)
+
+    def _respond_lti2(self, method, user, body):
+        """
+        LTI 2.0 Result service
+        """
+        content_type = 'application/vnd.ims.lis.v2.result+json'
+        if method == 'GET':
+            with self._lock:
+                result = self.results.get(user)
+            if result is None:
+                result = {"@context":
+                          "http://purl.imsglobal.org/ctx/lis/v2/Result",
+                          "@type": "Result"}
+            return 200, content_type, json.dumps(result).encode('utf-8')
+        try:
+            result = json.loads(body.decode('utf-8'))
+            score = result.get('resultScore')
+            if score is not None and not 0 <= float(score) <= 1:
+                raise ValueError("score out of range")
+        except (ValueError, TypeError, AttributeError):
+            return 400, 'text/plain', b'invalid result'
+        with self._lock:
+            self.results[user] = result
+        return 200, content_type, b''
+
+    def _respond_pox(self, body):
+        """
+        LTI 1.1 POX outcome service
+        """
+        try:
+            root = etree.fromstring(body)
+            identifier = root.findtext(
+                '{0}imsx_POXHeader/{0}imsx_POXRequestHeaderInfo/'
+                '{0}imsx_messageIdentifier'.format(_NAMESPACE)) or ''
+            request = list(root.find('{}imsx_POXBody'.format(_NAMESPACE)))[0]
+        except (etree.ParseError, TypeError, IndexError):
+            return self._pox_response('', 'failure', 'Invalid request', '',
+                                      '')
+        operation = request.tag.replace(_NAMESPACE, '')
+        sourcedid = request.findtext(
+            '{0}resultRecord/{0}sourcedGUID/{0}sourcedId'.format(_NAMESPACE))
+        operation_name = operation.replace('Request', '')
+        response_body = u''
+        code_major, description = 'success', 'ok'
+
+        if operation == 'replaceResultRequest':
+            text = request.findtext(
+                '{0}resultRecord/{0}result/{0}resultScore/'
+                '{0}textString'.format(_NAMESPACE))
+            try:
+                score = float(text)
+                if not 0 <= score <= 1:
+                    raise ValueError("score out of range")
+            except (TypeError, ValueError):
+                code_major, description = 'failure', 'Invalid score'
+            else:
+                with self._lock:
+                    self.grades[sourcedid] = score
+        elif operation == 'readResultRequest':
+            with self._lock:
+                score = self.grades.get(sourcedid)
+            response_body = (
+                u'<result><resultScore><language>en</language>'
+                u'<textString>{}</textString></resultScore></result>'.format(
+                    u'' if score is None else score))
+        elif operation == 'deleteResultRequest':
+            with self._lock:
+                self.grades.pop(sourcedid, None)
+        else:
+            code_major, description = 'unsupported', 'Unsupported operation'
+            operation_name = None
+
+        if operation_name:
+            response_body = u'<{0}Response>{1}</{0}Response>'.format(
+                operation_name, response_body)
+        return self._pox_response(identifier, code_major, description,
+                                  operation_name or '', response_body)
+
+    def _pox_response(self, ref, code_major, description, operation, body):
+        """
+        Serialized POX response envelope
+        """
+        # pylint: disable=too-many-arguments
+        with self._lock:
+            identifier = self.request_count
+        return _RESPONSE_XML_TEMPLATE.format(
+            identifier=identifier, code_major=code_major,
+            description=description, ref=xml_escape(ref),
+            operation=operation, body=body).encode('utf-8')
@@ -6,22 +6,68 @@ from __future__ import absolute_import
 from functools import wraps
 import logging
 
-from flask import session, current_app, Flask
+from flask import session, current_app, Flask, g, after_this_request
+from flask import has_app_context
 from flask import request as flask_request
+from flask.sessions import (
+    SecureCookieSession,
+    SessionInterface,
+    session_json_serializer,
+)
 
 from .common import (
+    LTI_REQUEST_TYPE,
+    LTI_CONTEXT_KEY,
+    LTI_ROLE_TABLE,
     LTI_SESSION_KEY,
     LTI_PROPERTY_LIST,
+    URL_REWRITERS,
+    UrlRewriter,
+    create_oauth_server,
     verify_request_common,
     default_error,
     LTIException,
     LTINotInSessionException,
+    LTIRoleException,
     LTIBase
 )
+from .session import new_session_id
+from .wsgi import LAUNCH_ENVIRON_KEY
 
 
 log = logging.getLogger('pylti.flask')  # pylint: disable=invalid-name
 
+# flask.g attributes memoizing request parameters and verification outcome
+_PARAMS_KEY = '_pylti_params'
+_VERIFIED_KEY = '_pylti_verified'
+
+
+def _request_memo(key):
+    """
+    Value memoized on flask.g for the current request.  flask.g lives as
+    long as the app context, which can outlast a request, so values are
+    stored with the request they belong to.
+
+    :param key: flask.g attribute
+    :return: value or None
+    """
+    memo = getattr(g, key, None)
+    # pylint: disable=protected-access
+    if memo is None or memo[0] is not flask_request._get_current_object():
+        return None
+    return memo[1]
+
+
+def _memoize_request(key, value):
+    """
+    Memoize value on flask.g for the current request
+
+    :param key: flask.g attribute
+    :param value: value
+    """
+    # pylint: disable=protected-access
+    setattr(g, key, (flask_request._get_current_object(), value))
+
 
 class LTI(LTIBase):
     """
@@ -50,40 +96,63 @@ class LTI(LTIBase):
         consumers = config.get('consumers', dict())
         return consumers
 
+    @staticmethod
+    def _request_params():
+        """
+        LTI parameters of the current request, parsed once per request
+
+        :return: dict of form parameters for POST, query otherwise
+        """
+        params = _request_memo(_PARAMS_KEY)
+        if params is None:
+            if flask_request.method == 'POST':
+                params = flask_request.form.to_dict()
+            else:
+                params = flask_request.args.to_dict()
+            _memoize_request(_PARAMS_KEY, params)
+        return params
+
     def verify_request(self):
         """
-        Verify LTI request
+        Verify LTI request, once per request for all LTI wrappers the
+        request passes
+
         :raises: LTIException is request validation failed
         """
-        if flask_request.method == 'POST':
-            params = flask_request.form.to_dict()
-        else:
-            params = flask_request.args.to_dict()
+        verified = _request_memo(_VERIFIED_KEY)
+        if verified is not None:
+            log.debug('verify_request already done')
+            if verified is not True:
+                raise verified
+            return True
+        params = self._request_params()
         log.debug(params)
         log.debug('verify_request?')
+        launch = flask_request.environ.get(LAUNCH_ENVIRON_KEY)
         try:
-            verify_request_common(self._consumers(), flask_request.url,
-                                  flask_request.method, flask_request.headers,
-                                  params)
+            if launch is None:
+                verify_request_common(
+                    self._consumers(), flask_request.url,
+                    flask_request.method, flask_request.headers, params,
+                    oauth_server=self._oauth_server())
+            else:
+                # Verified by LTIMiddleware before routing
+                params = launch.to_dict()
             log.debug('verify_request success')
 
             # All good to go, store all of the LTI params into a
             # session dict for use in views
-            for prop in LTI_PROPERTY_LIST:
-                if params.get(prop, None):
-                    log.debug("params %s=%s", prop, params.get(prop, None))
-                    session[prop] = params[prop]
-
-            # Set logged in session key
-            session[LTI_SESSION_KEY] = True
+            self._store_launch(params)
+            if isinstance(session, ServerSideSession):
+                session.regenerate()
+            self._prewarm()
+            self._record_grade_target()
+            _memoize_request(_VERIFIED_KEY, True)
             return True
-        except LTIException:
+        except LTIException as lti_exception:
             log.debug('verify_request failed')
-            for prop in LTI_PROPERTY_LIST:
-                if session.get(prop, None):
-                    del session[prop]
-
-            session[LTI_SESSION_KEY] = False
+            self._clear_launch()
+            _memoize_request(_VERIFIED_KEY, lti_exception)
             raise
 
     @property
@@ -94,17 +163,24 @@ class LTI(LTIBase):
 
         :return: remapped lis_outcome_service_url
         """
-        url = ""
-        url = self.session['lis_outcome_service_url']
         app_config = self.lti_kwargs['app'].config
-        urls = app_config.get('PYLTI_URL_FIX', dict())
         # url remapping is useful for using devstack
         # devstack reports httpS://localhost:8000/ and listens on HTTP
-        for prefix, mapping in urls.items():
-            if url.startswith(prefix):
-                for _from, _to in mapping.items():
-                    url = url.replace(_from, _to)
-        return url
+        return URL_REWRITERS.get(app_config.get('PYLTI_URL_FIX')).rewrite(
+            self.launch.lis_outcome_service_url)
+
+    def _defer(self, function):
+        """
+        Run function when the WSGI server closes the response, after it
+        was sent
+
+        :param function: called without arguments
+        """
+        @after_this_request
+        def call_on_close(response):  # pylint: disable=unused-variable
+            """ Register function with the response """
+            response.call_on_close(function)
+            return response
 
     def _verify_any(self):
         """
@@ -117,15 +193,14 @@ class LTI(LTIBase):
         # Check to see if there is a new LTI launch request incoming
         newrequest = False
         if flask_request.method == 'POST':
-            params = flask_request.form.to_dict()
+            params = self._request_params()
             initiation = "basic-lti-launch-request"
             if params.get("lti_message_type", None) == initiation:
                 newrequest = True
-                # Scrub the session of the old authentication
-                for prop in LTI_PROPERTY_LIST:
-                    if session.get(prop, None):
-                        del session[prop]
-                session[LTI_SESSION_KEY] = False
+                # Scrub the session of the old authentication, unless
+                # an outer LTI wrapper already verified this launch
+                if _request_memo(_VERIFIED_KEY) is None:
+                    self._clear_launch()
 
         # Attempt the appropriate validation
         # Both of these methods raise LTIException as necessary
@@ -153,6 +228,7 @@ class LTI(LTIBase):
         for prop in LTI_PROPERTY_LIST:
             if session.get(prop, None):
                 del session[prop]
+        session.pop(LTI_CONTEXT_KEY, None)
         session[LTI_SESSION_KEY] = False
 
 
@@ -211,3 +287,246 @@ def lti(app=None, request='any', error=default_error, role='any',
         # We are wrapping without arguments
         lti_kwargs['app'] = None
         return _lti(app)
+
+
+class _AppConfig(object):
+    """
+    LTI configuration of one Flask app, compiled by
+    :py:meth:`PyLTI.init_app`
+    """
+    # pylint: disable=too-few-public-methods
+
+    def __init__(self, app):
+        config = app.config.get('PYLTI_CONFIG', dict())
+        self.app = app
+        self.consumers = dict(config.get('consumers', dict()))
+        self.oauth_server = create_oauth_server(self.consumers)
+        self.url_rewriter = UrlRewriter(app.config.get('PYLTI_URL_FIX'))
+
+
+class _CompiledLTI(LTI):
+    """
+    :py:class:`LTI` of a :py:class:`PyLTI` route, reading the compiled
+    app configuration instead of app.config.
+    """
+
+    def __init__(self, app_config, lti_kwargs):
+        # pylint: disable=super-init-not-called
+        self.session = session
+        self.app_config = app_config
+        LTIBase.__init__(self, (), lti_kwargs)
+
+    def _consumers(self):
+        """
+        Consumers compiled from PYLTI_CONFIG
+
+        :return: consumers map
+        """
+        return self.app_config.consumers
+
+    def _oauth_server(self):
+        """
+        OAuth server of the compiled consumers
+
+        :return: :py:class:`pylti.common.LTIOAuthServer`
+        """
+        return self.app_config.oauth_server
+
+    @property
+    def response_url(self):
+        """
+        Returns lis_outcome_service_url remapped by compiled PYLTI_URL_FIX
+
+        :return: remapped lis_outcome_service_url
+        """
+        return self.app_config.url_rewriter.rewrite(
+            self.launch.lis_outcome_service_url)
+
+
+# Verification method name of every request type
+_VERIFIERS = {
+    u'any': '_verify_any',
+    u'initial': 'verify_request',
+    u'session': '_verify_session',
+}
+
+
+class PyLTI(object):
+    """
+    Flask extension compiling consumers and PYLTI_URL_FIX once per app
+    and request type and role checks once per route.
+
+    Usage::
+
+        pylti = PyLTI(app)
+
+        @app.route("/launch", methods=['POST'])
+        @pylti.lti(request='initial', error=error, role='staff')
+        def launch(lti):
+            return "Launched"
+
+    With an application factory, create ``PyLTI()`` and call
+    :py:meth:`init_app` for every app.  Call :py:meth:`init_app` again
+    after changing PYLTI_CONFIG or PYLTI_URL_FIX.
+    """
+
+    def __init__(self, app=None):
+        """
+        :param: app: Flask app (optional)
+        """
+        self.app = app
+        self._app_config = None
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        """
+        Compile LTI configuration of app
+
+        :param: app: Flask app
+        """
+        app_config = _AppConfig(app)
+        app.extensions['pylti'] = app_config
+        if app is self.app:
+            self._app_config = app_config
+
+    def lti(self, request='any', error=default_error, role='any',
+            **lti_kwargs):
+        """
+        LTI decorator, see :py:func:`lti` for arguments
+
+        :return: wrapper
+        :exception: LTIException for unknown request type or role
+        """
+        if request not in LTI_REQUEST_TYPE:
+            raise LTIException("Unknown request type")
+        verify = _VERIFIERS[request]
+        if role != u'any':
+            LTI_ROLE_TABLE.group_mask(role)
+        lti_kwargs.update(request=request, error=error, role=role, app=None)
+
+        def _lti(function):
+            """
+            Inner LTI decorator
+
+            :param: function:
+            :return:
+            """
+
+            @wraps(function)
+            def wrapper(*args, **kwargs):
+                """
+                Pass LTI reference to function or return error.
+                """
+                if has_app_context():
+                    app_config = current_app.extensions['pylti']
+                else:
+                    app_config = self._app_config
+                try:
+                    the_lti = _CompiledLTI(app_config, lti_kwargs)
+                    getattr(the_lti, verify)()
+                    if role != u'any' and not the_lti.is_role(the_lti, role):
+                        raise LTIRoleException('Not authorized.')
+                    kwargs['lti'] = the_lti
+                    return function(*args, **kwargs)
+                except LTIException as lti_exception:
+                    exception = dict()
+                    exception['exception'] = lti_exception
+                    exception['kwargs'] = kwargs
+                    exception['args'] = args
+                    return error(exception=exception)
+
+            return wrapper
+
+        return _lti
+
+
+class ServerSideSession(SecureCookieSession):
+    """
+    Flask session kept in a server-side store under an opaque id
+    """
+    # pylint: disable=too-many-ancestors
+
+    def __init__(self, initial=None, sid=None):
+        SecureCookieSession.__init__(self, initial)
+        self.sid = sid or new_session_id()
+        self.previous_sid = None
+
+    def regenerate(self):
+        """
+        Move session to a new id, so that an id known before a launch
+        cannot be used to access it
+        """
+        if self.previous_sid is None:
+            self.previous_sid = self.sid
+        self.sid = new_session_id()
+        self.modified = True
+
+
+class LTISessionInterface(SessionInterface):
+    """
+    Flask session interface keeping sessions, including the launch
+    parameters stored by PyLTI, in a server-side store.  The session
+    cookie only holds a random opaque id.
+
+    Usage::
+
+        from pylti.session import SQLiteSessionStore
+
+        app.session_interface = LTISessionInterface(
+            SQLiteSessionStore('/var/lib/myapp/sessions.db'))
+    """
+    serializer = session_json_serializer
+    session_class = ServerSideSession
+
+    def __init__(self, store):
+        """
+        :param: store: :py:class:`pylti.session.MemorySessionStore` or
+            :py:class:`pylti.session.SQLiteSessionStore`
+        """
+        self.store = store
+
+    def open_session(self, app, request):
+        """
+        Load session named by the session cookie
+
+        :return: :py:class:`ServerSideSession`
+        """
+        sid = request.cookies.get(app.config['SESSION_COOKIE_NAME'])
+        if sid:
+            data = self.store.load(sid)
+            if data is not None:
+                try:
+                    return self.session_class(self.serializer.loads(data),
+                                              sid=sid)
+                except ValueError:
+                    log.warning("discarding undecodable session")
+        return self.session_class()
+
+    def save_session(self, app, session, response):
+        # pylint: disable=redefined-outer-name
+        """
+        Store modified session and set its cookie
+        """
+        name = app.config['SESSION_COOKIE_NAME']
+        domain = self.get_cookie_domain(app)
+        path = self.get_cookie_path(app)
+        if session.previous_sid is not None:
+            self.store.delete(session.previous_sid)
+        if not session:
+            if session.modified:
+                self.store.delete(session.sid)
+                response.delete_cookie(name, domain=domain, path=path)
+            return
+        refresh = (session.permanent and
+                   app.config.get('SESSION_REFRESH_EACH_REQUEST', True))
+        if not (session.modified or refresh):
+            return
+        self.store.save(session.sid, self.serializer.dumps(dict(session)))
+        cookie_kwargs = dict(
+            expires=self.get_expiration_time(app, session),
+            httponly=self.get_cookie_httponly(app),
+            domain=domain, path=path, secure=self.get_cookie_secure(app))
+        if app.config.get('SESSION_COOKIE_SAMESITE'):
+            cookie_kwargs['samesite'] = app.config['SESSION_COOKIE_SAMESITE']
+        response.set_cookie(name, session.sid, **cookie_kwargs)
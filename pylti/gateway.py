@@ -0,0 +1,319 @@
+# -*- coding: utf-8 -*-
+"""
+    PyLTI gateway verifying launches in front of upstream applications
+
+The gateway is a threaded reverse proxy.  Launch POSTs are verified by
+:py:class:`pylti.wsgi.LTIMiddleware` with a shared nonce store, and
+forwarded with the launch context signed into the
+:py:data:`pylti.common.LAUNCH_HEADER` request header.  Upstream
+applications read it with :py:func:`pylti.common.verify_launch` and
+need no consumer secrets.  Only POSTs to the configured launch paths are
+verified; other requests, including large form posts, are proxied
+untouched.  It needs urllib3, installed with ``pip install PyLTI[gateway]``.
+Run it with a JSON config file::
+
+    python -m pylti.gateway gateway.json
+"""
+from __future__ import absolute_import
+
+import argparse
+import json
+import logging
+import threading
+from wsgiref.simple_server import WSGIRequestHandler, WSGIServer, make_server
+from wsgiref.util import request_uri
+
+import urllib3
+from six.moves import socketserver
+from six.moves.urllib.parse import urlparse
+from urllib3.exceptions import HTTPError
+
+from .common import LAUNCH_HEADER, LTIException, sign_launch
+from .session import MemoryNonceStore, SQLiteNonceStore
+from .wsgi import (
+    LAUNCH_ENVIRON_KEY,
+    MAX_LAUNCH_SIZE,
+    LTIMiddleware,
+    _respond,
+)
+
+log = logging.getLogger('pylti.gateway')  # pylint: disable=invalid-name
+
+# Connection specific headers, not passed through the gateway
+HOP_BY_HOP = frozenset((
+    'connection', 'keep-alive', 'proxy-authenticate', 'proxy-authorization',
+    'te', 'trailer', 'trailers', 'transfer-encoding', 'upgrade',
+))
+
+# Title cased like headers taken from the environ
+_LAUNCH_HEADER_NAME = LAUNCH_HEADER.title()
+
+
+def _request_headers(environ):
+    """
+    Request headers of environ, without connection specific headers and
+    launch headers sent by the client
+
+    :return: list of (name, value)
+    """
+    headers = []
+    for name, value in environ.items():
+        if name.startswith('HTTP_'):
+            name = name[5:].replace('_', '-').title()
+        elif name in ('CONTENT_TYPE', 'CONTENT_LENGTH') and value:
+            name = name.replace('_', '-').title()
+        else:
+            continue
+        if name.lower() not in HOP_BY_HOP and name != _LAUNCH_HEADER_NAME:
+            headers.append((name, value))
+    return headers
+
+
+class UpstreamProxy(object):
+    """
+    WSGI application forwarding requests to the upstream of the longest
+    matching path prefix over kept-alive pooled connections.  The
+    launch context of launches verified by
+    :py:class:`pylti.wsgi.LTIMiddleware` is signed into the
+    :py:data:`pylti.common.LAUNCH_HEADER` request header; the header is
+    never passed on from clients.
+    """
+    # pylint: disable=too-few-public-methods
+
+    def __init__(self, upstreams, secret, ttl=60, timeout=30, maxsize=10):
+        """
+        :param upstreams: map of path prefix to upstream base url
+        :param secret: secret shared with the upstreams, signing the
+            launch header
+        :param ttl: seconds upstreams accept the launch header
+        :param timeout: seconds to wait for an upstream
+        :param maxsize: connections kept per upstream
+        """
+        # pylint: disable=too-many-arguments
+        self.upstreams = sorted(upstreams.items(),
+                                key=lambda item: len(item[0]), reverse=True)
+        self.secret = secret
+        self.ttl = ttl
+        self.pool = urllib3.PoolManager(
+            maxsize=maxsize, block=False, retries=False,
+            timeout=urllib3.Timeout(total=timeout))
+
+    def upstream(self, path):
+        """
+        Upstream base url of request path
+
+        :param path: request path
+        :return: base url or None
+        """
+        for prefix, url in self.upstreams:
+            if path.startswith(prefix):
+                return url.rstrip('/')
+        return None
+
+    def __call__(self, environ, start_response):
+        uri = urlparse(request_uri(environ))
+        base = self.upstream(uri.path)
+        if base is None:
+            return _respond(start_response, '404 Not Found',
+                            u'No upstream for this path')
+        path = uri.path + (u'?' + uri.query if uri.query else u'')
+
+        headers = _request_headers(environ)
+        headers.append(('X-Forwarded-For', environ.get('REMOTE_ADDR', '')))
+        headers.append(('X-Forwarded-Proto', environ['wsgi.url_scheme']))
+        launch = environ.get(LAUNCH_ENVIRON_KEY)
+        if launch is not None:
+            headers.append((LAUNCH_HEADER,
+                            sign_launch(launch, self.secret, self.ttl)))
+        length = int(environ.get('CONTENT_LENGTH') or 0)
+        body = environ['wsgi.input'].read(length) if length else None
+
+        try:
+            response = self.pool.urlopen(
+                environ['REQUEST_METHOD'], base + path, body=body,
+                headers=dict(headers), redirect=False,
+                preload_content=False, decode_content=False)
+        except HTTPError as error:
+            log.warning("upstream %s failed: %s", base, error)
+            return _respond(start_response, '502 Bad Gateway',
+                            u'Upstream is not available')
+        start_response(
+            '{} {}'.format(response.status, response.reason),
+            [(name, value) for name, value in response.headers.items()
+             if name.lower() not in HOP_BY_HOP])
+        return _UpstreamBody(response)
+
+
+class _UpstreamBody(object):
+    """
+    Response body streamed from upstream, returning the connection to
+    its pool when closed
+    """
+
+    def __init__(self, response):
+        self.response = response
+
+    def __iter__(self):
+        return self.response.stream(64 * 1024, decode_content=False)
+
+    def close(self):
+        """
+        Release the upstream connection
+        """
+        self.response.release_conn()
+
+
+def create_gateway(consumers, upstreams, secret, paths, nonce_store=None,
+                   **proxy_kwargs):
+    """
+    Gateway WSGI application
+
+    :param consumers: consumers from config
+    :param upstreams: map of path prefix to upstream base url
+    :param secret: secret shared with the upstreams
+    :param paths: launch paths, the only requests verified and limited
+        to :py:data:`pylti.wsgi.MAX_LAUNCH_SIZE`
+    :param nonce_store: store of seen nonces, a
+        :py:class:`pylti.session.MemoryNonceStore` when not given
+    :param proxy_kwargs: arguments of :py:class:`UpstreamProxy`
+    :return: WSGI application
+    """
+    # pylint: disable=too-many-arguments
+    if nonce_store is None:
+        nonce_store = MemoryNonceStore()
+    return LTIMiddleware(UpstreamProxy(upstreams, secret, **proxy_kwargs),
+                         consumers, paths=paths, max_size=MAX_LAUNCH_SIZE,
+                         capture_custom=True, nonce_store=nonce_store)
+
+
+class _ThreadingWSGIServer(socketserver.ThreadingMixIn, WSGIServer):
+    """
+    WSGI server handling every connection in its own thread
+    """
+    daemon_threads = True
+    allow_reuse_address = True
+    request_queue_size = 128
+
+
+class _QuietHandler(WSGIRequestHandler):
+    """
+    Request handler logging through the pylti.gateway logger
+    """
+
+    def log_message(self, format, *args):
+        # pylint: disable=redefined-builtin
+        log.debug(format, *args)
+
+
+class Gateway(object):
+    """
+    Threaded HTTP server of a gateway application, serving in a
+    background thread when used as a context manager
+    """
+
+    def __init__(self, app, host='127.0.0.1', port=0):
+        """
+        :param app: gateway from :py:func:`create_gateway`
+        :param host: address to listen on
+        :param port: port to listen on, 0 picks a free port
+        """
+        self._server = make_server(host, port, app,
+                                   server_class=_ThreadingWSGIServer,
+                                   handler_class=_QuietHandler)
+        self._thread = None
+
+    @property
+    def url(self):
+        """
+        Base url of the gateway
+        """
+        host, port = self._server.server_address[:2]
+        return 'http://{}:{}'.format(host, port)
+
+    def serve_forever(self):
+        """
+        Serve requests until interrupted
+        """
+        try:
+            self._server.serve_forever()
+        finally:
+            self._server.server_close()
+
+    def start(self):
+        """
+        Serve requests in a background thread
+
+        :return: self
+        """
+        self._thread = threading.Thread(target=self._server.serve_forever,
+                                        name='pylti-gateway')
+        self._thread.daemon = True
+        self._thread.start()
+        return self
+
+    def stop(self):
+        """
+        Stop serving and close the listening socket
+        """
+        if self._thread is not None:
+            self._server.shutdown()
+            self._thread.join()
+            self._thread = None
+        self._server.server_close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.stop()
+
+
+def load_config(path):
+    """
+    Gateway application of a JSON config file with ``consumers``,
+    ``upstreams``, ``secret`` and launch ``paths``, and optionally
+    ``nonce_db`` (SQLite path shared by gateway processes), ``ttl`` and
+    ``timeout``
+
+    :param path: config file path
+    :return: WSGI application
+    :exception: LTIException for incomplete configs
+    """
+    with open(path) as config_file:
+        config = json.load(config_file)
+    missing = [key for key in ('consumers', 'upstreams', 'secret', 'paths')
+               if not config.get(key)]
+    if missing:
+        raise LTIException("Gateway config misses {}".format(
+            ', '.join(missing)))
+    nonce_store = None
+    if config.get('nonce_db'):
+        nonce_store = SQLiteNonceStore(config['nonce_db'])
+    proxy_kwargs = dict((key, config[key]) for key in ('ttl', 'timeout')
+                        if key in config)
+    return create_gateway(config['consumers'], config['upstreams'],
+                          config['secret'], config['paths'],
+                          nonce_store=nonce_store, **proxy_kwargs)
+
+
+def main(argv=None):
+    """
+    Run gateway of a config file
+    """
+    parser = argparse.ArgumentParser(
+        description='Verify LTI launches in front of upstream applications')
+    parser.add_argument('config', help='JSON config file')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8000)
+    args = parser.parse_args(argv)
+    logging.basicConfig(level=logging.INFO)
+    gateway = Gateway(load_config(args.config), args.host, args.port)
+    log.info("gateway listening on %s", gateway.url)
+    try:
+        gateway.serve_forever()
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == '__main__':
+    main()
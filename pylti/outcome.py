@@ -0,0 +1,460 @@
+# -*- coding: utf-8 -*-
+"""
+Outcome service helpers for PyLTI module
+"""
+
+from __future__ import absolute_import
+
+import atexit
+import logging
+import threading
+import time
+from collections import OrderedDict
+from multiprocessing.pool import ThreadPool
+
+from .common import (
+    LTIBase,
+    OutcomeResponse,
+    generate_request_xml,
+    post_message,
+)
+from .transport import TransportPool
+
+log = logging.getLogger('pylti.outcome')  # pylint: disable=invalid-name
+
+
+class AcknowledgedScoreCache(object):
+    """
+    Bounded cache of the last score (and comment) acknowledged by the LTI
+    consumer for every target, kept separately for each consumer key.
+
+    A target is the ``lis_result_sourcedid`` for LTI 1.1 posts and the
+    result URL for LTI 2.0 posts.  Pass the cache to the ``lti`` wrapper
+    as ``ack_cache`` and ``post_grade``/``post_grade2`` skip posts that
+    would resend an acknowledged score within ``ttl`` seconds.
+    """
+
+    def __init__(self, maxsize=10000, ttl=3600):
+        """
+        :param: maxsize: most entries remembered per consumer key
+        :param: ttl: seconds an acknowledgement stays valid
+        """
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._consumers = {}
+        self._lock = threading.Lock()
+
+    def is_acknowledged(self, lti_key, target, score, comment=None):
+        """
+        Check if the consumer already acknowledged this exact score
+
+        :param: lti_key: consumer key
+        :param: target: lis_result_sourcedid or result URL
+        :param: score: score about to be posted
+        :param: comment: comment about to be posted
+        :return: True if the post can be skipped
+        """
+        with self._lock:
+            entries = self._consumers.get(lti_key)
+            entry = entries.get(target) if entries else None
+            if entry is not None and entry[2] < time.time():
+                del entries[target]
+                entry = None
+            if entry is not None and entry[:2] == (score, comment):
+                entries[target] = entries.pop(target)
+                self.hits += 1
+                return True
+            self.misses += 1
+            return False
+
+    def acknowledge(self, lti_key, target, score, comment=None):
+        """
+        Remember score acknowledged by the consumer
+
+        :param: lti_key: consumer key
+        :param: target: lis_result_sourcedid or result URL
+        :param: score: acknowledged score
+        :param: comment: acknowledged comment
+        """
+        with self._lock:
+            entries = self._consumers.setdefault(lti_key, OrderedDict())
+            entries.pop(target, None)
+            entries[target] = (score, comment, time.time() + self.ttl)
+            while len(entries) > self.maxsize:
+                entries.popitem(last=False)
+
+    def invalidate(self, lti_key, target):
+        """
+        Forget acknowledged score, e.g. after a failed post
+
+        :param: lti_key: consumer key
+        :param: target: lis_result_sourcedid or result URL
+        """
+        with self._lock:
+            entries = self._consumers.get(lti_key)
+            if entries:
+                entries.pop(target, None)
+
+    def clear(self):
+        """
+        Forget all acknowledged scores
+        """
+        with self._lock:
+            self._consumers.clear()
+
+    def __len__(self):
+        with self._lock:
+            return sum(len(entries) for entries in self._consumers.values())
+
+
+class _PendingGrade(object):
+    """
+    Latest score waiting to be posted for one
+    (consumer key, lis_result_sourcedid) pair.
+    """
+    # pylint: disable=too-few-public-methods, too-many-arguments
+
+    def __init__(self, consumers, lti_key, url, lis_result_sourcedid,
+                 score, due, deadline):
+        self.consumers = consumers
+        self.lti_key = lti_key
+        self.url = url
+        self.lis_result_sourcedid = lis_result_sourcedid
+        self.score = score
+        self.due = due
+        self.deadline = deadline
+
+
+class GradeCoalescer(object):
+    """
+    Collapses grade updates keyed by (consumer key, lis_result_sourcedid)
+    so that only the most recent score is posted to the LTI consumer.
+
+    Every submission (re)starts a debounce window of ``delay`` seconds for
+    its key; the pending score is posted once the window passes without a
+    newer submission, or at the latest ``max_delay`` seconds after the
+    first pending submission.  Pending grades are flushed when the
+    coalescer is closed, which by default also happens at interpreter
+    exit.
+    """
+
+    def __init__(self, delay=1.0, max_delay=10.0, callback=None,
+                 flush_at_exit=True, ack_cache=None):
+        """
+        :param: delay: debounce window in seconds
+        :param: max_delay: longest time a score may stay pending
+        :param: callback: called as ``callback(lti_key,
+            lis_result_sourcedid, score, success)`` after every post
+        :param: flush_at_exit: flush pending grades at interpreter exit
+        :param: ack_cache: optional :py:class:`AcknowledgedScoreCache`
+            used to skip scores the consumer already acknowledged
+        """
+        # pylint: disable=too-many-arguments
+        self.delay = delay
+        self.max_delay = max(delay, max_delay)
+        self.callback = callback
+        self.ack_cache = ack_cache
+        self._pending = {}
+        self._condition = threading.Condition()
+        self._thread = None
+        self._closed = False
+        if flush_at_exit:
+            atexit.register(self.close)
+
+    @property
+    def pending(self):
+        """
+        Number of grades waiting to be posted
+
+        :return: count of pending (consumer key, sourcedid) pairs
+        """
+        with self._condition:
+            return len(self._pending)
+
+    def submit(self, consumers, lti_key, url, lis_result_sourcedid, grade):
+        """
+        Queue grade for posting, replacing any pending grade for the
+        same consumer key and lis_result_sourcedid.
+
+        :param: consumers: consumers from config
+        :param: lti_key: key to find appropriate consumer
+        :param: url: outcome service url
+        :param: lis_result_sourcedid: LTI lis_result_sourcedid
+        :param: grade: 0 <= grade <= 1
+        :return: True if grade was queued, False if grade is invalid
+        """
+        # pylint: disable=too-many-arguments
+        score = float(grade)
+        if not 0 <= score <= 1.0:
+            return False
+
+        key = (lti_key, lis_result_sourcedid)
+        with self._condition:
+            if self._closed:
+                pending = None
+            else:
+                now = time.time()
+                previous = self._pending.get(key)
+                deadline = (previous.deadline if previous
+                            else now + self.max_delay)
+                pending = _PendingGrade(
+                    consumers, lti_key, url, lis_result_sourcedid, score,
+                    min(now + self.delay, deadline), deadline)
+                self._pending[key] = pending
+                if previous:
+                    log.debug("coalesced grade for %s", key)
+                self._start_worker()
+                self._condition.notify()
+
+        if pending is None:
+            # Nothing will flush after close, so post right away
+            log.debug("coalescer closed, posting grade for %s", key)
+            self._post(_PendingGrade(consumers, lti_key, url,
+                                     lis_result_sourcedid, score, 0, 0))
+        return True
+
+    def submit_grade(self, lti, grade):
+        """
+        Queue grade for the user of the current LTI session.  Everything
+        needed for posting is captured from the session immediately.
+
+        :param: lti: :py:class:`pylti.common.LTIBase` instance
+        :param: grade: 0 <= grade <= 1
+        :return: True if grade was queued, False if grade is invalid
+        """
+        # pylint: disable=protected-access
+        return self.submit(lti._consumers(), lti.key, lti.response_url,
+                           lti.lis_result_sourcedid, grade)
+
+    def flush(self):
+        """
+        Post all pending grades immediately in the calling thread.
+        """
+        with self._condition:
+            pending = list(self._pending.values())
+            self._pending.clear()
+        for grade in pending:
+            self._post(grade)
+
+    def close(self):
+        """
+        Stop the background worker and flush pending grades.
+        """
+        with self._condition:
+            self._closed = True
+            self._condition.notify()
+            thread = self._thread
+        if thread is not None and thread is not threading.current_thread():
+            thread.join()
+        self.flush()
+
+    def _start_worker(self):
+        """
+        Start background worker thread if it is not running.
+        Must be called with the condition held.
+        """
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._run,
+                                            name='pylti-grade-coalescer')
+            self._thread.daemon = True
+            self._thread.start()
+
+    def _run(self):
+        """
+        Background loop posting grades whose debounce window passed.
+        """
+        while True:
+            with self._condition:
+                due = self._take_due()
+                while not due and not self._closed:
+                    self._condition.wait(self._next_wait())
+                    due = self._take_due()
+                if not due and self._closed:
+                    self._thread = None
+                    return
+            for grade in due:
+                self._post(grade)
+
+    def _take_due(self):
+        """
+        Remove and return pending grades that are due.
+        Must be called with the condition held.
+        """
+        now = time.time()
+        due = [grade for grade in self._pending.values() if grade.due <= now]
+        for grade in due:
+            del self._pending[(grade.lti_key, grade.lis_result_sourcedid)]
+        return due
+
+    def _next_wait(self):
+        """
+        Seconds until the earliest pending grade is due, or None.
+        Must be called with the condition held.
+        """
+        if not self._pending:
+            return None
+        earliest = min(grade.due for grade in self._pending.values())
+        return max(earliest - time.time(), 0)
+
+    def _post(self, grade):
+        """
+        Post a single grade and report the outcome to the callback.
+        """
+        ack_cache = self.ack_cache
+        if ack_cache is not None and ack_cache.is_acknowledged(
+                grade.lti_key, grade.lis_result_sourcedid, grade.score):
+            log.debug("coalesced grade for %s already acknowledged",
+                      grade.lis_result_sourcedid)
+            self._report(grade, True)
+            return
+        xml = generate_request_xml(LTIBase.message_identifier_id(),
+                                   'replaceResult',
+                                   grade.lis_result_sourcedid, grade.score)
+        try:
+            success = bool(post_message(grade.consumers, grade.lti_key,
+                                        grade.url, xml))
+        except Exception:  # pylint: disable=broad-except
+            log.exception("Posting coalesced grade failed")
+            success = False
+        if ack_cache is not None:
+            if success:
+                ack_cache.acknowledge(grade.lti_key,
+                                      grade.lis_result_sourcedid, grade.score)
+            else:
+                ack_cache.invalidate(grade.lti_key,
+                                     grade.lis_result_sourcedid)
+        if not success:
+            log.warning("Coalesced grade for %s was not accepted",
+                        grade.lis_result_sourcedid)
+        self._report(grade, success)
+
+    def _report(self, grade, success):
+        """
+        Pass the outcome of a grade post to the callback, logging its
+        failure so that the background worker keeps running.
+        """
+        if self.callback is None:
+            return
+        try:
+            self.callback(grade.lti_key, grade.lis_result_sourcedid,
+                          grade.score, success)
+        except Exception:  # pylint: disable=broad-except
+            log.exception("Coalesced grade callback failed")
+
+
+class ResultsReader(object):
+    """
+    Reads grades back from LTI consumers with the readResult operation.
+
+    Results are fetched by a pool of worker threads; each worker keeps
+    one transport per consumer key so that connections to the outcome
+    service are reused.  Successfully read results are cached for ``ttl``
+    seconds.
+    """
+
+    def __init__(self, consumers, workers=8, ttl=300, maxsize=100000,
+                 transport_factory=None):
+        """
+        :param: consumers: consumers from config
+        :param: workers: number of concurrent requests
+        :param: ttl: seconds a read result stays cached
+        :param: maxsize: most results kept in cache
+        :param: transport_factory: factory of outcome transports, see
+            :py:func:`pylti.transport.create_transport`
+        """
+        # pylint: disable=too-many-arguments
+        self.consumers = consumers
+        self.workers = workers
+        self.ttl = ttl
+        self.maxsize = maxsize
+        self._cache = OrderedDict()
+        self._lock = threading.Lock()
+        self._transports = TransportPool(consumers, transport_factory)
+        self._pool = None
+
+    def read_result(self, lti_key, url, lis_result_sourcedid):
+        """
+        Read result of one lis_result_sourcedid, using the cache
+
+        :param: lti_key: consumer key
+        :param: url: outcome service url
+        :param: lis_result_sourcedid: LTI lis_result_sourcedid
+        :return: :py:class:`pylti.common.OutcomeResponse`, with the
+            grade in ``score`` when successful
+        """
+        key = (lti_key, lis_result_sourcedid)
+        with self._lock:
+            cached = self._cache.get(key)
+            if cached is not None:
+                if cached[1] >= time.time():
+                    return cached[0]
+                del self._cache[key]
+
+        response = self._fetch(lti_key, url, lis_result_sourcedid)
+        if response:
+            with self._lock:
+                self._cache.pop(key, None)
+                self._cache[key] = (response, time.time() + self.ttl)
+                while len(self._cache) > self.maxsize:
+                    self._cache.popitem(last=False)
+        return response
+
+    def read_results(self, lti_key, url, lis_result_sourcedids):
+        """
+        Read results of many lis_result_sourcedids concurrently
+
+        :param: lti_key: consumer key
+        :param: url: outcome service url
+        :param: lis_result_sourcedids: iterable of lis_result_sourcedid
+        :return: dict mapping lis_result_sourcedid to
+            :py:class:`pylti.common.OutcomeResponse`
+        """
+        sourcedids = list(lis_result_sourcedids)
+        with self._lock:
+            if self._pool is None:
+                self._pool = ThreadPool(self.workers)
+            pool = self._pool
+        responses = pool.map(
+            lambda sourcedid: self.read_result(lti_key, url, sourcedid),
+            sourcedids)
+        return dict(zip(sourcedids, responses))
+
+    def invalidate(self, lti_key, lis_result_sourcedid):
+        """
+        Drop cached result, e.g. after posting a new grade
+
+        :param: lti_key: consumer key
+        :param: lis_result_sourcedid: LTI lis_result_sourcedid
+        """
+        with self._lock:
+            self._cache.pop((lti_key, lis_result_sourcedid), None)
+
+    def close(self):
+        """
+        Stop worker threads and close their connections.
+        """
+        with self._lock:
+            pool, self._pool = self._pool, None
+        if pool is not None:
+            pool.close()
+            pool.join()
+        self._transports.close()
+
+    def _fetch(self, lti_key, url, lis_result_sourcedid):
+        """
+        Send readResult request
+
+        :return: :py:class:`pylti.common.OutcomeResponse`
+        """
+        xml = generate_request_xml(LTIBase.message_identifier_id(),
+                                   'readResult', lis_result_sourcedid, None)
+        try:
+            return post_message(self.consumers, lti_key, url, xml,
+                                want_score=True,
+                                transport=self._transports.get(lti_key))
+        except Exception as err:  # pylint: disable=broad-except
+            log.exception("Reading result of %s failed",
+                          lis_result_sourcedid)
+            return OutcomeResponse(error=str(err))
@@ -0,0 +1,283 @@
+# -*- coding: utf-8 -*-
+"""
+Server-side session and nonce stores for PyLTI module
+"""
+
+from __future__ import absolute_import
+
+import binascii
+import logging
+import os
+import threading
+import time
+from collections import OrderedDict
+
+from .sqlite import SQLiteStore
+
+log = logging.getLogger('pylti.session')  # pylint: disable=invalid-name
+
+
+def new_session_id():
+    """
+    Random opaque session id
+
+    :return: 32 hex digits
+    """
+    return binascii.hexlify(os.urandom(16)).decode('ascii')
+
+
+class MemorySessionStore(object):
+    """
+    Bounded in-process store of serialized sessions.  The least recently
+    used sessions are dropped beyond ``maxsize``.  Sessions are not
+    shared between worker processes; use :py:class:`SQLiteSessionStore`
+    for those.
+    """
+
+    def __init__(self, maxsize=10000, ttl=3600):
+        """
+        :param: maxsize: most sessions kept
+        :param: ttl: seconds a session stays valid after it was saved
+        """
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._sessions = OrderedDict()
+        self._lock = threading.Lock()
+
+    def load(self, session_id):
+        """
+        Serialized session
+
+        :param: session_id: opaque session id
+        :return: session data or None if unknown or expired
+        """
+        with self._lock:
+            entry = self._sessions.get(session_id)
+            if entry is None:
+                return None
+            if entry[1] < time.time():
+                del self._sessions[session_id]
+                return None
+            self._sessions[session_id] = self._sessions.pop(session_id)
+            return entry[0]
+
+    def save(self, session_id, data):
+        """
+        Store serialized session
+
+        :param: session_id: opaque session id
+        :param: data: session data string
+        """
+        with self._lock:
+            self._sessions.pop(session_id, None)
+            self._sessions[session_id] = (data, time.time() + self.ttl)
+            while len(self._sessions) > self.maxsize:
+                self._sessions.popitem(last=False)
+
+    def delete(self, session_id):
+        """
+        Forget session
+
+        :param: session_id: opaque session id
+        """
+        with self._lock:
+            self._sessions.pop(session_id, None)
+
+    def __len__(self):
+        with self._lock:
+            return len(self._sessions)
+
+
+class SQLiteSessionStore(SQLiteStore):
+    """
+    SQLite store of serialized sessions.  Use a file path to share
+    sessions between worker processes of one host.  Expired sessions
+    are removed by :py:meth:`purge`, which runs about every
+    ``purge_interval`` saves.
+    """
+    SCHEMA = (
+        'CREATE TABLE IF NOT EXISTS pylti_session ('
+        'session_id TEXT PRIMARY KEY, data TEXT NOT NULL, '
+        'expires_at REAL NOT NULL)',
+    )
+    TABLE = 'pylti_session'
+
+    def __init__(self, path=':memory:', ttl=3600, purge_interval=1000):
+        """
+        :param: path: SQLite database path
+        :param: ttl: seconds a session stays valid after it was saved
+        :param: purge_interval: saves between removals of expired sessions
+        """
+        SQLiteStore.__init__(self, path)
+        self.ttl = ttl
+        self.purge_interval = purge_interval
+        self._saves = 0
+
+    def load(self, session_id):
+        """
+        Serialized session
+
+        :param: session_id: opaque session id
+        :return: session data or None if unknown or expired
+        """
+        with self._lock:
+            row = self._connection.execute(
+                'SELECT data FROM pylti_session WHERE session_id = ? '
+                'AND expires_at >= ?', (session_id, time.time())).fetchone()
+        return row[0] if row else None
+
+    def save(self, session_id, data):
+        """
+        Store serialized session
+
+        :param: session_id: opaque session id
+        :param: data: session data string
+        """
+        with self._lock:
+            with self._connection:
+                self._connection.execute(
+                    'INSERT OR REPLACE INTO pylti_session '
+                    '(session_id, data, expires_at) VALUES (?, ?, ?)',
+                    (session_id, data, time.time() + self.ttl))
+            self._saves += 1
+            purge = self._saves % self.purge_interval == 0
+        if purge:
+            self.purge()
+
+    def delete(self, session_id):
+        """
+        Forget session
+
+        :param: session_id: opaque session id
+        """
+        with self._lock, self._connection:
+            self._connection.execute(
+                'DELETE FROM pylti_session WHERE session_id = ?',
+                (session_id,))
+
+    def purge(self):
+        """
+        Remove expired sessions
+
+        :return: number of sessions removed
+        """
+        with self._lock, self._connection:
+            removed = self._connection.execute(
+                'DELETE FROM pylti_session WHERE expires_at < ?',
+                (time.time(),)).rowcount
+        log.debug("purged %s expired sessions", removed)
+        return removed
+
+
+class MemoryNonceStore(object):
+    """
+    In-process store of OAuth nonces seen within ``ttl`` seconds, which
+    should exceed the timestamp window of the OAuth server (300
+    seconds).  Pass it as ``nonce_store`` to reject replayed launches;
+    use :py:class:`SQLiteNonceStore` to share nonces between worker
+    processes.
+    """
+
+    def __init__(self, ttl=600, maxsize=100000):
+        """
+        :param: ttl: seconds a nonce is remembered
+        :param: maxsize: most nonces kept, the oldest are dropped first
+        """
+        self.ttl = ttl
+        self.maxsize = maxsize
+        self._nonces = OrderedDict()
+        self._lock = threading.Lock()
+
+    def add(self, lti_key, nonce):
+        """
+        Remember nonce of consumer
+
+        :param: lti_key: consumer key
+        :param: nonce: oauth_nonce of the request
+        :return: True if the nonce was not seen within ttl
+        """
+        if not nonce:
+            return False
+        now = time.time()
+        with self._lock:
+            # Entries share one ttl, so the oldest expire first
+            while self._nonces and next(iter(self._nonces.values())) < now:
+                self._nonces.popitem(last=False)
+            if self._nonces.get((lti_key, nonce), now) > now:
+                return False
+            self._nonces.pop((lti_key, nonce), None)
+            self._nonces[(lti_key, nonce)] = now + self.ttl
+            if len(self._nonces) > self.maxsize:
+                log.warning("nonce store full, dropping the oldest nonce")
+                self._nonces.popitem(last=False)
+            return True
+
+    def __len__(self):
+        with self._lock:
+            return len(self._nonces)
+
+
+class SQLiteNonceStore(SQLiteStore):
+    """
+    SQLite store of OAuth nonces seen within ``ttl`` seconds.  Use a
+    file path to share nonces between worker processes of one host.
+    Expired nonces are removed by :py:meth:`purge`, which runs about
+    every ``purge_interval`` additions.
+    """
+    SCHEMA = (
+        'CREATE TABLE IF NOT EXISTS pylti_nonce ('
+        'lti_key TEXT NOT NULL, nonce TEXT NOT NULL, '
+        'expires_at REAL NOT NULL, PRIMARY KEY (lti_key, nonce))',
+    )
+    TABLE = 'pylti_nonce'
+
+    def __init__(self, path=':memory:', ttl=600, purge_interval=1000):
+        """
+        :param: path: SQLite database path
+        :param: ttl: seconds a nonce is remembered
+        :param: purge_interval: additions between removals of expired
+            nonces
+        """
+        SQLiteStore.__init__(self, path)
+        self.ttl = ttl
+        self.purge_interval = purge_interval
+        self._adds = 0
+
+    def add(self, lti_key, nonce):
+        """
+        Remember nonce of consumer
+
+        :param: lti_key: consumer key
+        :param: nonce: oauth_nonce of the request
+        :return: True if the nonce was not seen within ttl
+        """
+        if not nonce:
+            return False
+        now = time.time()
+        with self._lock:
+            with self._connection:
+                self._connection.execute(
+                    'DELETE FROM pylti_nonce WHERE lti_key = ? AND nonce = ? '
+                    'AND expires_at < ?', (lti_key, nonce, now))
+                added = self._connection.execute(
+                    'INSERT OR IGNORE INTO pylti_nonce '
+                    '(lti_key, nonce, expires_at) VALUES (?, ?, ?)',
+                    (lti_key, nonce, now + self.ttl)).rowcount == 1
+            self._adds += 1
+            purge = self._adds % self.purge_interval == 0
+        if purge:
+            self.purge()
+        return added
+
+    def purge(self):
+        """
+        Remove expired nonces
+
+        :return: number of nonces removed
+        """
+        with self._lock, self._connection:
+            removed = self._connection.execute(
+                'DELETE FROM pylti_nonce WHERE expires_at < ?',
+                (time.time(),)).rowcount
+        log.debug("purged %s expired nonces", removed)
+        return removed
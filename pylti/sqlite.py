@@ -0,0 +1,44 @@
+# -*- coding: utf-8 -*-
+"""
+SQLite storage shared by the PyLTI ledgers, indexes and stores
+"""
+
+from __future__ import absolute_import
+
+import sqlite3
+import threading
+
+
+class SQLiteStore(object):
+    """
+    Base of the SQLite backed classes.  One connection serves all
+    threads, guarded by ``_lock``; the tables of ``SCHEMA`` are created
+    when missing.  Use a file path to share the data between processes.
+    """
+    # CREATE TABLE IF NOT EXISTS statements of the store
+    SCHEMA = ()
+    # Table whose rows are counted by len()
+    TABLE = None
+
+    def __init__(self, path=':memory:'):
+        """
+        :param: path: SQLite database path
+        """
+        self.path = path
+        self._lock = threading.Lock()
+        self._connection = sqlite3.connect(path, check_same_thread=False)
+        with self._connection:
+            for statement in self.SCHEMA:
+                self._connection.execute(statement)
+
+    def __len__(self):
+        with self._lock:
+            return self._connection.execute(
+                'SELECT COUNT(*) FROM {}'.format(self.TABLE)).fetchone()[0]
+
+    def close(self):
+        """
+        Close database connection
+        """
+        with self._lock:
+            self._connection.close()
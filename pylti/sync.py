@@ -0,0 +1,332 @@
+# -*- coding: utf-8 -*-
+"""
+Incremental gradebook synchronization for PyLTI module
+"""
+
+from __future__ import absolute_import
+
+import logging
+import threading
+import time
+from itertools import islice
+from multiprocessing.pool import ThreadPool
+
+from .common import (
+    LTIBase,
+    generate_request_xml,
+    post_message,
+)
+from .sqlite import SQLiteStore
+from .transport import TransportPool
+
+log = logging.getLogger('pylti.sync')  # pylint: disable=invalid-name
+
+
+class GradeLedger(SQLiteStore):
+    """
+    SQLite ledger of scores acknowledged by LTI consumers, also holding
+    checkpoints of interrupted synchronizations.  Use a file path to keep
+    the ledger between runs.
+    """
+    SCHEMA = (
+        'CREATE TABLE IF NOT EXISTS pylti_grade_ledger ('
+        'lti_key TEXT NOT NULL, lis_result_sourcedid TEXT NOT NULL, '
+        'score REAL NOT NULL, acknowledged_at REAL NOT NULL, '
+        'PRIMARY KEY (lti_key, lis_result_sourcedid))',
+        'CREATE TABLE IF NOT EXISTS pylti_sync_checkpoint ('
+        'name TEXT PRIMARY KEY, position INTEGER NOT NULL)',
+    )
+    TABLE = 'pylti_grade_ledger'
+
+    def get_many(self, lti_key, lis_result_sourcedids):
+        """
+        Acknowledged scores of several sourcedids
+
+        :param: lti_key: consumer key
+        :param: lis_result_sourcedids: list of lis_result_sourcedid
+        :return: dict mapping lis_result_sourcedid to score, sourcedids
+            without acknowledged score are left out
+        """
+        scores = {}
+        # Stay below SQLite's default limit of 999 host parameters
+        for start in range(0, len(lis_result_sourcedids), 900):
+            chunk = lis_result_sourcedids[start:start + 900]
+            with self._lock:
+                rows = self._connection.execute(
+                    'SELECT lis_result_sourcedid, score '
+                    'FROM pylti_grade_ledger WHERE lti_key = ? AND '
+                    'lis_result_sourcedid IN ({})'.format(
+                        ','.join('?' * len(chunk))),
+                    [lti_key] + list(chunk)).fetchall()
+            scores.update(rows)
+        return scores
+
+    def get(self, lti_key, lis_result_sourcedid):
+        """
+        Acknowledged score of sourcedid
+
+        :param: lti_key: consumer key
+        :param: lis_result_sourcedid: LTI lis_result_sourcedid
+        :return: score or None
+        """
+        return self.get_many(lti_key, [lis_result_sourcedid]).get(
+            lis_result_sourcedid)
+
+    def record_many(self, lti_key, scores):
+        """
+        Record scores acknowledged by the consumer
+
+        :param: lti_key: consumer key
+        :param: scores: iterable of (lis_result_sourcedid, score)
+        """
+        now = time.time()
+        with self._lock, self._connection:
+            self._connection.executemany(
+                'INSERT OR REPLACE INTO pylti_grade_ledger '
+                '(lti_key, lis_result_sourcedid, score, acknowledged_at) '
+                'VALUES (?, ?, ?, ?)',
+                [(lti_key, sourcedid, score, now)
+                 for sourcedid, score in scores])
+
+    def record(self, lti_key, lis_result_sourcedid, score):
+        """
+        Record score acknowledged by the consumer
+
+        :param: lti_key: consumer key
+        :param: lis_result_sourcedid: LTI lis_result_sourcedid
+        :param: score: acknowledged score
+        """
+        self.record_many(lti_key, [(lis_result_sourcedid, score)])
+
+    def get_checkpoint(self, name):
+        """
+        Position reached by an interrupted synchronization
+
+        :param: name: synchronization name
+        :return: number of snapshot entries already processed
+        """
+        with self._lock:
+            row = self._connection.execute(
+                'SELECT position FROM pylti_sync_checkpoint WHERE name = ?',
+                (name,)).fetchone()
+        return row[0] if row else 0
+
+    def set_checkpoint(self, name, position):
+        """
+        Store position reached by a synchronization
+
+        :param: name: synchronization name
+        :param: position: number of snapshot entries processed
+        """
+        with self._lock, self._connection:
+            self._connection.execute(
+                'INSERT OR REPLACE INTO pylti_sync_checkpoint '
+                '(name, position) VALUES (?, ?)', (name, position))
+
+    def clear_checkpoint(self, name):
+        """
+        Forget checkpoint of a finished synchronization
+
+        :param: name: synchronization name
+        """
+        with self._lock, self._connection:
+            self._connection.execute(
+                'DELETE FROM pylti_sync_checkpoint WHERE name = ?', (name,))
+
+
+class SyncResult(object):
+    """
+    Outcome of a gradebook synchronization
+    """
+    # pylint: disable=too-few-public-methods
+
+    def __init__(self):
+        self.checked = 0
+        self.unchanged = 0
+        self.posted = 0
+        self.failed = []
+        self.resumed_at = 0
+
+    def __repr__(self):
+        return ('SyncResult(checked={}, unchanged={}, posted={}, '
+                'failed={})').format(self.checked, self.unchanged,
+                                     self.posted, len(self.failed))
+
+
+class GradebookSync(object):
+    """
+    Pushes a local snapshot of scores to an LTI consumer, posting only
+    the scores that differ from the last known consumer state.
+
+    The known state comes from a :py:class:`GradeLedger` of acknowledged
+    posts, or, if no ledger is given, from the consumer itself through a
+    :py:class:`pylti.outcome.ResultsReader`.  The snapshot is processed in
+    batches; changed scores of a batch are posted concurrently with one
+    reused connection per worker, and a named synchronization stores its
+    position in the ledger after every batch so an interrupted run
+    resumes where it stopped.
+    """
+    # pylint: disable=too-many-instance-attributes
+
+    def __init__(self, consumers, ledger=None, reader=None, workers=8,
+                 batch_size=500, tolerance=1e-6, transport_factory=None):
+        """
+        :param: consumers: consumers from config
+        :param: ledger: :py:class:`GradeLedger` of acknowledged scores
+        :param: reader: :py:class:`pylti.outcome.ResultsReader` used
+            when no ledger is given
+        :param: workers: number of concurrent posts
+        :param: batch_size: snapshot entries compared at a time
+        :param: tolerance: score differences ignored as unchanged
+        :param: transport_factory: factory of outcome transports, see
+            :py:func:`pylti.transport.create_transport`
+        """
+        # pylint: disable=too-many-arguments
+        if ledger is None and reader is None:
+            raise ValueError("GradebookSync needs a ledger or a reader")
+        self.consumers = consumers
+        self.ledger = ledger
+        self.reader = reader
+        self.workers = workers
+        self.batch_size = batch_size
+        self.tolerance = tolerance
+        self._transports = TransportPool(consumers, transport_factory)
+        self._lock = threading.Lock()
+        self._pool = None
+
+    def known_scores(self, lti_key, url, lis_result_sourcedids):
+        """
+        Last known consumer scores
+
+        :param: lti_key: consumer key
+        :param: url: outcome service url
+        :param: lis_result_sourcedids: list of lis_result_sourcedid
+        :return: dict mapping lis_result_sourcedid to score
+        """
+        if self.ledger is not None:
+            return self.ledger.get_many(lti_key, lis_result_sourcedids)
+        results = self.reader.read_results(lti_key, url,
+                                           lis_result_sourcedids)
+        return dict((sourcedid, result.score)
+                    for sourcedid, result in results.items()
+                    if result and result.score is not None)
+
+    def diff(self, lti_key, url, scores):
+        """
+        Scores that differ from the last known consumer state
+
+        :param: lti_key: consumer key
+        :param: url: outcome service url
+        :param: scores: list of (lis_result_sourcedid, score)
+        :return: list of changed (lis_result_sourcedid, score)
+        """
+        known = self.known_scores(lti_key, url,
+                                  [sourcedid for sourcedid, _ in scores])
+        changed = []
+        for sourcedid, score in scores:
+            previous = known.get(sourcedid)
+            if (previous is None or
+                    abs(previous - float(score)) > self.tolerance):
+                changed.append((sourcedid, float(score)))
+        return changed
+
+    def sync(self, lti_key, url, scores, name=None):
+        """
+        Post changed scores of the snapshot
+
+        :param: lti_key: consumer key
+        :param: url: outcome service url
+        :param: scores: dict or ordered iterable of
+            (lis_result_sourcedid, score); keep the order stable between
+            runs when resuming from a checkpoint
+        :param: name: name of a resumable synchronization, requires ledger
+        :return: :py:class:`SyncResult`
+        """
+        if name is not None and self.ledger is None:
+            raise ValueError("Resumable synchronization needs a ledger")
+        if isinstance(scores, dict):
+            scores = sorted(scores.items())
+
+        result = SyncResult()
+        position = 0
+        entries = iter(scores)
+        if name is not None:
+            position = result.resumed_at = self.ledger.get_checkpoint(name)
+            if position:
+                log.info("Resuming sync %s at %d", name, position)
+                entries = islice(entries, position, None)
+
+        while True:
+            batch = list(islice(entries, self.batch_size))
+            if not batch:
+                break
+            changed = self.diff(lti_key, url, batch)
+            result.checked += len(batch)
+            result.unchanged += len(batch) - len(changed)
+            self._post_batch(lti_key, url, changed, result)
+            position += len(batch)
+            if name is not None:
+                self.ledger.set_checkpoint(name, position)
+
+        if name is not None:
+            self.ledger.clear_checkpoint(name)
+        log.info("Sync finished %s", result)
+        return result
+
+    def close(self):
+        """
+        Stop worker threads and close their connections.
+        """
+        with self._lock:
+            pool, self._pool = self._pool, None
+        if pool is not None:
+            pool.close()
+            pool.join()
+        self._transports.close()
+
+    def _post_batch(self, lti_key, url, changed, result):
+        """
+        Post changed scores concurrently and record acknowledged ones
+        """
+        if not changed:
+            return
+        with self._lock:
+            if self._pool is None:
+                self._pool = ThreadPool(self.workers)
+            pool = self._pool
+        successes = pool.map(
+            lambda entry: self._post(lti_key, url, entry[0], entry[1]),
+            changed)
+        acknowledged = []
+        for entry, success in zip(changed, successes):
+            if success:
+                acknowledged.append(entry)
+            else:
+                result.failed.append(entry[0])
+        result.posted += len(acknowledged)
+        if self.ledger is not None and acknowledged:
+            self.ledger.record_many(lti_key, acknowledged)
+
+    def _post(self, lti_key, url, lis_result_sourcedid, score):
+        """
+        Post a single score
+
+        :return: True if the consumer acknowledged the score
+        """
+        if not 0 <= score <= 1.0:
+            log.warning("Invalid score %s for %s not synced", score,
+                        lis_result_sourcedid)
+            return False
+        xml = generate_request_xml(LTIBase.message_identifier_id(),
+                                   'replaceResult', lis_result_sourcedid,
+                                   score)
+        try:
+            success = bool(post_message(
+                self.consumers, lti_key, url, xml,
+                transport=self._transports.get(lti_key)))
+        except Exception:  # pylint: disable=broad-except
+            log.exception("Syncing grade of %s failed", lis_result_sourcedid)
+            success = False
+        if self.reader is not None:
+            self.reader.invalidate(lti_key, lis_result_sourcedid)
+        return success
@@ -0,0 +1,236 @@
+# -*- coding: utf-8 -*-
+"""
+Grade targets for posting grades outside of LTI sessions
+"""
+
+from __future__ import absolute_import
+
+import json
+import logging
+import time
+
+from .common import (
+    GRADE_SKIPPED,
+    LTIBase,
+    LTIPostMessageException,
+    generate_request_xml,
+    post_message,
+)
+from .sqlite import SQLiteStore
+
+log = logging.getLogger('pylti.target')  # pylint: disable=invalid-name
+
+
+class GradeTarget(object):
+    """
+    Everything needed to post a grade for one user and resource link,
+    captured from the session at launch time.  Targets hold no secrets;
+    consumer secrets are supplied when posting.
+    """
+    # pylint: disable=too-many-arguments
+    __slots__ = ('lti_key', 'url', 'lis_result_sourcedid', 'user_id',
+                 'resource_link_id')
+
+    def __init__(self, lti_key, url, lis_result_sourcedid, user_id=None,
+                 resource_link_id=None):
+        """
+        :param: lti_key: consumer key
+        :param: url: outcome service url
+        :param: lis_result_sourcedid: LTI lis_result_sourcedid
+        :param: user_id: LTI user_id
+        :param: resource_link_id: LTI resource_link_id
+        """
+        self.lti_key = lti_key
+        self.url = url
+        self.lis_result_sourcedid = lis_result_sourcedid
+        self.user_id = user_id
+        self.resource_link_id = resource_link_id
+
+    @classmethod
+    def from_lti(cls, lti):
+        """
+        Target of the current LTI session
+
+        :param: lti: :py:class:`pylti.common.LTIBase` instance
+        :return: :py:class:`GradeTarget`
+        """
+        return cls(lti.key, lti.response_url, lti.lis_result_sourcedid,
+                   lti.launch.user_id, lti.launch.resource_link_id)
+
+    def to_dict(self):
+        """
+        Target as a dict of strings
+
+        :return: dict
+        """
+        return dict((name, getattr(self, name)) for name in self.__slots__)
+
+    @classmethod
+    def from_dict(cls, data):
+        """
+        Target from :py:meth:`to_dict` output
+
+        :param: data: dict
+        :return: :py:class:`GradeTarget`
+        """
+        return cls(**data)
+
+    def dumps(self):
+        """
+        Target serialized as JSON
+
+        :return: JSON string
+        """
+        return json.dumps(self.to_dict(), sort_keys=True)
+
+    @classmethod
+    def loads(cls, data):
+        """
+        Target from :py:meth:`dumps` output
+
+        :param: data: JSON string
+        :return: :py:class:`GradeTarget`
+        """
+        return cls.from_dict(json.loads(data))
+
+    def __eq__(self, other):
+        return (isinstance(other, GradeTarget) and
+                self.to_dict() == other.to_dict())
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __hash__(self):
+        return hash(tuple(getattr(self, name) for name in self.__slots__))
+
+    def __repr__(self):
+        return 'GradeTarget({!r}, {!r}, {!r})'.format(
+            self.lti_key, self.url, self.lis_result_sourcedid)
+
+
+def post_grade_to(target, grade, consumers, transport=None, deadline=None,
+                  ack_cache=None):
+    """
+    Post grade to the outcome service of target, without an LTI session
+
+    :param: target: :py:class:`GradeTarget`
+    :param: grade: 0 <= grade <= 1
+    :param: consumers: consumers from config
+    :param: transport: :py:class:`pylti.transport.Transport` to send with
+    :param: deadline: absolute time.time() by which posting, including
+        retries, must end
+    :param: ack_cache: optional
+        :py:class:`pylti.outcome.AcknowledgedScoreCache`
+    :return: True if post successful and grade valid,
+        GRADE_SKIPPED if the score was already acknowledged
+    :exception: LTIPostMessageException if call failed
+    """
+    # pylint: disable=too-many-arguments
+    score = float(grade)
+    if not 0 <= score <= 1.0:
+        return False
+    if ack_cache is not None and ack_cache.is_acknowledged(
+            target.lti_key, target.lis_result_sourcedid, score):
+        log.debug("post_grade_to skipped, %s already acknowledged", score)
+        return GRADE_SKIPPED
+    xml = generate_request_xml(
+        LTIBase.message_identifier_id(), 'replaceResult',
+        target.lis_result_sourcedid, score)
+    ret = post_message(consumers, target.lti_key, target.url, xml,
+                       transport=transport, deadline=deadline)
+    if not ret:
+        if ack_cache is not None:
+            ack_cache.invalidate(target.lti_key, target.lis_result_sourcedid)
+        raise LTIPostMessageException("Post Message Failed")
+    if ack_cache is not None:
+        ack_cache.acknowledge(target.lti_key, target.lis_result_sourcedid,
+                              score)
+    return True
+
+
+class GradeTargetIndex(SQLiteStore):
+    """
+    SQLite index of the latest grade target of every
+    (consumer key, user_id, resource_link_id).  Pass it as the
+    ``grade_targets`` wrapper attribute to record targets of verified
+    launches, and use a file path to share the index with batch workers.
+    """
+    SCHEMA = (
+        'CREATE TABLE IF NOT EXISTS pylti_grade_target ('
+        'lti_key TEXT NOT NULL, user_id TEXT NOT NULL, '
+        'resource_link_id TEXT NOT NULL, target TEXT NOT NULL, '
+        'launched_at REAL NOT NULL, '
+        'PRIMARY KEY (lti_key, user_id, resource_link_id))',
+    )
+    TABLE = 'pylti_grade_target'
+
+    def add(self, target):
+        """
+        Store target, replacing the previous target of its user and
+        resource link
+
+        :param: target: :py:class:`GradeTarget`
+        """
+        with self._lock, self._connection:
+            self._connection.execute(
+                'INSERT OR REPLACE INTO pylti_grade_target '
+                '(lti_key, user_id, resource_link_id, target, launched_at) '
+                'VALUES (?, ?, ?, ?, ?)',
+                (target.lti_key, target.user_id or '',
+                 target.resource_link_id or '', target.dumps(), time.time()))
+
+    def record_launch(self, lti):
+        """
+        Store target of a verified launch
+
+        :param: lti: :py:class:`pylti.common.LTIBase` instance
+        """
+        self.add(GradeTarget.from_lti(lti))
+
+    def get(self, lti_key, user_id, resource_link_id):
+        """
+        Latest target of user and resource link
+
+        :param: lti_key: consumer key
+        :param: user_id: LTI user_id
+        :param: resource_link_id: LTI resource_link_id
+        :return: :py:class:`GradeTarget` or None
+        """
+        with self._lock:
+            row = self._connection.execute(
+                'SELECT target FROM pylti_grade_target WHERE lti_key = ? '
+                'AND user_id = ? AND resource_link_id = ?',
+                (lti_key, user_id, resource_link_id)).fetchone()
+        return GradeTarget.loads(row[0]) if row else None
+
+    def targets(self, lti_key, resource_link_id=None):
+        """
+        Targets of a consumer, optionally of one resource link
+
+        :param: lti_key: consumer key
+        :param: resource_link_id: LTI resource_link_id
+        :return: list of :py:class:`GradeTarget`
+        """
+        query = 'SELECT target FROM pylti_grade_target WHERE lti_key = ?'
+        params = [lti_key]
+        if resource_link_id is not None:
+            query += ' AND resource_link_id = ?'
+            params.append(resource_link_id)
+        with self._lock:
+            rows = self._connection.execute(
+                query + ' ORDER BY user_id', params).fetchall()
+        return [GradeTarget.loads(row[0]) for row in rows]
+
+    def remove(self, lti_key, user_id, resource_link_id):
+        """
+        Forget target of user and resource link
+
+        :param: lti_key: consumer key
+        :param: user_id: LTI user_id
+        :param: resource_link_id: LTI resource_link_id
+        """
+        with self._lock, self._connection:
+            self._connection.execute(
+                'DELETE FROM pylti_grade_target WHERE lti_key = ? '
+                'AND user_id = ? AND resource_link_id = ?',
+                (lti_key, user_id, resource_link_id))
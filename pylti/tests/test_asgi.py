@@ -0,0 +1,191 @@
+# -*- coding: utf-8 -*-
+"""
+Test pylti/asgi.py module
+"""
+from __future__ import absolute_import
+import asyncio
+import unittest
+
+import oauthlib.oauth1
+
+from six.moves.urllib.parse import urlencode
+
+from pylti.asgi import LTIMiddleware, lti
+from pylti.common import LTIRoleException
+from pylti.fake_lms import FakeLMS
+from pylti.session import MemoryNonceStore
+
+
+class TestASGI(unittest.TestCase):
+    """
+    Tests for the ASGI middleware and decorator
+    """
+    consumers = {
+        "__consumer_key__": {"secret": "__lti_secret__"}
+    }
+
+    def setUp(self):
+        """
+        Create middleware around an LTI handler.
+        """
+        self.errors = []
+        self.lms = FakeLMS(self.consumers).start()
+
+        async def error(scope, receive, send, exception):
+            """
+            Record exception and answer with 401.
+            """
+            # pylint: disable=unused-argument
+            self.errors.append(exception)
+            await send({'type': 'http.response.start', 'status': 401,
+                        'headers': []})
+            await send({'type': 'http.response.body', 'body': b'error'})
+
+        @lti(self.consumers, error=error, role='student')
+        async def handler(scope, receive, send, lti):
+            """
+            Post grade and answer with the form and the result.
+            """
+            # pylint: disable=redefined-outer-name
+            message = await receive()
+            ret = await lti.post_grade_async(0.5)
+            await send({'type': 'http.response.start', 'status': 200,
+                        'headers': []})
+            await send({'type': 'http.response.body',
+                        'body': u'{} {} {}'.format(
+                            len(message['body']), lti.user_id,
+                            ret).encode('utf-8')})
+
+        self.handler = handler
+        self.app = LTIMiddleware(handler, self.consumers,
+                                 paths=['/launch'], offload=True)
+
+    def tearDown(self):
+        """
+        Stop fake LMS.
+        """
+        self.lms.stop()
+
+    def request(self, roles=u'Learner', secret='__lti_secret__',
+                path='/launch', app=None, raw=None, nonce=None,
+                content_length=False):
+        """
+        Send signed launch form, or raw body, in two body chunks, with a
+        Content-Length header if content_length.
+
+        :return: status, body
+        """
+        params = {'lti_message_type': u'basic-lti-launch-request',
+                  'user_id': u'student', 'roles': roles,
+                  'lis_result_sourcedid': u'sourced',
+                  'lis_outcome_service_url': self.lms.outcome_url}
+        client = oauthlib.oauth1.Client(
+            '__consumer_key__', client_secret=secret, nonce=nonce,
+            signature_type=oauthlib.oauth1.SIGNATURE_TYPE_BODY)
+        _, _, body = client.sign(
+            'http://localhost' + path, http_method='POST',
+            body=urlencode(params),
+            headers={'Content-Type': 'application/x-www-form-urlencoded'})
+        body = body.encode('utf-8') if raw is None else raw
+        scope = {'type': 'http', 'method': 'POST', 'scheme': 'http',
+                 'path': path, 'query_string': b'',
+                 'headers': [(b'host', b'localhost'),
+                             (b'content-type',
+                              b'application/x-www-form-urlencoded')]}
+        if content_length:
+            scope['headers'].append(
+                (b'content-length', str(len(body)).encode('ascii')))
+        messages = [{'type': 'http.request', 'body': body[:10],
+                     'more_body': True},
+                    {'type': 'http.request', 'body': body[10:]}]
+        sent = []
+
+        async def receive():
+            """ Next request message """
+            return messages.pop(0)
+
+        async def send(message):
+            """ Record response message """
+            sent.append(message)
+
+        loop = asyncio.new_event_loop()
+        try:
+            loop.run_until_complete((app or self.app)(scope, receive, send))
+        finally:
+            loop.close()
+        return sent[0]['status'], sent[1]['body'].decode('utf-8'), len(body)
+
+    def test_launch(self):
+        """
+        Verified launches reach the handler, which posts grades.
+        """
+        status, body, size = self.request()
+        self.assertEqual(status, 200)
+        self.assertEqual(body, u'{} student True'.format(size))
+        self.assertEqual(self.lms.grades, {u'sourced': 0.5})
+
+    def test_replayed(self):
+        """
+        Replayed launches are rejected with a nonce store.
+        """
+        self.app.nonce_store = MemoryNonceStore()
+        self.assertEqual(self.request(nonce=u'1234567890')[0], 200)
+        self.assertEqual(self.request(nonce=u'1234567890')[0], 403)
+        self.assertEqual(self.request(nonce=u'1234567891')[0], 200)
+
+    def test_rejected(self):
+        """
+        Invalid launches are rejected by the middleware.
+        """
+        status, _, _ = self.request(secret='wrong')
+        self.assertEqual(status, 403)
+        status, _, _ = self.request(raw=b'user_id=\xff\xfe')
+        self.assertEqual(status, 400)
+        self.app.max_size = 10
+        status, _, _ = self.request()
+        self.assertEqual(status, 413)
+        self.assertEqual(self.lms.request_count, 0)
+
+    def test_any_path(self):
+        """
+        Without launch paths, forms that are no launches reach the app
+        untouched whatever their size.
+        """
+        async def echo(scope, receive, send):
+            """
+            Answer with the size of the body.
+            """
+            # pylint: disable=unused-argument
+            size, more_body = 0, True
+            while more_body:
+                message = await receive()
+                size += len(message['body'])
+                more_body = message.get('more_body', False)
+            await send({'type': 'http.response.start', 'status': 200,
+                        'headers': []})
+            await send({'type': 'http.response.body',
+                        'body': str(size).encode('ascii')})
+
+        app = LTIMiddleware(echo, self.consumers)
+        essay = b'essay=' + b'a' * 70000
+        for raw, content_length in ((essay, True), (essay, False),
+                                    (b'essay=\xff', True)):
+            status, body, size = self.request(
+                path='/submit', app=app, raw=raw,
+                content_length=content_length)
+            self.assertEqual((status, body), (200, str(size)))
+        status, _, _ = self.request(path='/submit', app=app, secret='wrong',
+                                    content_length=True)
+        self.assertEqual(status, 403)
+
+    def test_decorator_errors(self):
+        """
+        Role and missing verification errors go to the error handler.
+        """
+        status, _, _ = self.request(roles=u'Instructor')
+        self.assertEqual(status, 401)
+        self.assertIsInstance(self.errors.pop(), LTIRoleException)
+
+        status, _, _ = self.request(app=self.handler)
+        self.assertEqual(status, 401)
+        self.assertIn('verified LTI launch', str(self.errors.pop()))
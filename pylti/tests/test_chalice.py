@@ -7,13 +7,15 @@ import unittest
 
 import httpretty
 import oauthlib.oauth1
+import json
 import os
 
 from six.moves.urllib.parse import urlencode
 
 from pylti.common import LTIException
 # from pylti.chalice import LTI
-from pylti.tests.test_chalice_app import app_exception, app
+from pylti.tests.test_chalice_app import app_exception, app, warmer
+from pylti.tests.util import WarmRecordingTransport
 
 from chalice.config import Config
 from chalice.local import LocalGateway
@@ -282,6 +284,24 @@ edge.edx.org-i4x-StarX-StarX_DEMO-lti-40559041895b4065b2818c23b9cd9da8\
                                          body='')
         self.assertFalse(self.has_exception())
 
+    def test_access_to_oauth_resource_prewarm(self):
+        """
+        Verified launch warms connection to its outcome service.
+        """
+        del WarmRecordingTransport.warmed[:]
+        url = 'https://localhost/initial_prewarm?'
+        new_url = self.generate_launch_request(self.consumers, url)
+        self.localGateway.handle_request(method='GET',
+                                         path=new_url,
+                                         headers={
+                                            'host': 'localhost',
+                                            'x-forwarded-proto': 'https'
+                                         },
+                                         body='')
+        warmer.close()
+        self.assertFalse(self.has_exception())
+        self.assertEqual(len(WarmRecordingTransport.warmed), 1)
+
     def test_access_to_oauth_resource_post(self):
         """
         Accessing oauth_resource.
@@ -655,32 +675,36 @@ edge.edx.org-i4x-StarX-StarX_DEMO-lti-40559041895b4065b2818c23b9cd9da8\
         self.assertTrue(self.has_exception())
         self.assertEqual(ret['body'], "error")
 
-    # DELETED: Not implemented. Sounds like an EdX edge case
-    # @httpretty.activate
-    # def test_access_to_oauth_resource_post_grade_fix_url(self):
-    #     """
-    #     Make sure URL remap works for edX vagrant stack.
-    #     """
-    #     # pylint: disable=maybe-no-member
-    #     uri = 'https://localhost:8000/dev_stack'
-
-    #     httpretty.register_uri(httpretty.POST, uri,
-    #                            body=self.request_callback)
-
-    #     url = 'https://localhost/initial?'
-    #     new_url = self.generate_launch_request(
-    #         self.consumers, url, lit_outcome_service_url=uri
-    #     )
-    #     ret = self.app.get(new_url)
-    #     self.assertFalse(self.has_exception())
-
-    #     ret = self.app.get("/post_grade/1.0")
-    #     self.assertFalse(self.has_exception())
-    #     self.assertEqual(ret.data.decode('utf-8'), "grade=True")
-
-    #     ret = self.app.get("/post_grade/2.0")
-    #     self.assertFalse(self.has_exception())
-    #     self.assertEqual(ret.data.decode('utf-8'), "grade=False")
+    @httpretty.activate
+    def test_access_to_oauth_resource_post_grade_fix_url(self):
+        """
+        Make sure URL remap works for edX vagrant stack.
+        """
+        # pylint: disable=maybe-no-member
+        uri = 'https://localhost:8000/dev_stack'
+
+        httpretty.register_uri(httpretty.POST,
+                               'http://localhost:8000/dev_stack',
+                               body=self.request_callback)
+
+        os.environ['PYLTI_URL_FIX'] = json.dumps({
+            "https://localhost:8000/": {
+                "https://localhost:8000/": "http://localhost:8000/"
+            }
+        })
+        try:
+            url = 'https://localhost/post_grade/1.0?'
+            new_url = self.generate_launch_request(
+                self.consumers, url, lit_outcome_service_url=uri
+            )
+            ret = self.localGateway.handle_request(
+                method='GET', path=new_url,
+                headers={'host': 'localhost', 'x-forwarded-proto': 'https'},
+                body='')
+        finally:
+            del os.environ['PYLTI_URL_FIX']
+        self.assertFalse(self.has_exception())
+        self.assertEqual(ret['body'], "grade=True")
 
     @httpretty.activate
     def test_access_to_oauth_resource_post_grade2(self):
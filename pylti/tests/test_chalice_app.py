@@ -1,9 +1,11 @@
 from chalice import Chalice
 from pylti.chalice import lti as lti_chalice
 from pylti.tests.test_common import ExceptionHandler
+from pylti.tests.util import recording_warmer
 
 app = Chalice(__name__)
 app_exception = ExceptionHandler()  # pylint: disable=invalid-name
+warmer = recording_warmer()  # pylint: disable=invalid-name
 
 
 def error(exception):
@@ -80,6 +82,19 @@ def post_form(lti):
     return "hi"
 
 
+@app.route("/initial_prewarm", methods=['GET'])
+@lti_chalice(error=error, request='initial', app=app, prewarm=warmer)
+def initial_prewarm_route(lti):
+    # pylint: disable=unused-argument,
+    """
+    Access route with 'initial' request and connection warming.
+
+    :param lti: `lti` object
+    :return: string "hi"
+    """
+    return "hi"
+
+
 @app.route("/name", methods=['GET', 'POST'])
 @lti_chalice(error=error, request='initial', app=app)
 def name(lti):
@@ -2,6 +2,11 @@
 """
 Test pylti/test_common.py module
 """
+import json
+import socket
+import ssl
+import threading
+import time
 import unittest
 import semantic_version
 
@@ -12,14 +17,33 @@ from six.moves.urllib.parse import urlencode, urlparse, parse_qs
 
 import pylti
 from pylti.common import (
+    CIRCUIT_BREAKERS,
+    CONCURRENCY_LIMITERS,
+    LTI_CONTEXT_KEY,
+    LaunchContext,
+    RoleTable,
+    LTICircuitOpenException,
     LTIOAuthServer,
+    LTIPostMessageException,
+    RATE_LIMITERS,
+    TLS_CONTEXTS,
+    URL_REWRITERS,
+    UrlRewriter,
+    create_transport,
     verify_request_common,
     LTIException,
     post_message,
     post_message2,
-    generate_request_xml
+    generate_request_xml,
+    normalize_role,
+    parse_outcome_response,
+)
+from pylti.fake_lms import FakeLMS
+from pylti.tests.util import (
+    TEST_CLIENT_CERT,
+    TEST_SERVER_CERT,
+    generate_request_xml_etree,
 )
-from pylti.tests.util import TEST_CLIENT_CERT
 
 
 class ExceptionHandler(object):
@@ -237,6 +261,406 @@ edge.edx.org-i4x-StarX-StarX_DEMO-lti-40559041895b4065b2818c23b9cd9da8\
         ret = post_message2(consumers, "__consumer_key__", uri, body)
         self.assertTrue(ret)
 
+    def test_parse_outcome_response(self):
+        """
+        Status fields are read from a valid response
+        """
+        response = parse_outcome_response(self.expected_response)
+        self.assertTrue(response)
+        self.assertTrue(response.is_success)
+        self.assertEqual(response.code_major, 'success')
+        self.assertEqual(response.severity, 'status')
+        self.assertTrue(response.description.startswith('Score for StarX'))
+        self.assertIsNone(response.message_ref_identifier)
+        self.assertIsNone(response.error)
+
+    def test_parse_outcome_response_prefixed_namespace(self):
+        """
+        Namespace prefixes and whitespace do not affect parsing
+        """
+        content = b"""<?xml version="1.0" encoding="UTF-8"?>
+<ims:imsx_POXEnvelopeResponse
+    xmlns:ims="http://www.imsglobal.org/services/ltiv1p1/xsd/imsoms_v1p0">
+  <ims:imsx_POXHeader><ims:imsx_POXResponseHeaderInfo>
+    <ims:imsx_statusInfo>
+      <ims:imsx_codeMajor>
+        success
+      </ims:imsx_codeMajor>
+      <ims:imsx_severity>status</ims:imsx_severity>
+      <ims:imsx_messageRefIdentifier>42</ims:imsx_messageRefIdentifier>
+    </ims:imsx_statusInfo>
+  </ims:imsx_POXResponseHeaderInfo></ims:imsx_POXHeader>
+</ims:imsx_POXEnvelopeResponse>"""
+        response = parse_outcome_response(content)
+        self.assertTrue(response)
+        self.assertEqual(response.message_ref_identifier, '42')
+
+    def test_parse_outcome_response_failure(self):
+        """
+        Failure status keeps severity and description
+        """
+        content = self.expected_response.replace(
+            '<imsx_codeMajor>success', '<imsx_codeMajor>failure').replace(
+                '<imsx_severity>status', '<imsx_severity>error')
+        response = parse_outcome_response(content)
+        self.assertFalse(response)
+        self.assertEqual(response.code_major, 'failure')
+        self.assertEqual(response.severity, 'error')
+        self.assertIsNotNone(response.description)
+        self.assertIsNone(response.error)
+
+    def test_parse_outcome_response_score(self):
+        """
+        readResult score is read when requested
+        """
+        content = self.expected_response.replace(
+            '<replaceResultResponse/>',
+            '<readResultResponse><result><resultScore><language>en'
+            '</language><textString>0.91</textString></resultScore>'
+            '</result></readResultResponse>')
+        self.assertIsNone(parse_outcome_response(content).score)
+        response = parse_outcome_response(content, want_score=True)
+        self.assertTrue(response)
+        self.assertEqual(response.score, 0.91)
+
+    def test_parse_outcome_response_rejected(self):
+        """
+        Invalid, oversized and DTD carrying responses are failures
+        """
+        for content in (b'', b'success', b'<xml></xml>',
+                        b'<imsx_codeMajor>success</imsx_codeMajor',
+                        self.expected_response + ' ' * 70000):
+            response = parse_outcome_response(content)
+            self.assertFalse(response)
+            self.assertIsNotNone(response.error)
+
+        bomb = b"""<?xml version="1.0"?>
+<!DOCTYPE lolz [<!ENTITY lol "lol"><!ENTITY lol2 "&lol;&lol;&lol;">]>
+<imsx_codeMajor>&lol2;</imsx_codeMajor>"""
+        response = parse_outcome_response(bomb)
+        self.assertFalse(response)
+        self.assertEqual(response.error,
+                         'Document type declarations are not allowed')
+
+    @httpretty.activate
+    def test_post_message_circuit_open(self):
+        """
+        Failing outcome service host is not contacted while circuit is open
+        """
+        uri = 'https://failing.example.edu/grade_handler'
+        requests = []
+
+        def request_callback(request, cburi, headers):
+            # pylint: disable=unused-argument
+            """
+            Mock server error.
+            """
+            requests.append(request)
+            return 503, headers, "unavailable"
+
+        httpretty.register_uri(httpretty.POST, uri, body=request_callback)
+        consumers = {
+            "__consumer_key__": {"secret": "__lti_secret__"}
+        }
+        CIRCUIT_BREAKERS.configure(failure_threshold=2, reset_timeout=60)
+        try:
+            for _ in range(2):
+                self.assertFalse(post_message(consumers, "__consumer_key__",
+                                              uri, '<xml></xml>'))
+            with self.assertRaises(LTICircuitOpenException):
+                post_message(consumers, "__consumer_key__", uri,
+                             '<xml></xml>')
+            self.assertEqual(len(requests), 2)
+            self.assertEqual(CIRCUIT_BREAKERS.states(),
+                             {'https://failing.example.edu': 'open'})
+        finally:
+            CIRCUIT_BREAKERS.configure()
+
+    def test_post_message_concurrency_limit(self):
+        """
+        Outcome host answering 429 gets a lower limit
+        """
+        consumers = {
+            "__consumer_key__": {"secret": "__lti_secret__"}
+        }
+        self.assertIsNone(CONCURRENCY_LIMITERS.get('http://lms'))
+        CONCURRENCY_LIMITERS.configure()
+        self.addCleanup(CONCURRENCY_LIMITERS.configure, enabled=False)
+        with FakeLMS(consumers, failure_rate=1.0,
+                     failure_status=429) as lms:
+            for _ in range(2):
+                self.assertFalse(post_message(
+                    consumers, "__consumer_key__", lms.outcome_url,
+                    generate_request_xml(u'id', 'replaceResult', 's', 0.5)))
+            stats = CONCURRENCY_LIMITERS.stats()[lms.url]
+        self.assertEqual(stats['limit'], 2)
+        self.assertEqual(stats['in_flight'], 0)
+
+    def test_post_message_rate_limited(self):
+        """
+        Outcome requests of a rate limited consumer are spread out
+        """
+        consumers = {
+            "__consumer_key__": {"secret": "__lti_secret__", "rate": 20,
+                                 "burst": 1}
+        }
+        with FakeLMS(consumers) as lms:
+            started = time.time()
+            for score in (0.1, 0.2, 0.3):
+                self.assertTrue(post_message(
+                    consumers, "__consumer_key__", lms.outcome_url,
+                    generate_request_xml(u'id', 'replaceResult', 's',
+                                         score)))
+        self.assertGreaterEqual(time.time() - started, 0.09)
+        RATE_LIMITERS.clear()
+
+    def test_post_message_client_cert_tls(self):
+        """
+        Client certificate context is loaded once and TLS sessions are
+        resumed by new connections
+        """
+        server_context = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
+        server_context.load_cert_chain(TEST_SERVER_CERT)
+        server_context.verify_mode = ssl.CERT_REQUIRED
+        server_context.load_verify_locations(TEST_SERVER_CERT)
+        consumers = {
+            "__consumer_key__": {"secret": "__lti_secret__",
+                                 "cert": TEST_SERVER_CERT}
+        }
+        TLS_CONTEXTS.configure(cafile=TEST_SERVER_CERT)
+        try:
+            with FakeLMS(consumers, ssl_context=server_context) as lms:
+                for score in (0.1, 0.2, 0.3):
+                    transport = create_transport(consumers,
+                                                 "__consumer_key__")
+                    self.assertTrue(post_message(
+                        consumers, "__consumer_key__", lms.outcome_url,
+                        generate_request_xml(u'id', 'replaceResult', 's',
+                                             score),
+                        transport=transport))
+                    transport.close()
+            self.assertEqual(lms.grades, {'s': 0.3})
+            self.assertEqual(lms.connection_count, 3)
+            self.assertEqual(lms.resumed_count, 2)
+            self.assertIs(TLS_CONTEXTS.get(TEST_SERVER_CERT),
+                          TLS_CONTEXTS.get(TEST_SERVER_CERT))
+        finally:
+            TLS_CONTEXTS.configure()
+
+    @staticmethod
+    def silent_server():
+        """
+        Start server accepting connections without ever responding
+
+        :return: (url, listening socket)
+        """
+        listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        listener.bind(('127.0.0.1', 0))
+        listener.listen(5)
+        connections = []
+
+        def accept():
+            """
+            Keep accepted connections open.
+            """
+            try:
+                while True:
+                    connections.append(listener.accept()[0])
+            except socket.error:
+                for connection in connections:
+                    connection.close()
+
+        thread = threading.Thread(target=accept)
+        thread.daemon = True
+        thread.start()
+        url = 'http://127.0.0.1:{}/grade_handler'.format(
+            listener.getsockname()[1])
+        return url, listener
+
+    def test_post_message_read_timeout(self):
+        """
+        Stalled outcome service times out
+        """
+        url, listener = self.silent_server()
+        consumers = {
+            "__consumer_key__": {"secret": "__lti_secret__",
+                                 "read_timeout": 0.2}
+        }
+        started = time.time()
+        try:
+            with self.assertRaises(LTIPostMessageException):
+                post_message(consumers, "__consumer_key__", url, '<xml/>')
+        finally:
+            listener.close()
+        self.assertLess(time.time() - started, 2)
+
+    def test_post_message_deadline(self):
+        """
+        Deadline bounds outcome request without configured timeouts
+        """
+        url, listener = self.silent_server()
+        consumers = {
+            "__consumer_key__": {"secret": "__lti_secret__", "retries": 3}
+        }
+        try:
+            with self.assertRaises(LTIPostMessageException):
+                post_message(consumers, "__consumer_key__", url, '<xml/>',
+                             deadline=time.time() - 1)
+            started = time.time()
+            with self.assertRaises(LTIPostMessageException):
+                post_message(consumers, "__consumer_key__", url, '<xml/>',
+                             deadline=time.time() + 0.3)
+        finally:
+            listener.close()
+        self.assertLess(time.time() - started, 2)
+
+    @httpretty.activate
+    def test_post_message_retries(self):
+        """
+        Server errors are retried as configured
+        """
+        uri = 'https://retry.example.edu/grade_handler'
+        statuses = [503, 200]
+
+        def request_callback(request, cburi, headers):
+            # pylint: disable=unused-argument
+            """
+            Fail once, then succeed.
+            """
+            return statuses.pop(0), headers, self.expected_response
+
+        httpretty.register_uri(httpretty.POST, uri, body=request_callback)
+        consumers = {
+            "__consumer_key__": {"secret": "__lti_secret__",
+                                 "retries": 1, "retry_delay": 0}
+        }
+        self.assertTrue(post_message(consumers, "__consumer_key__", uri,
+                                     '<xml/>'))
+        self.assertEqual(statuses, [])
+
+    def test_launch_context(self):
+        """
+        Launch context keeps launch parameters in one compact value
+        """
+        params = {'oauth_consumer_key': u'key', 'user_id': u'user',
+                  'roles': u'Learner', 'context_title': u'ignored',
+                  'lis_result_sourcedid': u'', 'custom_color': u'blue'}
+        context = LaunchContext.from_params(params, capture_custom=True)
+        self.assertEqual(context.user_id, u'user')
+        self.assertIsNone(context.lis_result_sourcedid)
+        self.assertEqual(context.get('custom_color'), u'blue')
+        self.assertEqual(context.get('context_title', u'none'), u'none')
+        self.assertEqual(context.to_dict(), {
+            'oauth_consumer_key': u'key', 'user_id': u'user',
+            'roles': u'Learner', 'custom_color': u'blue'})
+
+        copy = LaunchContext.loads(context.dumps())
+        self.assertEqual(copy.to_dict(), context.to_dict())
+        self.assertLess(len(context.dumps()),
+                        len(json.dumps(context.to_dict())))
+        self.assertEqual(LaunchContext.from_session(
+            {LTI_CONTEXT_KEY: context.dumps()}).user_id, u'user')
+        self.assertEqual(LaunchContext.from_session(params).custom, {})
+        self.assertEqual(LaunchContext(user_id=u'user').to_dict(),
+                         {'user_id': u'user'})
+
+        with self.assertRaises(ValueError):
+            LaunchContext.loads('[0,"key"]')
+        with self.assertRaises(TypeError):
+            LaunchContext(context_title=u'title')
+
+    def test_url_rewriter(self):
+        """
+        Compiled PYLTI_URL_FIX mapping rewrites like the mapping loop
+        """
+        mapping = {
+            "https://localhost:8000/": {
+                "https://localhost:8000/": "http://localhost:8000/"
+            },
+            "http://localhost:8000/": {"/dev": "/stack", "8000": "8001"},
+        }
+        rewriter = UrlRewriter(mapping)
+        for url in ('https://localhost:8000/dev/grade',
+                    'http://localhost:8000/dev/grade',
+                    'https://example.edu/dev/grade', ''):
+            expected = url
+            for prefix, replacements in mapping.items():
+                if expected.startswith(prefix):
+                    for _from, _to in replacements.items():
+                        expected = expected.replace(_from, _to)
+            self.assertEqual(rewriter.rewrite(url), expected)
+            self.assertEqual(rewriter.rewrite(url), expected)
+        self.assertEqual(UrlRewriter().rewrite('https://a/'), 'https://a/')
+
+        rewriter.maxsize = 1
+        rewriter.rewrite('https://localhost:8000/other')
+        self.assertEqual(len(rewriter._memo), 1)  # pylint: disable=W0212
+
+        self.assertIs(URL_REWRITERS.get(mapping), URL_REWRITERS.get(mapping))
+        self.assertIsNot(URL_REWRITERS.get(mapping),
+                         URL_REWRITERS.get(dict(mapping)))
+        text = json.dumps(mapping)
+        self.assertIs(URL_REWRITERS.get(text),
+                      URL_REWRITERS.get(json.dumps(mapping)))
+        self.assertEqual(URL_REWRITERS.get(text).rewrite(
+            'https://localhost:8000/x'), 'http://localhost:8001/x')
+        URL_REWRITERS.clear()
+
+    def test_role_table(self):
+        """
+        Roles are normalized and checked with masks
+        """
+        self.assertEqual(normalize_role(u' Instructor'), u'Instructor')
+        self.assertEqual(normalize_role(
+            u'urn:lti:role:ims/lis/Instructor'), u'Instructor')
+        self.assertEqual(normalize_role(
+            u'urn:lti:role:ims/lis/Instructor/TeachingAssistant'),
+            u'TeachingAssistant')
+        self.assertEqual(normalize_role(
+            u'http://purl.imsglobal.org/vocab/lis/v2/membership/'
+            u'Instructor#TeachingAssistant'), u'TeachingAssistant')
+        for role in (u'urn:lti:sysrole:ims/lis/Administrator',
+                     u'urn:lti:instrole:ims/lis/Instructor',
+                     u'http://purl.imsglobal.org/vocab/lis/v2/institution/'
+                     u'person#Instructor'):
+            self.assertEqual(normalize_role(role), role)
+        self.assertEqual(normalize_role(
+            u'http://purl.imsglobal.org/vocab/lis/v2/membership#Learner'),
+            u'Learner')
+
+        groups = {u'staff': [u'Administrator', u'Instructor'],
+                  u'student': [u'Student', u'Learner']}
+        table = RoleTable(groups, maxsize=2)
+        names, mask = table.parse(u'urn:lti:role:ims/lis/Learner,Mentor')
+        self.assertEqual(names, frozenset([u'Learner', u'Mentor']))
+        self.assertTrue(mask & table.group_mask(u'student'))
+        self.assertFalse(mask & table.group_mask(u'staff'))
+        self.assertEqual(table.parse(None), (frozenset(), 0))
+        self.assertIs(table.parse(u'Instructor'), table.parse(u'Instructor'))
+        with self.assertRaises(LTIException):
+            table.group_mask(u'mentor')
+
+        groups[u'mentor'] = [u'Mentor']
+        mentor = table.group_mask(u'mentor')
+        self.assertTrue(table.parse(u'Mentor')[1] & mentor)
+
+        groups[u'staff'].append(u'TeachingAssistant')
+        table.compile()
+        staff = table.group_mask(u'staff')
+        self.assertTrue(table.parse(u'TeachingAssistant')[1] & staff)
+
+        # Group roles are normalized, other roles only match themselves
+        groups = {u'ta': [u'urn:lti:role:ims/lis/TeachingAssistant'],
+                  u'admin': [u'urn:lti:sysrole:ims/lis/Administrator'],
+                  u'staff': [u'Administrator']}
+        table = RoleTable(groups)
+        self.assertTrue(table.parse(
+            u'urn:lti:role:ims/lis/TeachingAssistant')[1] &
+            table.group_mask(u'ta'))
+        _, mask = table.parse(u'urn:lti:sysrole:ims/lis/Administrator')
+        self.assertTrue(mask & table.group_mask(u'admin'))
+        self.assertFalse(mask & table.group_mask(u'staff'))
+
     def test_generate_xml(self):
         """
         Generated post XML is valid
@@ -264,6 +688,31 @@ imsoms_v1p0"><imsx_POXHeader><imsx_POXRequestHeaderInfo><imsx_version>V1.0\
 lis_result_sourcedid</sourcedId></sourcedGUID></resultRecord></operationRequest>\
 </imsx_POXBody></imsx_POXEnvelopeRequest>""")
 
+    def test_generate_xml_parity(self):
+        """
+        Template serializer matches ElementTree output
+        """
+        identifiers = [u'edX_fix', u'', None, u'a&b', u'<id>', u'"q" \'a\'']
+        sourcedids = [
+            u'MITx/ODL_ENG/2014_T1:edge.edx.org-i4x-MITx-ODL_ENG-lti-'
+            u'94173d3e79d145fd8ec2e83f15836ac8:'
+            u'008437924c9852377e8994829aaac7a1',
+            u'', None, u'&amp;', u'<sourcedId>x</sourcedId>',
+            u'\u00e9\u00fc\u4e2d\u6587', u'tab\tline\nreturn\r',
+            u']]>', u'a > b < c & d',
+        ]
+        scores = [None, 0, 1, 0.0, 0.5, 1.0, 1.0 / 3, u'0.25', u'&<>', u'']
+        operations = [u'replaceResult', u'readResult', u'deleteResult']
+        for operation in operations:
+            for identifier in identifiers:
+                for sourcedid in sourcedids:
+                    for score in scores:
+                        self.assertEqual(
+                            generate_request_xml(identifier, operation,
+                                                 sourcedid, score),
+                            generate_request_xml_etree(identifier, operation,
+                                                       sourcedid, score))
+
     @staticmethod
     def generate_oauth_request(url_to_sign=None):
         """
@@ -0,0 +1,115 @@
+# -*- coding: utf-8 -*-
+"""
+Test pylti/fake_lms.py module
+"""
+from __future__ import absolute_import
+import json
+import unittest
+
+from pylti.common import (
+    TransportPool,
+    generate_request_xml,
+    post_message,
+    post_message2,
+)
+from pylti.fake_lms import FakeLMS
+
+
+class TestFakeLMS(unittest.TestCase):
+    """
+    Tests for FakeLMS
+    """
+    consumers = {
+        "__consumer_key__": {"secret": "__lti_secret__"}
+    }
+
+    def setUp(self):
+        """
+        Start fake LMS verifying signatures.
+        """
+        self.lms = FakeLMS(self.consumers).start()
+
+    def tearDown(self):
+        """
+        Stop fake LMS.
+        """
+        self.lms.stop()
+
+    def post(self, operation, sourcedid, score=None, consumers=None):
+        """
+        Send POX outcome request to fake LMS.
+        """
+        xml = generate_request_xml(u'message_id', operation, sourcedid,
+                                   score)
+        return post_message(consumers or self.consumers, "__consumer_key__",
+                            self.lms.outcome_url, xml,
+                            want_score=operation == 'readResult')
+
+    def test_pox_operations(self):
+        """
+        Scores are replaced, read and deleted.
+        """
+        response = self.post('replaceResult', 'sourced', 0.5)
+        self.assertTrue(response)
+        self.assertEqual(response.message_ref_identifier, u'message_id')
+        self.assertEqual(self.lms.grades, {'sourced': 0.5})
+        self.assertEqual(self.post('readResult', 'sourced').score, 0.5)
+
+        self.assertTrue(self.post('deleteResult', 'sourced'))
+        response = self.post('readResult', 'sourced')
+        self.assertTrue(response)
+        self.assertIsNone(response.score)
+        self.assertEqual(self.lms.request_count, 4)
+
+    def test_invalid_score(self):
+        """
+        Out of range score is answered with failure.
+        """
+        response = self.post('replaceResult', 'sourced', 1.5)
+        self.assertFalse(response)
+        self.assertEqual(response.code_major, 'failure')
+        self.assertEqual(self.lms.grades, {})
+
+    def test_invalid_signature(self):
+        """
+        Requests signed with the wrong secret are rejected.
+        """
+        response = self.post('replaceResult', 'sourced', 0.5, consumers={
+            "__consumer_key__": {"secret": "wrong"}})
+        self.assertFalse(response)
+        self.assertEqual(self.lms.grades, {})
+
+    def test_lti2_result(self):
+        """
+        LTI 2.0 results are stored per user and read back.
+        """
+        url = self.lms.url + '/lti_2_0_result_rest_handler/user/student'
+        body = json.dumps({"@type": "Result", "resultScore": 0.8})
+        self.assertTrue(post_message2(
+            self.consumers, "__consumer_key__", url, body, method='PUT',
+            content_type='application/vnd.ims.lis.v2.result+json'))
+        self.assertEqual(self.lms.results['student']['resultScore'], 0.8)
+        self.assertTrue(post_message2(
+            self.consumers, "__consumer_key__", url, '', method='GET'))
+        self.assertFalse(post_message2(
+            self.consumers, "__consumer_key__", url, '{"resultScore": 2}',
+            method='PUT'))
+
+    def test_failures_and_latency(self):
+        """
+        Failure rate and latency apply to every request.
+        """
+        self.lms.failure_rate = 1.0
+        self.lms.failure_status = 503
+        transport = TransportPool(self.consumers).get("__consumer_key__")
+        self.assertFalse(post_message2(
+            self.consumers, "__consumer_key__",
+            self.lms.url + '/lti_2_0_result_rest_handler/user/student',
+            '{}', method='PUT', transport=transport))
+        self.assertEqual(self.lms.failure_count, 1)
+
+        self.lms.failure_rate = 0.0
+        self.lms.latency = (0.01, 0.02)
+        self.assertTrue(self.post('replaceResult', 'sourced', 0.1))
+        self.assertEqual(self.lms.in_flight, 0)
+        self.assertEqual(self.lms.max_in_flight, 1)
@@ -3,17 +3,36 @@
 Test pylti/test_flask.py module
 """
 from __future__ import absolute_import
+import time
 import unittest
 
 import httpretty
 import mock
 import oauthlib.oauth1
+from flask import Flask, session
 
 from six.moves.urllib.parse import urlencode
 
-from pylti.common import LTIException
-from pylti.flask import LTI
-from pylti.tests.test_flask_app import app_exception, app
+from pylti.common import (
+    GRADE_DEFERRED,
+    LTI_CONTEXT_KEY,
+    LTIException,
+    LTIRoleException,
+    verify_request_common,
+)
+from pylti.flask import LTI, LTISessionInterface, PyLTI, lti as lti_flask
+from pylti.session import MemorySessionStore
+from pylti.tests.test_flask_app import (
+    app_exception,
+    app,
+    ack_cache,
+    budget_results,
+    deferred_results,
+    grade_targets,
+    transport_pool,
+    warmer,
+)
+from pylti.tests.util import WarmRecordingTransport
 
 
 class TestFlask(unittest.TestCase):
@@ -64,6 +83,7 @@ edge.edx.org-i4x-StarX-StarX_DEMO-lti-40559041895b4065b2818c23b9cd9da8\
         }
         self.app = app.test_client()
         app_exception.reset()
+        ack_cache.clear()
 
     @staticmethod
     def get_exception():
@@ -175,6 +195,98 @@ edge.edx.org-i4x-StarX-StarX_DEMO-lti-40559041895b4065b2818c23b9cd9da8\
         self.app.get(new_url)
         self.assertFalse(self.has_exception())
 
+    def test_access_to_oauth_resource_prewarm(self):
+        """
+        Verified launch warms connection to its outcome service once.
+        """
+        del WarmRecordingTransport.warmed[:]
+        url = 'http://localhost/initial_prewarm?'
+        for _ in range(2):
+            new_url = self.generate_launch_request(self.consumers, url)
+            self.app.get(new_url)
+        warmer.close()
+        self.assertFalse(self.has_exception())
+        self.assertEqual(len(WarmRecordingTransport.warmed), 1)
+        self.assertTrue(WarmRecordingTransport.warmed[0].startswith(
+            'https://example.edu/courses/MITx/ODL_ENG/2014_T1/'))
+
+        self.app.get('http://localhost/initial_prewarm?invalid=1')
+        self.assertTrue(self.has_exception())
+        self.assertEqual(len(WarmRecordingTransport.warmed), 1)
+
+    def test_initial_grade_targets(self):
+        """
+        Verified launch records its grade target.
+        """
+        url = 'http://localhost/initial_targets?'
+        new_url = self.generate_launch_request(self.consumers, url)
+        self.app.get(new_url)
+        self.assertFalse(self.has_exception())
+        targets = grade_targets.targets("__consumer_key__")
+        self.assertEqual(len(targets), 1)
+        self.assertEqual(targets[0].user_id,
+                         u'008437924c9852377e8994829aaac7a1')
+        self.assertTrue(targets[0].url.endswith('/grade_handler'))
+        self.assertTrue(targets[0].lis_result_sourcedid.startswith(
+            u'MITx/ODL_ENG/2014_T1:'))
+
+    def test_launch_context(self):
+        """
+        Launch context is stored as a single session value.
+        """
+        url = 'http://localhost/initial_context?'
+        new_url = self.generate_launch_request(
+            self.consumers, url, add_params={u'custom_color': u'blue',
+                                             u'lis_person_sourcedid': u'p'})
+        ret = self.app.get(new_url)
+        self.assertFalse(self.has_exception())
+        self.assertEqual(ret.data.decode('utf-8'), u'blue')
+        with self.app.session_transaction() as sess:
+            self.assertIn(LTI_CONTEXT_KEY, sess)
+            self.assertNotIn('user_id', sess)
+
+        ret = self.app.get('/session_name')
+        self.assertEqual(ret.data.decode('utf-8'), u'p')
+
+        # Launch without launch context replaces the stored context
+        url = 'http://localhost/initial?'
+        self.app.get(self.generate_launch_request(self.consumers, url))
+        with self.app.session_transaction() as sess:
+            self.assertNotIn(LTI_CONTEXT_KEY, sess)
+        ret = self.app.get('/session_name')
+        self.assertEqual(ret.data.decode('utf-8'),
+                         u'008437924c9852377e8994829aaac7a1')
+
+    def test_nested_verification(self):
+        """
+        Nested LTI wrappers verify a request once.
+        """
+        url = 'http://localhost/initial_nested?'
+        new_url = self.generate_launch_request(self.consumers, url)
+        with mock.patch('pylti.flask.verify_request_common',
+                        wraps=verify_request_common) as verify:
+            ret = self.app.get(new_url)
+            self.assertFalse(self.has_exception())
+            self.assertEqual(ret.data.decode('utf-8'),
+                             u'008437924c9852377e8994829aaac7a1')
+            self.assertEqual(verify.call_count, 1)
+
+            self.app.get(new_url.replace('Instructor', 'Learner'))
+            self.assertTrue(self.has_exception())
+            self.assertEqual(verify.call_count, 2)
+
+    def test_verification_per_request(self):
+        """
+        Requests sharing an app context are verified each.
+        """
+        url = 'http://localhost/initial_nested?'
+        new_url = self.generate_launch_request(self.consumers, url)
+        with app.app_context():
+            self.app.get(new_url)
+            self.assertFalse(self.has_exception())
+            self.app.get(new_url.replace('Instructor', 'Learner'))
+            self.assertTrue(self.has_exception())
+
     def test_access_to_oauth_resource_name_passed(self):
         """
         Check that name is returned if passed via initial request.
@@ -255,6 +367,38 @@ edge.edx.org-i4x-StarX-StarX_DEMO-lti-40559041895b4065b2818c23b9cd9da8\
         self.app.get(new_url)
         self.assertFalse(self.has_exception())
 
+    def test_access_to_oauth_resource_staff_only_as_urn_role(self):
+        """
+        Allow access if user in role given as LIS URN.
+        """
+        url = 'http://localhost/initial_staff?'
+        new_url = self.generate_launch_request(
+            self.consumers, url,
+            roles='urn:lti:instrole:ims/lis/Student,'
+                  'urn:lti:role:ims/lis/Instructor'
+        )
+
+        self.app.get(new_url)
+        self.assertFalse(self.has_exception())
+
+        # Sub-roles are not their principal role
+        new_url = self.generate_launch_request(
+            self.consumers, url,
+            roles='urn:lti:role:ims/lis/Instructor/TeachingAssistant'
+        )
+        self.app.get(new_url)
+        self.assertTrue(self.has_exception())
+        self.assertIsInstance(self.get_exception(), LTIRoleException)
+
+        # Institution roles are not course roles
+        app_exception.reset()
+        new_url = self.generate_launch_request(
+            self.consumers, url,
+            roles='urn:lti:instrole:ims/lis/Instructor,Learner'
+        )
+        self.app.get(new_url)
+        self.assertIsInstance(self.get_exception(), LTIRoleException)
+
     def test_access_to_oauth_resource_staff_only_as_unknown_role(self):
         """
         Deny access if role not defined.
@@ -536,6 +680,269 @@ edge.edx.org-i4x-StarX-StarX_DEMO-lti-40559041895b4065b2818c23b9cd9da8\
         self.assertFalse(self.has_exception())
         self.assertEqual(ret.data.decode('utf-8'), "grade=False")
 
+    @httpretty.activate
+    def test_access_to_oauth_resource_read_grade(self):
+        """
+        Check read_grade functionality.
+        """
+        # pylint: disable=maybe-no-member
+        uri = (u'https://example.edu/courses/MITx/ODL_ENG/2014_T1/xblock/'
+               u'i4x:;_;_MITx;_ODL_ENG;_lti;'
+               u'_94173d3e79d145fd8ec2e83f15836ac8/handler_noauth'
+               u'/grade_handler')
+        scores = ['<textString>0.8</textString>', '<textString/>']
+
+        def request_callback(request, cburi, headers):
+            # pylint: disable=unused-argument
+            """
+            Mock readResult response.
+            """
+            self.assertIn(b'<readResultRequest>', request.body)
+            return 200, headers, self.expected_response.replace(
+                '<replaceResultResponse/>',
+                '<readResultResponse><result><resultScore><language>en'
+                '</language>{}</resultScore></result>'
+                '</readResultResponse>'.format(scores.pop(0)))
+
+        httpretty.register_uri(httpretty.POST, uri, body=request_callback)
+
+        url = 'http://localhost/initial?'
+        new_url = self.generate_launch_request(self.consumers, url)
+        self.app.get(new_url)
+
+        ret = self.app.get("/read_grade")
+        self.assertFalse(self.has_exception())
+        self.assertEqual(ret.data.decode('utf-8'), "grade=0.8")
+        ret = self.app.get("/read_grade")
+        self.assertFalse(self.has_exception())
+        self.assertEqual(ret.data.decode('utf-8'), "grade=None")
+
+    @httpretty.activate
+    def test_access_to_oauth_resource_delete_grade(self):
+        """
+        Check delete_grade functionality.
+        """
+        # pylint: disable=maybe-no-member
+        uri = (u'https://example.edu/courses/MITx/ODL_ENG/2014_T1/xblock/'
+               u'i4x:;_;_MITx;_ODL_ENG;_lti;'
+               u'_94173d3e79d145fd8ec2e83f15836ac8/handler_noauth'
+               u'/grade_handler')
+        bodies = []
+
+        def request_callback(request, cburi, headers):
+            """
+            Record request and return success.
+            """
+            bodies.append(request.body)
+            return self.request_callback(request, cburi, headers)
+
+        httpretty.register_uri(httpretty.POST, uri, body=request_callback)
+
+        url = 'http://localhost/initial?'
+        new_url = self.generate_launch_request(self.consumers, url)
+        self.app.get(new_url)
+
+        ret = self.app.get("/delete_grade")
+        self.assertFalse(self.has_exception())
+        self.assertEqual(ret.data.decode('utf-8'), "deleted=True")
+        self.assertIn(b'<deleteResultRequest>', bodies[0])
+        self.assertNotIn(b'<result>', bodies[0])
+
+    @httpretty.activate
+    def test_access_to_oauth_resource_read_grade_fail(self):
+        """
+        Check read_grade fails on invalid response.
+        """
+        # pylint: disable=maybe-no-member
+        uri = (u'https://example.edu/courses/MITx/ODL_ENG/2014_T1/xblock/'
+               u'i4x:;_;_MITx;_ODL_ENG;_lti;'
+               u'_94173d3e79d145fd8ec2e83f15836ac8/handler_noauth'
+               u'/grade_handler')
+        httpretty.register_uri(httpretty.POST, uri, body="wrong_response")
+
+        url = 'http://localhost/initial?'
+        new_url = self.generate_launch_request(self.consumers, url)
+        self.app.get(new_url)
+
+        ret = self.app.get("/read_grade")
+        self.assertTrue(self.has_exception())
+        self.assertEqual(ret.data.decode('utf-8'), "error")
+
+    @httpretty.activate
+    def test_post_grade_acknowledged_skipped(self):
+        """
+        Posting an already acknowledged score is skipped.
+        """
+        # pylint: disable=maybe-no-member
+        uri = (u'https://example.edu/courses/MITx/ODL_ENG/2014_T1/xblock/'
+               u'i4x:;_;_MITx;_ODL_ENG;_lti;'
+               u'_94173d3e79d145fd8ec2e83f15836ac8/handler_noauth'
+               u'/grade_handler')
+
+        posted = []
+
+        def request_callback(request, cburi, headers):
+            """
+            Count posted grades.
+            """
+            posted.append(request)
+            return self.request_callback(request, cburi, headers)
+
+        httpretty.register_uri(httpretty.POST, uri, body=request_callback)
+
+        url = 'http://localhost/initial?'
+        new_url = self.generate_launch_request(self.consumers, url)
+        self.app.get(new_url)
+
+        ret = self.app.get("/post_grade_cached/0.5")
+        self.assertEqual(ret.data.decode('utf-8'), "grade=True")
+        ret = self.app.get("/post_grade_cached/0.5")
+        self.assertEqual(ret.data.decode('utf-8'), "grade=skipped")
+        self.assertEqual(len(posted), 1)
+
+        ret = self.app.get("/post_grade_cached/0.6")
+        self.assertEqual(ret.data.decode('utf-8'), "grade=True")
+        self.assertFalse(self.has_exception())
+        self.assertEqual(len(posted), 2)
+
+    @httpretty.activate
+    def test_post_grade2_acknowledged_skipped(self):
+        """
+        Posting an already acknowledged LTI2 score is skipped.
+        """
+        # pylint: disable=maybe-no-member
+        uri = (u'https://example.edu/courses/MITx/ODL_ENG/2014_T1/xblock/'
+               u'i4x:;_;_MITx;_ODL_ENG;_lti;'
+               u'_94173d3e79d145fd8ec2e83f15836ac8/handler_noauth'
+               u'/lti_2_0_result_rest_handler/user/'
+               u'008437924c9852377e8994829aaac7a1')
+
+        posted = []
+
+        def request_callback(request, cburi, headers):
+            """
+            Count posted grades.
+            """
+            posted.append(request)
+            return self.request_callback(request, cburi, headers)
+
+        httpretty.register_uri(httpretty.PUT, uri, body=request_callback)
+
+        url = 'http://localhost/initial?'
+        new_url = self.generate_launch_request(self.consumers, url)
+        self.app.get(new_url)
+
+        ret = self.app.get("/post_grade2_cached/1.0")
+        self.assertEqual(ret.data.decode('utf-8'), "grade=True")
+        ret = self.app.get("/post_grade2_cached/1.0")
+        self.assertEqual(ret.data.decode('utf-8'), "grade=skipped")
+        self.assertFalse(self.has_exception())
+        self.assertEqual(len(posted), 1)
+
+    @httpretty.activate
+    def test_post_grade_pooled_transport(self):
+        """
+        Grades posted with a transport pool reuse the pooled transport.
+        """
+        uri = (u'https://example.edu/courses/MITx/ODL_ENG/2014_T1/xblock/'
+               u'i4x:;_;_MITx;_ODL_ENG;_lti;'
+               u'_94173d3e79d145fd8ec2e83f15836ac8/handler_noauth'
+               u'/grade_handler')
+        httpretty.register_uri(httpretty.POST, uri,
+                               body=self.request_callback)
+
+        url = 'http://localhost/initial?'
+        new_url = self.generate_launch_request(self.consumers, url)
+        self.app.get(new_url)
+
+        transport = transport_pool.get("__consumer_key__", self.consumers)
+        with mock.patch.object(transport, 'request',
+                               wraps=transport.request) as request:
+            for grade in ("0.5", "0.6"):
+                ret = self.app.get("/post_grade_pooled/" + grade)
+                self.assertEqual(ret.data.decode('utf-8'), "grade=True")
+        self.assertFalse(self.has_exception())
+        self.assertEqual(request.call_count, 2)
+
+    @httpretty.activate
+    def test_post_grade_budget(self):
+        """
+        Grades posted over the latency budget finish in the background.
+        """
+        uri = (u'https://example.edu/courses/MITx/ODL_ENG/2014_T1/xblock/'
+               u'i4x:;_;_MITx;_ODL_ENG;_lti;'
+               u'_94173d3e79d145fd8ec2e83f15836ac8/handler_noauth'
+               u'/grade_handler')
+        latency = []
+
+        def request_callback(request, cburi, headers):
+            # pylint: disable=unused-argument
+            """
+            Mock expected response after latency.
+            """
+            time.sleep(sum(latency))
+            return 200, headers, self.expected_response
+
+        httpretty.register_uri(httpretty.POST, uri, body=request_callback)
+
+        url = 'http://localhost/initial?'
+        new_url = self.generate_launch_request(self.consumers, url)
+        self.app.get(new_url)
+
+        del budget_results[:]
+        ret = self.app.get("/post_grade_budget/0.5")
+        self.assertEqual(ret.data.decode('utf-8'), "grade=True")
+
+        latency.append(0.3)
+        ret = self.app.get("/post_grade_budget/0.6")
+        self.assertEqual(ret.data.decode('utf-8'), "grade=pending")
+        self.assertFalse(self.has_exception())
+        self.assertEqual(budget_results, [])
+        for _ in range(100):
+            if budget_results:
+                break
+            time.sleep(0.01)
+        self.assertEqual(budget_results, [True])
+
+    @httpretty.activate
+    def test_post_grade_defer(self):
+        """
+        Deferred grades are posted after the response was sent.
+        """
+        uri = (u'https://example.edu/courses/MITx/ODL_ENG/2014_T1/xblock/'
+               u'i4x:;_;_MITx;_ODL_ENG;_lti;'
+               u'_94173d3e79d145fd8ec2e83f15836ac8/handler_noauth'
+               u'/grade_handler')
+        responses = [
+            self.expected_response.replace(u'>success<', u'>failure<'),
+            self.expected_response]
+
+        def request_callback(request, cburi, headers):
+            # pylint: disable=unused-argument
+            """
+            Mock expected, then failure response.
+            """
+            return 200, headers, responses.pop()
+
+        httpretty.register_uri(httpretty.POST, uri, body=request_callback)
+
+        url = 'http://localhost/initial?'
+        new_url = self.generate_launch_request(self.consumers, url)
+        self.app.get(new_url)
+
+        del deferred_results[:]
+        ret = self.app.get("/post_grade_defer/0.5")
+        self.assertEqual(ret.data.decode('utf-8'), "grade=deferred")
+        ret.close()
+        ret = self.app.get("/post_grade_defer/0.6")
+        ret.close()
+        self.assertFalse(self.has_exception())
+        self.assertEqual(deferred_results,
+                         [GRADE_DEFERRED, True, GRADE_DEFERRED, False])
+
+        ret = self.app.get("/post_grade_defer/1.5")
+        self.assertEqual(ret.data.decode('utf-8'), "grade=False")
+
     def request_callback(self, request, cburi, headers):
         # pylint: disable=unused-argument
         """
@@ -604,3 +1011,196 @@ edge.edx.org-i4x-StarX-StarX_DEMO-lti-40559041895b4065b2818c23b9cd9da8\
         self.assertEqual(500, response.status_code)
         self.assertEqual("There was an LTI communication error",
                          response.data.decode('utf-8'))
+
+
+class TestPyLTI(unittest.TestCase):
+    """
+    Tests for the PyLTI extension.
+    """
+    consumers = TestFlask.consumers
+
+    def setUp(self):
+        """
+        Create app with PyLTI routes.
+        """
+        app = Flask(__name__)  # pylint: disable=redefined-outer-name
+        app.config['TESTING'] = True
+        app.config['SERVER_NAME'] = 'localhost'
+        app.config['SECRET_KEY'] = 'you-will-never-guess'
+        app.config['PYLTI_CONFIG'] = {'consumers': self.consumers}
+        app.config['PYLTI_URL_FIX'] = {
+            "https://example.edu/": {"https://": "http://"}
+        }
+        self.errors = []
+        self.pylti = PyLTI()
+
+        def error(exception):
+            """
+            Record exception.
+            """
+            self.errors.append(exception['exception'])
+            return "error"
+
+        @app.route("/initial", methods=['GET', 'POST'])
+        @self.pylti.lti(request='initial', error=error)
+        def initial(lti):  # pylint: disable=unused-variable
+            """
+            Return remapped outcome service url.
+            """
+            return lti.response_url
+
+        @app.route("/student")
+        @self.pylti.lti(request='session', error=error, role='student')
+        def student(lti):  # pylint: disable=unused-variable,unused-argument
+            """
+            Student only route.
+            """
+            return "hi"
+
+        self.pylti.init_app(app)
+        self.app = app.test_client()
+
+    def test_launch(self):
+        """
+        Launches are verified with the compiled configuration.
+        """
+        new_url = TestFlask.generate_launch_request(
+            self.consumers, 'http://localhost/initial?')
+        response = self.app.get(new_url)
+        self.assertEqual(self.errors, [])
+        self.assertTrue(response.data.decode('utf-8').startswith(
+            'http://example.edu/courses/'))
+
+        self.app.get('/student')
+        self.assertIsInstance(self.errors.pop(), LTIRoleException)
+
+        new_url = TestFlask.generate_launch_request(
+            self.consumers, 'http://localhost/initial?', roles=u'Learner')
+        self.app.get(new_url)
+        self.assertEqual(self.app.get('/student').data.decode('utf-8'), "hi")
+
+        new_url = TestFlask.generate_launch_request(
+            self.consumers, 'http://localhost/initial?', roles=u'Admin')
+        new_url = new_url.replace('Admin', 'Administrator')
+        self.assertEqual(self.app.get(new_url).data.decode('utf-8'),
+                         "error")
+        self.assertIsInstance(self.errors.pop(), LTIException)
+
+    def test_init_other_app(self):
+        """
+        Apps initialized later use their own configuration.
+        """
+        first = Flask(__name__)
+        first.config['PYLTI_CONFIG'] = {'consumers': {}}
+        pylti = PyLTI(first)
+        app = Flask(__name__)  # pylint: disable=redefined-outer-name
+        app.config.update(TESTING=True, SERVER_NAME='localhost',
+                          SECRET_KEY='you-will-never-guess',
+                          PYLTI_CONFIG={'consumers': self.consumers})
+
+        @app.route("/initial")
+        @pylti.lti(request='initial', error=lambda exception: "error")
+        def initial(lti):  # pylint: disable=unused-variable
+            """
+            Return outcome service url.
+            """
+            return lti.response_url
+
+        pylti.init_app(app)
+        new_url = TestFlask.generate_launch_request(
+            self.consumers, 'http://localhost/initial?')
+        response = app.test_client().get(new_url)
+        self.assertTrue(response.data.decode('utf-8').startswith(
+            'https://example.edu/courses/'))
+
+    def test_unknown_request_or_role(self):
+        """
+        Unknown request types and roles fail at registration.
+        """
+        with self.assertRaises(LTIException):
+            self.pylti.lti(request='notreal')
+        with self.assertRaises(LTIException):
+            self.pylti.lti(role='notreal')
+
+
+class TestLTISessionInterface(unittest.TestCase):
+    """
+    Tests for server-side sessions.
+    """
+    consumers = TestFlask.consumers
+
+    def setUp(self):
+        """
+        Create app keeping sessions in a memory store.
+        """
+        app = Flask(__name__)  # pylint: disable=redefined-outer-name
+        app.config['TESTING'] = True
+        app.config['SERVER_NAME'] = 'localhost'
+        app.config['PYLTI_CONFIG'] = {'consumers': self.consumers}
+        self.store = MemorySessionStore()
+        app.session_interface = LTISessionInterface(self.store)
+
+        @app.route("/initial", methods=['GET', 'POST'])
+        @lti_flask(request='initial', app=app)
+        def initial(lti):  # pylint: disable=unused-variable
+            """
+            Return user id.
+            """
+            return lti.user_id
+
+        @app.route("/session")
+        @lti_flask(request='session', app=app)
+        def session_route(lti):  # pylint: disable=unused-variable
+            """
+            Return user id.
+            """
+            return lti.user_id
+
+        @app.route("/logout")
+        @lti_flask(request='session', app=app)
+        def logout(lti):  # pylint: disable=unused-variable
+            """
+            Close session.
+            """
+            lti.close_session()
+            session.clear()
+            return "bye"
+
+        self.app = app.test_client()
+
+    @staticmethod
+    def session_cookie(response):
+        """
+        Value of the session cookie set by response.
+        """
+        for header in response.headers.getlist('Set-Cookie'):
+            if header.startswith('session='):
+                return header.split(';')[0][len('session='):]
+        return None
+
+    def test_launch_session(self):
+        """
+        Launch parameters are stored server-side under an opaque id.
+        """
+        new_url = TestFlask.generate_launch_request(
+            self.consumers, 'http://localhost/initial?')
+        response = self.app.get(new_url)
+        self.assertEqual(response.data.decode('utf-8'),
+                         u'008437924c9852377e8994829aaac7a1')
+        sid = self.session_cookie(response)
+        self.assertEqual(len(sid), 32)
+        self.assertIn(u'lis_outcome_service_url', self.store.load(sid))
+
+        response = self.app.get('/session')
+        self.assertEqual(response.data.decode('utf-8'),
+                         u'008437924c9852377e8994829aaac7a1')
+        self.assertIsNone(self.session_cookie(response))
+
+        # A new launch moves the session to a new id
+        response = self.app.get(new_url)
+        self.assertNotEqual(self.session_cookie(response), sid)
+        self.assertIsNone(self.store.load(sid))
+        self.assertEqual(len(self.store), 1)
+
+        self.app.get('/logout')
+        self.assertEqual(len(self.store), 0)
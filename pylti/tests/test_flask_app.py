@@ -4,11 +4,20 @@ Test pylti/test_flask_app.py module
 from flask import Flask, session
 
 from pylti.flask import lti as lti_flask
-from pylti.common import LTI_SESSION_KEY
+from pylti.common import LTI_SESSION_KEY, TransportPool
+from pylti.outcome import AcknowledgedScoreCache
+from pylti.target import GradeTargetIndex
 from pylti.tests.test_common import ExceptionHandler
+from pylti.tests.util import recording_warmer
 
 app = Flask(__name__)  # pylint: disable=invalid-name
 app_exception = ExceptionHandler()  # pylint: disable=invalid-name
+ack_cache = AcknowledgedScoreCache()  # pylint: disable=invalid-name
+transport_pool = TransportPool()  # pylint: disable=invalid-name
+warmer = recording_warmer()  # pylint: disable=invalid-name
+budget_results = []  # pylint: disable=invalid-name
+deferred_results = []  # pylint: disable=invalid-name
+grade_targets = GradeTargetIndex()  # pylint: disable=invalid-name
 
 
 def error(exception):
@@ -89,6 +98,82 @@ def initial_route(lti):
     return "hi"
 
 
+@app.route("/initial_prewarm", methods=['GET', 'POST'])
+@lti_flask(error=error, request='initial', app=app, prewarm=warmer)
+def initial_prewarm_route(lti):
+    # pylint: disable=unused-argument,
+    """
+    Access route with 'initial' request and connection warming.
+
+    :param lti: `lti` object
+    :return: string "hi"
+    """
+    return "hi"
+
+
+@app.route("/initial_targets", methods=['GET', 'POST'])
+@lti_flask(error=error, request='initial', app=app,
+           grade_targets=grade_targets)
+def initial_targets_route(lti):
+    # pylint: disable=unused-argument,
+    """
+    Access route with 'initial' request recording grade targets.
+
+    :param lti: `lti` object
+    :return: string "hi"
+    """
+    return "hi"
+
+
+@app.route("/initial_context", methods=['GET', 'POST'])
+@lti_flask(error=error, request='initial', app=app, launch_context=True,
+           capture_custom=True)
+def initial_context_route(lti):
+    """
+    Access route with 'initial' request storing a launch context.
+
+    :param lti: `lti` object
+    :return: custom_color launch parameter
+    """
+    return lti.launch.get('custom_color', '')
+
+
+@app.route("/session_name")
+@lti_flask(error=error, request='session', app=app)
+def session_name(lti):
+    """
+    Access route with 'session' request.
+
+    :param lti: `lti` object
+    :return: name of user
+    """
+    return lti.name
+
+
+@lti_flask(error=error, request='initial', app=app)
+def nested_helper(lti):
+    """
+    LTI wrapped helper called by a wrapped view.
+
+    :param lti: `lti` object
+    :return: user_id
+    """
+    return lti.user_id
+
+
+@app.route("/initial_nested", methods=['GET', 'POST'])
+@lti_flask(error=error, request='initial', app=app)
+def initial_nested(lti):
+    # pylint: disable=unused-argument,
+    """
+    Access route with 'initial' request calling a wrapped helper.
+
+    :param lti: `lti` object
+    :return: user_id from helper
+    """
+    return nested_helper()  # pylint: disable=no-value-for-parameter
+
+
 @app.route("/name", methods=['GET', 'POST'])
 @lti_flask(error=error, request='initial', app=app)
 def name(lti):
@@ -192,6 +277,99 @@ def post_grade2(grade, lti):
     return "grade={}".format(ret)
 
 
+@app.route("/read_grade")
+@lti_flask(error=error, request='session', app=app)
+def read_grade(lti):
+    """
+    Access route with 'session' request.
+
+    :param lti: `lti` object
+    :return: string "grade={}"
+    """
+    ret = lti.read_grade()
+    return "grade={}".format(ret)
+
+
+@app.route("/delete_grade")
+@lti_flask(error=error, request='session', app=app)
+def delete_grade(lti):
+    """
+    Access route with 'session' request.
+
+    :param lti: `lti` object
+    :return: string "deleted={}"
+    """
+    ret = lti.delete_grade()
+    return "deleted={}".format(ret)
+
+
+@app.route("/post_grade_cached/<float:grade>")
+@lti_flask(error=error, request='session', app=app, ack_cache=ack_cache)
+def post_grade_cached(grade, lti):
+    """
+    Access route with 'session' request and acknowledged score cache.
+
+    :param lti: `lti` object
+    :return: string "grade={}"
+    """
+    ret = lti.post_grade(grade)
+    return "grade={}".format(ret)
+
+
+@app.route("/post_grade2_cached/<float:grade>")
+@lti_flask(error=error, request='session', app=app, ack_cache=ack_cache)
+def post_grade2_cached(grade, lti):
+    """
+    Access route with 'session' request and acknowledged score cache.
+
+    :param lti: `lti` object
+    :return: string "grade={}"
+    """
+    ret = lti.post_grade2(grade)
+    return "grade={}".format(ret)
+
+
+@app.route("/post_grade_pooled/<float:grade>")
+@lti_flask(error=error, request='session', app=app,
+           transport_pool=transport_pool)
+def post_grade_pooled(grade, lti):
+    """
+    Access route with 'session' request and pooled transports.
+
+    :param lti: `lti` object
+    :return: string "grade={}"
+    """
+    ret = lti.post_grade(grade)
+    return "grade={}".format(ret)
+
+
+@app.route("/post_grade_budget/<float:grade>")
+@lti_flask(error=error, request='session', app=app)
+def post_grade_budget(grade, lti):
+    """
+    Access route with 'session' request posting within a latency budget.
+
+    :param lti: `lti` object
+    :return: string "grade={}"
+    """
+    ret = lti.post_grade(grade, budget=0.1, callback=budget_results.append)
+    return "grade={}".format(ret)
+
+
+@app.route("/post_grade_defer/<float:grade>")
+@lti_flask(error=error, request='session', app=app)
+def post_grade_defer(grade, lti):
+    """
+    Access route with 'session' request posting after the response.
+
+    :param lti: `lti` object
+    :return: string "grade={}"
+    """
+    ret = lti.post_grade(grade, defer=True, callback=deferred_results.append)
+    deferred_results.append(ret)
+    return "grade={}".format(ret)
+
+
 @app.route("/default_lti")
 @lti_flask
 def default_lti(lti=lti_flask):
@@ -0,0 +1,224 @@
+# -*- coding: utf-8 -*-
+"""
+Test pylti/gateway.py module
+"""
+from __future__ import absolute_import
+import json
+import os
+import shutil
+import tempfile
+import unittest
+
+import oauthlib.oauth1
+import urllib3
+
+from six.moves.urllib.parse import urlencode
+
+from pylti.common import (
+    LAUNCH_HEADER,
+    LaunchContext,
+    LTIException,
+    sign_launch,
+    verify_launch,
+)
+from pylti.gateway import Gateway, create_gateway, load_config
+
+SECRET = 'gateway-secret'
+
+
+def upstream_app(environ, start_response):
+    """
+    WSGI application answering with the request it received.
+    """
+    header = environ.get('HTTP_' + LAUNCH_HEADER.upper().replace('-', '_'))
+    length = int(environ.get('CONTENT_LENGTH') or 0)
+    echo = {
+        'path': environ['PATH_INFO'],
+        'query': environ.get('QUERY_STRING', ''),
+        'body': environ['wsgi.input'].read(length).decode('utf-8'),
+        'user_id': verify_launch(header, SECRET).user_id if header else None,
+    }
+    body = json.dumps(echo).encode('utf-8')
+    start_response('200 OK', [('Content-Type', 'application/json'),
+                              ('Content-Length', str(len(body))),
+                              ('Set-Cookie', 'a=1'), ('Set-Cookie', 'b=2')])
+    return [body]
+
+
+class TestLaunchHeader(unittest.TestCase):
+    """
+    Tests for signed launch headers
+    """
+
+    def test_verify_launch(self):
+        """
+        Launch headers are only accepted unaltered, with the shared secret
+        and before they expire.
+        """
+        context = LaunchContext.from_params(
+            {'user_id': u'student', 'custom_color': u'blue'}, True)
+        value = sign_launch(context, SECRET)
+        launch = verify_launch(value, SECRET)
+        self.assertEqual(launch.user_id, u'student')
+        self.assertEqual(launch.get('custom_color'), u'blue')
+
+        payload, signature = value.split('.')
+        for forged in (value + 'x', payload + '.' + signature[::-1],
+                       payload[:-2] + '.' + signature, 'nonsense', None):
+            with self.assertRaises(LTIException):
+                verify_launch(forged, SECRET)
+        with self.assertRaises(LTIException):
+            verify_launch(value, 'other-secret')
+        with self.assertRaises(LTIException):
+            verify_launch(sign_launch(context, SECRET, ttl=-1), SECRET)
+
+
+class TestGateway(unittest.TestCase):
+    """
+    Tests for the gateway in front of an upstream server
+    """
+    consumers = {
+        "__consumer_key__": {"secret": "__lti_secret__"}
+    }
+
+    def setUp(self):
+        """
+        Start upstream and gateway servers.
+        """
+        self.upstream = Gateway(upstream_app).start()
+        self.gateway = Gateway(create_gateway(
+            self.consumers, {'/': self.upstream.url}, SECRET,
+            paths=['/launch'])).start()
+        self.http = urllib3.PoolManager(retries=False)
+
+    def tearDown(self):
+        """
+        Stop servers.
+        """
+        self.gateway.stop()
+        self.upstream.stop()
+
+    def sign(self, path, secret='__lti_secret__'):
+        """
+        Launch form signed in its body.
+        """
+        params = {'lti_message_type': u'basic-lti-launch-request',
+                  'user_id': u'student', 'roles': u'Learner'}
+        client = oauthlib.oauth1.Client(
+            '__consumer_key__', client_secret=secret,
+            signature_type=oauthlib.oauth1.SIGNATURE_TYPE_BODY)
+        _, headers, body = client.sign(
+            self.gateway.url + path, http_method='POST',
+            body=urlencode(params),
+            headers={'Content-Type': 'application/x-www-form-urlencoded'})
+        return headers, body
+
+    def request(self, method, path, **kwargs):
+        """
+        Send request to gateway, return status and decoded echo.
+        """
+        response = self.http.request(method, self.gateway.url + path,
+                                     **kwargs)
+        if response.headers.get('Content-Type') != 'application/json':
+            return response.status, None
+        return response.status, json.loads(response.data.decode('utf-8'))
+
+    def test_launch(self):
+        """
+        Verified launches are forwarded with the signed launch context,
+        replayed launches are rejected.
+        """
+        headers, body = self.sign('/launch')
+        status, echo = self.request('POST', '/launch', body=body,
+                                    headers=headers)
+        self.assertEqual(status, 200)
+        self.assertEqual(echo['user_id'], u'student')
+        self.assertIn('lti_message_type', echo['body'])
+
+        status, _ = self.request('POST', '/launch', body=body,
+                                 headers=headers)
+        self.assertEqual(status, 403)
+
+        headers, body = self.sign('/launch', secret='wrong')
+        status, _ = self.request('POST', '/launch', body=body,
+                                 headers=headers)
+        self.assertEqual(status, 403)
+
+    def test_passthrough(self):
+        """
+        Other requests are forwarded without launch headers from clients.
+        """
+        forged = sign_launch(LaunchContext.from_params(
+            {'user_id': u'admin'}), SECRET)
+        response = self.http.request(
+            'GET', self.gateway.url + '/page/a?b=c',
+            headers={LAUNCH_HEADER: forged})
+        self.assertEqual(response.status, 200)
+        self.assertEqual(response.headers.getlist('Set-Cookie'),
+                         ['a=1', 'b=2'])
+        echo = json.loads(response.data.decode('utf-8'))
+        self.assertEqual((echo['path'], echo['query'], echo['user_id']),
+                         ('/page/a', 'b=c', None))
+
+    def test_upstream_errors(self):
+        """
+        Unknown paths and failing upstreams are answered by the gateway.
+        """
+        with Gateway(create_gateway(
+                self.consumers, {'/app': self.upstream.url}, SECRET,
+                ['/app/launch'], timeout=1)) as gateway:
+            response = self.http.request('GET', gateway.url + '/other')
+            self.assertEqual(response.status, 404)
+            self.upstream.stop()
+            response = self.http.request('GET', gateway.url + '/app')
+            self.assertEqual(response.status, 502)
+
+
+class TestLoadConfig(unittest.TestCase):
+    """
+    Tests for gateway config files
+    """
+
+    def setUp(self):
+        """
+        Create temporary directory for configs.
+        """
+        self.directory = tempfile.mkdtemp()
+        self.path = os.path.join(self.directory, 'gateway.json')
+
+    def tearDown(self):
+        """
+        Remove temporary directory.
+        """
+        shutil.rmtree(self.directory)
+
+    def write(self, config):
+        """
+        Write config file.
+        """
+        with open(self.path, 'w') as config_file:
+            json.dump(config, config_file)
+
+    def test_load_config(self):
+        """
+        Configs need consumers, upstreams, secret and launch paths.
+        """
+        self.write({'consumers': {'key': {'secret': 'secret'}},
+                    'secret': SECRET})
+        with self.assertRaises(LTIException):
+            load_config(self.path)
+        self.write({'consumers': {'key': {'secret': 'secret'}},
+                    'upstreams': {'/': 'http://localhost:8001'},
+                    'secret': SECRET})
+        with self.assertRaises(LTIException):
+            load_config(self.path)
+
+        self.write({'consumers': {'key': {'secret': 'secret'}},
+                    'upstreams': {'/': 'http://localhost:8001'},
+                    'secret': SECRET, 'paths': ['/launch'], 'ttl': 30,
+                    'nonce_db': os.path.join(self.directory, 'nonces.db')})
+        app = load_config(self.path)
+        self.assertEqual(app.paths, frozenset(['/launch']))
+        self.assertEqual(app.app.ttl, 30)
+        self.assertTrue(app.nonce_store.add('key', 'nonce'))
+        app.nonce_store.close()
@@ -0,0 +1,391 @@
+# -*- coding: utf-8 -*-
+"""
+Test pylti/outcome.py module
+"""
+from __future__ import absolute_import
+import re
+import time
+import unittest
+
+import httpretty
+
+from pylti.common import generate_request_xml, post_message
+from pylti.fake_lms import FakeLMS
+from pylti.transport import Httplib2Transport
+from pylti.outcome import (
+    AcknowledgedScoreCache,
+    GradeCoalescer,
+    ResultsReader,
+)
+
+
+SUCCESS_RESPONSE = """<?xml version="1.0" encoding="UTF-8"?>
+<imsx_POXEnvelopeResponse xmlns="http://www.imsglobal.org/services/ltiv1p1\
+/xsd/imsoms_v1p0">
+    <imsx_POXHeader>
+        <imsx_POXResponseHeaderInfo>
+            <imsx_version>V1.0</imsx_version>
+            <imsx_messageIdentifier>edX_fix</imsx_messageIdentifier>
+            <imsx_statusInfo>
+                <imsx_codeMajor>success</imsx_codeMajor>
+                <imsx_severity>status</imsx_severity>
+                <imsx_description>ok</imsx_description>
+            </imsx_statusInfo>
+        </imsx_POXResponseHeaderInfo>
+    </imsx_POXHeader>
+    <imsx_POXBody>{}</imsx_POXBody>
+</imsx_POXEnvelopeResponse>
+"""
+
+
+class TestAcknowledgedScoreCache(unittest.TestCase):
+    """
+    Tests for AcknowledgedScoreCache
+    """
+
+    def test_acknowledged(self):
+        """
+        Only the exact acknowledged score and comment match.
+        """
+        cache = AcknowledgedScoreCache()
+        self.assertFalse(cache.is_acknowledged("key", "sourced", 0.5))
+        cache.acknowledge("key", "sourced", 0.5)
+        self.assertTrue(cache.is_acknowledged("key", "sourced", 0.5))
+        self.assertFalse(cache.is_acknowledged("key", "sourced", 0.6))
+        self.assertFalse(cache.is_acknowledged("key", "sourced", 0.5, "x"))
+        self.assertFalse(cache.is_acknowledged("other", "sourced", 0.5))
+        self.assertEqual((cache.hits, cache.misses), (1, 4))
+
+    def test_ttl(self):
+        """
+        Acknowledgements expire after ttl.
+        """
+        cache = AcknowledgedScoreCache(ttl=-1)
+        cache.acknowledge("key", "sourced", 0.5)
+        self.assertFalse(cache.is_acknowledged("key", "sourced", 0.5))
+        self.assertEqual(len(cache), 0)
+
+    def test_bounded_per_consumer(self):
+        """
+        Least recently used entries are evicted per consumer key.
+        """
+        cache = AcknowledgedScoreCache(maxsize=2)
+        cache.acknowledge("key", "first", 0.1)
+        cache.acknowledge("key", "second", 0.2)
+        cache.acknowledge("other", "first", 0.1)
+        self.assertTrue(cache.is_acknowledged("key", "first", 0.1))
+        cache.acknowledge("key", "third", 0.3)
+        self.assertTrue(cache.is_acknowledged("key", "first", 0.1))
+        self.assertFalse(cache.is_acknowledged("key", "second", 0.2))
+        self.assertTrue(cache.is_acknowledged("other", "first", 0.1))
+        self.assertEqual(len(cache), 3)
+
+    def test_invalidate(self):
+        """
+        Invalidated acknowledgement no longer matches.
+        """
+        cache = AcknowledgedScoreCache()
+        cache.acknowledge("key", "sourced", 0.5)
+        cache.invalidate("key", "sourced")
+        cache.invalidate("unknown", "sourced")
+        self.assertFalse(cache.is_acknowledged("key", "sourced", 0.5))
+
+
+class TestGradeCoalescer(unittest.TestCase):
+    """
+    Tests for GradeCoalescer
+    """
+    consumers = {
+        "__consumer_key__": {"secret": "__lti_secret__"}
+    }
+    uri = 'https://localhost:8000/grade_handler'
+
+    success_response = SUCCESS_RESPONSE.format('<replaceResultResponse/>')
+
+    def setUp(self):
+        """
+        Collect posted bodies and callback results.
+        """
+        self.bodies = []
+        self.results = []
+
+    def request_callback(self, request, cburi, headers):
+        # pylint: disable=unused-argument
+        """
+        Record request body and return success response.
+        """
+        self.bodies.append(request.body.decode('utf-8'))
+        return 200, headers, self.success_response
+
+    def callback(self, lti_key, lis_result_sourcedid, score, success):
+        """
+        Record coalescer callback.
+        """
+        self.results.append((lti_key, lis_result_sourcedid, score, success))
+
+    @httpretty.activate
+    def test_only_latest_score_posted(self):
+        """
+        Several scores for the same sourcedid collapse to the last one.
+        """
+        httpretty.register_uri(httpretty.POST, self.uri,
+                               body=self.request_callback)
+        coalescer = GradeCoalescer(delay=60, callback=self.callback,
+                                   flush_at_exit=False)
+        for grade in (0.1, 0.5, 0.7):
+            self.assertTrue(coalescer.submit(
+                self.consumers, "__consumer_key__", self.uri, "sourced",
+                grade))
+        self.assertEqual(coalescer.pending, 1)
+        coalescer.flush()
+        coalescer.close()
+
+        self.assertEqual(len(self.bodies), 1)
+        self.assertIn('<textString>0.7</textString>', self.bodies[0])
+        self.assertEqual(self.results,
+                         [("__consumer_key__", "sourced", 0.7, True)])
+
+    @httpretty.activate
+    def test_distinct_sourcedids_posted_separately(self):
+        """
+        Scores for different sourcedids are not merged.
+        """
+        httpretty.register_uri(httpretty.POST, self.uri,
+                               body=self.request_callback)
+        coalescer = GradeCoalescer(delay=60, flush_at_exit=False)
+        coalescer.submit(self.consumers, "__consumer_key__", self.uri,
+                         "first", 0.1)
+        coalescer.submit(self.consumers, "__consumer_key__", self.uri,
+                         "second", 0.2)
+        self.assertEqual(coalescer.pending, 2)
+        coalescer.close()
+        self.assertEqual(len(self.bodies), 2)
+        self.assertEqual(coalescer.pending, 0)
+
+    @httpretty.activate
+    def test_posted_after_debounce(self):
+        """
+        Background worker posts grade once the window passed.
+        """
+        httpretty.register_uri(httpretty.POST, self.uri,
+                               body=self.request_callback)
+        coalescer = GradeCoalescer(delay=0.05, callback=self.callback,
+                                   flush_at_exit=False)
+        coalescer.submit(self.consumers, "__consumer_key__", self.uri,
+                         "sourced", 0.3)
+        for _ in range(100):
+            if self.results:
+                break
+            time.sleep(0.02)
+        coalescer.close()
+        self.assertEqual(self.results,
+                         [("__consumer_key__", "sourced", 0.3, True)])
+
+    @httpretty.activate
+    def test_failing_callback_keeps_worker(self):
+        """
+        Grades keep being posted in the background after the callback
+        raised.
+        """
+        httpretty.register_uri(httpretty.POST, self.uri,
+                               body=self.request_callback)
+
+        def callback(*args):
+            """
+            Record the result, then fail.
+            """
+            self.callback(*args)
+            raise ValueError("callback failed")
+
+        coalescer = GradeCoalescer(delay=0.05, callback=callback,
+                                   flush_at_exit=False)
+        for sourcedid in ("first", "second"):
+            coalescer.submit(self.consumers, "__consumer_key__", self.uri,
+                             sourcedid, 0.3)
+            for _ in range(100):
+                if sourcedid in [result[1] for result in self.results]:
+                    break
+                time.sleep(0.02)
+        self.assertEqual([result[1] for result in self.results],
+                         ["first", "second"])
+        coalescer.close()
+
+    @httpretty.activate
+    def test_acknowledged_grade_not_posted(self):
+        """
+        Coalesced grade already acknowledged is not posted again.
+        """
+        httpretty.register_uri(httpretty.POST, self.uri,
+                               body=self.request_callback)
+        cache = AcknowledgedScoreCache()
+        coalescer = GradeCoalescer(delay=60, flush_at_exit=False,
+                                   ack_cache=cache)
+        for _ in range(2):
+            coalescer.submit(self.consumers, "__consumer_key__", self.uri,
+                             "sourced", 0.9)
+            coalescer.flush()
+        coalescer.close()
+        self.assertEqual(len(self.bodies), 1)
+        self.assertTrue(cache.is_acknowledged("__consumer_key__", "sourced",
+                                              0.9))
+
+    def test_invalid_grade(self):
+        """
+        Out of range grades are rejected and not queued.
+        """
+        coalescer = GradeCoalescer(flush_at_exit=False)
+        self.assertFalse(coalescer.submit(
+            self.consumers, "__consumer_key__", self.uri, "sourced", 2.0))
+        self.assertEqual(coalescer.pending, 0)
+        coalescer.close()
+
+    @httpretty.activate
+    def test_failed_post_reported(self):
+        """
+        Unsuccessful post is reported through the callback.
+        """
+        httpretty.register_uri(httpretty.POST, self.uri, body="failure")
+        coalescer = GradeCoalescer(delay=60, callback=self.callback,
+                                   flush_at_exit=False)
+        coalescer.submit(self.consumers, "__consumer_key__", self.uri,
+                         "sourced", 0.4)
+        coalescer.close()
+        self.assertEqual(self.results,
+                         [("__consumer_key__", "sourced", 0.4, False)])
+
+    @httpretty.activate
+    def test_submit_after_close_posts_immediately(self):
+        """
+        Grades submitted after close are not lost.
+        """
+        httpretty.register_uri(httpretty.POST, self.uri,
+                               body=self.request_callback)
+        coalescer = GradeCoalescer(delay=60, flush_at_exit=False)
+        coalescer.close()
+        coalescer.submit(self.consumers, "__consumer_key__", self.uri,
+                         "sourced", 1.0)
+        self.assertEqual(len(self.bodies), 1)
+
+
+class TestResultsReader(unittest.TestCase):
+    """
+    Tests for ResultsReader
+    """
+    consumers = {
+        "__consumer_key__": {"secret": "__lti_secret__"}
+    }
+    uri = 'https://localhost:8000/grade_handler'
+
+    def setUp(self):
+        """
+        Collect requested sourcedids.
+        """
+        self.requested = []
+
+    def request_callback(self, request, cburi, headers):
+        # pylint: disable=unused-argument
+        """
+        Return score encoded in sourcedid, fail for "broken".
+        """
+        sourcedid = re.search(r'<sourcedId>(.*)</sourcedId>',
+                              request.body.decode('utf-8')).group(1)
+        self.requested.append(sourcedid)
+        if sourcedid == 'broken':
+            return 500, headers, 'error'
+        if sourcedid == 'empty':
+            text_string = '<textString/>'
+        else:
+            text_string = '<textString>0.{}</textString>'.format(sourcedid)
+        return 200, headers, SUCCESS_RESPONSE.format(
+            '<readResultResponse><result><resultScore><language>en'
+            '</language>{}</resultScore></result>'
+            '</readResultResponse>'.format(text_string))
+
+    @httpretty.activate
+    def test_read_results(self):
+        """
+        Results of many sourcedids are read and cached.
+        """
+        httpretty.register_uri(httpretty.POST, self.uri,
+                               body=self.request_callback)
+        # httpretty is not thread safe, keep a single worker
+        reader = ResultsReader(self.consumers, workers=1)
+        sourcedids = [str(number) for number in range(1, 20)]
+        results = reader.read_results("__consumer_key__", self.uri,
+                                      sourcedids + ['empty', 'broken'])
+        self.assertEqual(len(self.requested), 21)
+        for sourcedid in sourcedids:
+            self.assertTrue(results[sourcedid])
+            self.assertEqual(results[sourcedid].score,
+                             float('0.' + sourcedid))
+        self.assertTrue(results['empty'])
+        self.assertIsNone(results['empty'].score)
+        self.assertFalse(results['broken'])
+
+        # Successful results are served from cache, failures are retried
+        results = reader.read_results("__consumer_key__", self.uri,
+                                      sourcedids + ['broken'])
+        self.assertEqual(len(self.requested), 22)
+        self.assertEqual(results['1'].score, 0.1)
+
+        reader.invalidate("__consumer_key__", '1')
+        self.assertEqual(
+            reader.read_result("__consumer_key__", self.uri, '1').score, 0.1)
+        self.assertEqual(len(self.requested), 23)
+        reader.close()
+
+    @httpretty.activate
+    def test_read_result_expired(self):
+        """
+        Expired results are read again.
+        """
+        httpretty.register_uri(httpretty.POST, self.uri,
+                               body=self.request_callback)
+        reader = ResultsReader(self.consumers, ttl=-1)
+        reader.read_result("__consumer_key__", self.uri, '5')
+        reader.read_result("__consumer_key__", self.uri, '5')
+        self.assertEqual(self.requested, ['5', '5'])
+
+    def test_read_result_unknown_consumer(self):
+        """
+        Unknown consumer key gives failed result.
+        """
+        reader = ResultsReader(self.consumers)
+        response = reader.read_result("unknown", self.uri, '5')
+        self.assertFalse(response)
+        self.assertIsNotNone(response.error)
+
+    def test_read_results_concurrently(self):
+        """
+        Workers read results concurrently from a live outcome service.
+        """
+        with FakeLMS(self.consumers, latency=0.02) as lms:
+            sourcedids = [str(number) for number in range(40)]
+            for sourcedid in sourcedids:
+                post_message(self.consumers, "__consumer_key__",
+                             lms.outcome_url, generate_request_xml(
+                                 u'edX_fix', 'replaceResult', sourcedid,
+                                 int(sourcedid) / 100.0))
+            transports = []
+
+            def factory(cert=None):
+                """
+                Record created transports.
+                """
+                transports.append(Httplib2Transport(cert=cert))
+                return transports[-1]
+
+            reader = ResultsReader(self.consumers, workers=8,
+                                   transport_factory=factory)
+            results = reader.read_results("__consumer_key__",
+                                          lms.outcome_url, sourcedids)
+            reader.close()
+        # Every worker's connection is closed
+        self.assertTrue(transports)
+        self.assertEqual([transport.http.connections
+                          for transport in transports],
+                         [{}] * len(transports))
+        self.assertEqual(dict((sourcedid, result.score)
+                              for sourcedid, result in results.items()),
+                         lms.grades)
+        self.assertGreater(lms.max_in_flight, 1)
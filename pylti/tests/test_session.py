@@ -0,0 +1,122 @@
+# -*- coding: utf-8 -*-
+"""
+Test pylti/session.py module
+"""
+from __future__ import absolute_import
+import os
+import shutil
+import tempfile
+import unittest
+
+from pylti.session import (
+    MemoryNonceStore,
+    MemorySessionStore,
+    SQLiteNonceStore,
+    SQLiteSessionStore,
+    new_session_id,
+)
+
+
+class TestSessionStores(unittest.TestCase):
+    """
+    Tests for session stores
+    """
+
+    def setUp(self):
+        """
+        Create temporary directory for SQLite stores.
+        """
+        self.directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        """
+        Remove temporary directory.
+        """
+        shutil.rmtree(self.directory)
+
+    def test_new_session_id(self):
+        """
+        Session ids are random hex strings.
+        """
+        session_id = new_session_id()
+        self.assertEqual(len(session_id), 32)
+        int(session_id, 16)
+        self.assertNotEqual(session_id, new_session_id())
+
+    def test_memory_store(self):
+        """
+        Least recently used and expired sessions are dropped.
+        """
+        store = MemorySessionStore(maxsize=2)
+        store.save('a', '{"user_id": "a"}')
+        store.save('b', '{"user_id": "b"}')
+        self.assertEqual(store.load('a'), '{"user_id": "a"}')
+        store.save('c', '{"user_id": "c"}')
+        self.assertIsNone(store.load('b'))
+        self.assertEqual(len(store), 2)
+        store.delete('a')
+        self.assertIsNone(store.load('a'))
+
+        store.ttl = -1
+        store.save('d', '{}')
+        self.assertIsNone(store.load('d'))
+        self.assertEqual(len(store), 1)
+
+    def test_sqlite_store(self):
+        """
+        Sessions are shared through the database file until they expire.
+        """
+        path = os.path.join(self.directory, 'sessions.db')
+        store = SQLiteSessionStore(path)
+        store.save('a', '{"user_id": "a"}')
+        self.assertEqual(SQLiteSessionStore(path).load('a'),
+                         '{"user_id": "a"}')
+        store.save('a', '{"user_id": "b"}')
+        self.assertEqual(store.load('a'), '{"user_id": "b"}')
+        store.delete('a')
+        self.assertIsNone(store.load('a'))
+
+        store.ttl = -1
+        store.purge_interval = 2
+        store.save('b', '{}')
+        self.assertIsNone(store.load('b'))
+        self.assertEqual(len(store), 1)
+        store.save('c', '{}')
+        self.assertEqual(len(store), 0)
+        store.close()
+
+    def test_memory_nonce_store(self):
+        """
+        Nonces are accepted once per consumer until they expire.
+        """
+        store = MemoryNonceStore(maxsize=2)
+        self.assertTrue(store.add('key', 'a'))
+        self.assertFalse(store.add('key', 'a'))
+        self.assertTrue(store.add('other', 'a'))
+        self.assertFalse(store.add('key', None))
+        self.assertTrue(store.add('key', 'b'))
+        self.assertEqual(len(store), 2)
+
+        store.ttl = -1
+        self.assertTrue(store.add('key', 'c'))
+        self.assertTrue(store.add('key', 'c'))
+        self.assertEqual(len(store), 2)
+
+    def test_sqlite_nonce_store(self):
+        """
+        Nonces are shared through the database file until they expire.
+        """
+        path = os.path.join(self.directory, 'nonces.db')
+        store = SQLiteNonceStore(path, purge_interval=3)
+        self.assertTrue(store.add('key', 'a'))
+        self.assertFalse(SQLiteNonceStore(path).add('key', 'a'))
+        self.assertTrue(store.add('other', 'a'))
+        self.assertFalse(store.add('key', ''))
+
+        store.ttl = -1
+        self.assertTrue(store.add('key', 'b'))
+        self.assertTrue(store.add('key', 'b'))
+        self.assertEqual(len(store), 3)
+        self.assertEqual(store.purge(), 1)
+        self.assertEqual(len(store), 2)
+        store.close()
@@ -0,0 +1,59 @@
+# -*- coding: utf-8 -*-
+"""
+Test pylti/sqlite.py module
+"""
+from __future__ import absolute_import
+import os
+import shutil
+import sqlite3
+import tempfile
+import unittest
+
+from pylti.sqlite import SQLiteStore
+
+
+class ItemStore(SQLiteStore):
+    """
+    Store of a single table.
+    """
+    SCHEMA = ('CREATE TABLE IF NOT EXISTS item (name TEXT PRIMARY KEY)',)
+    TABLE = 'item'
+
+    def add(self, name):
+        """
+        Store item.
+        """
+        with self._lock, self._connection:
+            self._connection.execute('INSERT INTO item VALUES (?)', (name,))
+
+
+class TestSQLiteStore(unittest.TestCase):
+    """
+    Tests for SQLiteStore
+    """
+
+    def setUp(self):
+        """
+        Create temporary directory for databases.
+        """
+        self.directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        """
+        Remove temporary directory.
+        """
+        shutil.rmtree(self.directory)
+
+    def test_store(self):
+        """
+        Tables are created once and shared through the database file.
+        """
+        path = os.path.join(self.directory, 'items.db')
+        store = ItemStore(path)
+        store.add('a')
+        other = ItemStore(path)
+        self.assertEqual((len(store), len(other)), (1, 1))
+        other.close()
+        store.close()
+        with self.assertRaises(sqlite3.ProgrammingError):
+            len(store)
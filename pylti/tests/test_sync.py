@@ -0,0 +1,176 @@
+# -*- coding: utf-8 -*-
+"""
+Test pylti/sync.py module
+"""
+from __future__ import absolute_import
+import re
+import unittest
+
+import httpretty
+
+from pylti.outcome import ResultsReader
+from pylti.sync import GradeLedger, GradebookSync
+from pylti.tests.test_outcome import SUCCESS_RESPONSE
+
+
+class TestGradeLedger(unittest.TestCase):
+    """
+    Tests for GradeLedger
+    """
+
+    def test_record(self):
+        """
+        Recorded scores are returned per consumer key.
+        """
+        ledger = GradeLedger()
+        self.assertIsNone(ledger.get("key", "sourced"))
+        ledger.record("key", "sourced", 0.5)
+        ledger.record("key", "sourced", 0.7)
+        self.assertEqual(ledger.get("key", "sourced"), 0.7)
+        self.assertIsNone(ledger.get("other", "sourced"))
+
+        sourcedids = [str(number) for number in range(2000)]
+        ledger.record_many("key", [(sourcedid, 0.1)
+                                   for sourcedid in sourcedids])
+        self.assertEqual(len(ledger.get_many("key", sourcedids)), 2000)
+        ledger.close()
+
+    def test_checkpoint(self):
+        """
+        Checkpoints are stored and cleared by name.
+        """
+        ledger = GradeLedger()
+        self.assertEqual(ledger.get_checkpoint("nightly"), 0)
+        ledger.set_checkpoint("nightly", 500)
+        self.assertEqual(ledger.get_checkpoint("nightly"), 500)
+        ledger.clear_checkpoint("nightly")
+        self.assertEqual(ledger.get_checkpoint("nightly"), 0)
+
+
+class TestGradebookSync(unittest.TestCase):
+    """
+    Tests for GradebookSync
+    """
+    consumers = {
+        "__consumer_key__": {"secret": "__lti_secret__"}
+    }
+    uri = 'https://localhost:8000/grade_handler'
+
+    def setUp(self):
+        """
+        Collect posted grades and set up consumer state.
+        """
+        self.posted = []
+        self.lms_scores = {}
+
+    def request_callback(self, request, cburi, headers):
+        # pylint: disable=unused-argument
+        """
+        Fake outcome service storing scores in lms_scores.
+        """
+        body = request.body.decode('utf-8')
+        sourcedid = re.search(r'<sourcedId>(.*)</sourcedId>',
+                              body).group(1)
+        if '<readResultRequest>' in body:
+            score = self.lms_scores.get(sourcedid)
+            text_string = ('<textString/>' if score is None else
+                           '<textString>{}</textString>'.format(score))
+            return 200, headers, SUCCESS_RESPONSE.format(
+                '<readResultResponse><result><resultScore>{}'
+                '</resultScore></result></readResultResponse>'.format(
+                    text_string))
+        score = float(re.search(r'<textString>(.*)</textString>',
+                                body).group(1))
+        self.posted.append((sourcedid, score))
+        self.lms_scores[sourcedid] = score
+        return 200, headers, SUCCESS_RESPONSE.format(
+            '<replaceResultResponse/>')
+
+    def test_needs_state(self):
+        """
+        Either ledger or reader is required.
+        """
+        with self.assertRaises(ValueError):
+            GradebookSync(self.consumers)
+        sync = GradebookSync(self.consumers,
+                             reader=ResultsReader(self.consumers))
+        with self.assertRaises(ValueError):
+            sync.sync("__consumer_key__", self.uri, {}, name="nightly")
+
+    @httpretty.activate
+    def test_sync_with_ledger(self):
+        """
+        Only scores that changed since the last sync are posted.
+        """
+        httpretty.register_uri(httpretty.POST, self.uri,
+                               body=self.request_callback)
+        # httpretty is not thread safe, keep a single worker
+        sync = GradebookSync(self.consumers, ledger=GradeLedger(),
+                             workers=1, batch_size=3)
+        scores = dict(('s{}'.format(number), number / 10.0)
+                      for number in range(10))
+
+        result = sync.sync("__consumer_key__", self.uri, scores)
+        self.assertEqual((result.checked, result.posted, result.unchanged),
+                         (10, 10, 0))
+        self.assertEqual(len(self.posted), 10)
+
+        scores['s3'] = 0.35
+        result = sync.sync("__consumer_key__", self.uri, scores)
+        self.assertEqual((result.checked, result.posted, result.unchanged),
+                         (10, 1, 9))
+        self.assertEqual(self.posted[-1], ('s3', 0.35))
+        sync.close()
+
+    @httpretty.activate
+    def test_sync_with_reader(self):
+        """
+        Consumer state is read back when no ledger is used.
+        """
+        httpretty.register_uri(httpretty.POST, self.uri,
+                               body=self.request_callback)
+        self.lms_scores = {'a': 0.5, 'b': 0.2}
+        reader = ResultsReader(self.consumers, workers=1)
+        sync = GradebookSync(self.consumers, reader=reader, workers=1)
+        result = sync.sync("__consumer_key__", self.uri,
+                           [('a', 0.5), ('b', 0.3), ('c', 1.0)])
+        self.assertEqual(sorted(self.posted), [('b', 0.3), ('c', 1.0)])
+        self.assertEqual((result.posted, result.unchanged), (2, 1))
+
+        result = sync.sync("__consumer_key__", self.uri,
+                           [('a', 0.5), ('b', 0.3), ('c', 1.0)])
+        self.assertEqual((result.posted, result.unchanged), (0, 3))
+        sync.close()
+        reader.close()
+
+    @httpretty.activate
+    def test_sync_resumes_from_checkpoint(self):
+        """
+        Named sync skips entries processed before it was interrupted.
+        """
+        httpretty.register_uri(httpretty.POST, self.uri,
+                               body=self.request_callback)
+        ledger = GradeLedger()
+        ledger.set_checkpoint("nightly", 2)
+        sync = GradebookSync(self.consumers, ledger=ledger, workers=1,
+                             batch_size=2)
+        result = sync.sync("__consumer_key__", self.uri,
+                           [('a', 0.1), ('b', 0.2), ('c', 0.3), ('d', 0.4)],
+                           name="nightly")
+        self.assertEqual(result.resumed_at, 2)
+        self.assertEqual(self.posted, [('c', 0.3), ('d', 0.4)])
+        self.assertEqual(ledger.get_checkpoint("nightly"), 0)
+
+    @httpretty.activate
+    def test_sync_failures(self):
+        """
+        Invalid scores and rejected posts are reported and not recorded.
+        """
+        httpretty.register_uri(httpretty.POST, self.uri, body="error")
+        ledger = GradeLedger()
+        sync = GradebookSync(self.consumers, ledger=ledger, workers=1)
+        result = sync.sync("__consumer_key__", self.uri,
+                           [('a', 0.1), ('b', 2.0)])
+        self.assertEqual(sorted(result.failed), ['a', 'b'])
+        self.assertEqual(result.posted, 0)
+        self.assertIsNone(ledger.get("__consumer_key__", 'a'))
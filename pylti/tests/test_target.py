@@ -0,0 +1,104 @@
+# -*- coding: utf-8 -*-
+"""
+Test pylti/target.py module
+"""
+from __future__ import absolute_import
+import os
+import shutil
+import tempfile
+import unittest
+
+from pylti.common import GRADE_SKIPPED, LTIPostMessageException
+from pylti.fake_lms import FakeLMS
+from pylti.outcome import AcknowledgedScoreCache
+from pylti.target import GradeTarget, GradeTargetIndex, post_grade_to
+
+
+class TestGradeTarget(unittest.TestCase):
+    """
+    Tests for GradeTarget and post_grade_to
+    """
+    consumers = {
+        "__consumer_key__": {"secret": "__lti_secret__"}
+    }
+
+    def test_serialization(self):
+        """
+        Targets survive JSON round trips.
+        """
+        target = GradeTarget(u'__consumer_key__', u'https://lms/grade',
+                             u'sourcedid', u'user', u'link')
+        self.assertEqual(GradeTarget.loads(target.dumps()), target)
+        self.assertEqual(GradeTarget.from_dict(target.to_dict()), target)
+        self.assertNotEqual(GradeTarget(u'__consumer_key__', u'url', u's'),
+                            target)
+        self.assertEqual(len(set([target, GradeTarget.loads(
+            target.dumps())])), 1)
+
+    def test_post_grade_to(self):
+        """
+        Grades are posted to targets without a session.
+        """
+        ack_cache = AcknowledgedScoreCache()
+        with FakeLMS(self.consumers) as lms:
+            target = GradeTarget(u'__consumer_key__', lms.outcome_url,
+                                 u'sourcedid')
+            self.assertTrue(post_grade_to(target, 0.5, self.consumers,
+                                          ack_cache=ack_cache))
+            self.assertEqual(post_grade_to(target, 0.5, self.consumers,
+                                           ack_cache=ack_cache),
+                             GRADE_SKIPPED)
+            self.assertFalse(post_grade_to(target, 1.5, self.consumers))
+            self.assertEqual(lms.grades, {u'sourcedid': 0.5})
+            self.assertEqual(lms.request_count, 1)
+
+            with self.assertRaises(LTIPostMessageException):
+                post_grade_to(target, 0.7, {"__consumer_key__": {
+                    "secret": "wrong"}}, ack_cache=ack_cache)
+            self.assertFalse(ack_cache.is_acknowledged(
+                u'__consumer_key__', u'sourcedid', 0.5))
+
+
+class TestGradeTargetIndex(unittest.TestCase):
+    """
+    Tests for GradeTargetIndex
+    """
+
+    def setUp(self):
+        """
+        Create temporary directory for the index.
+        """
+        self.directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        """
+        Remove temporary directory.
+        """
+        shutil.rmtree(self.directory)
+
+    def test_index(self):
+        """
+        Latest target of every user and resource link is kept on disk.
+        """
+        path = os.path.join(self.directory, 'targets.db')
+        index = GradeTargetIndex(path)
+        index.add(GradeTarget(u'key', u'https://lms/a', u's1', u'u1', u'l1'))
+        index.add(GradeTarget(u'key', u'https://lms/b', u's2', u'u1', u'l1'))
+        index.add(GradeTarget(u'key', u'https://lms/a', u's3', u'u2', u'l1'))
+        index.add(GradeTarget(u'key', u'https://lms/a', u's4', u'u1', u'l2'))
+        index.add(GradeTarget(u'other', u'https://lms/a', u's5', u'u1',
+                              u'l1'))
+        index.close()
+
+        index = GradeTargetIndex(path)
+        self.assertEqual(len(index), 4)
+        self.assertEqual(index.get(u'key', u'u1', u'l1').lis_result_sourcedid,
+                         u's2')
+        self.assertIsNone(index.get(u'key', u'u3', u'l1'))
+        self.assertEqual(
+            [t.lis_result_sourcedid for t in index.targets(u'key', u'l1')],
+            [u's2', u's3'])
+        self.assertEqual(len(index.targets(u'key')), 3)
+        index.remove(u'key', u'u1', u'l1')
+        self.assertIsNone(index.get(u'key', u'u1', u'l1'))
+        index.close()
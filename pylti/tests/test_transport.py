@@ -0,0 +1,295 @@
+# -*- coding: utf-8 -*-
+"""
+Test pylti/transport.py module
+"""
+from __future__ import absolute_import
+import threading
+import time
+import unittest
+
+from pylti.exceptions import (
+    LTICircuitOpenException,
+    LTIException,
+    LTIPostMessageException,
+)
+from pylti.transport import (
+    GRADE_PENDING,
+    RATE_LIMITERS,
+    BackgroundPoster,
+    CircuitBreaker,
+    CircuitBreakerRegistry,
+    ConcurrencyLimiter,
+    ConnectionWarmer,
+    TokenBucket,
+    Transport,
+    TransportPool,
+    consumer_timeouts,
+    create_transport,
+)
+from pylti.tests.util import WarmRecordingTransport
+
+
+class TestTransport(unittest.TestCase):
+    """
+    Tests for transport.py
+    """
+
+    def test_circuit_breaker(self):
+        """
+        Circuit opens after consecutive failures and closes after trial
+        """
+        breaker = CircuitBreaker(failure_threshold=2, reset_timeout=0.05)
+        breaker.before_request()
+        breaker.record(False)
+        breaker.before_request()
+        breaker.record(True)
+        self.assertEqual(breaker.failures, 0)
+        for _ in range(2):
+            breaker.before_request()
+            breaker.record(False)
+        self.assertEqual(breaker.state, CircuitBreaker.OPEN)
+        with self.assertRaises(LTICircuitOpenException):
+            breaker.before_request('https://lms')
+
+        time.sleep(0.06)
+        self.assertEqual(breaker.state, CircuitBreaker.HALF_OPEN)
+        breaker.before_request()
+        # Only one trial request at a time
+        with self.assertRaises(LTICircuitOpenException):
+            breaker.before_request()
+        breaker.record(False)
+        self.assertEqual(breaker.state, CircuitBreaker.OPEN)
+
+        time.sleep(0.06)
+        breaker.before_request()
+        breaker.record(True)
+        self.assertEqual(breaker.state, CircuitBreaker.CLOSED)
+        breaker.before_request()
+
+    def test_circuit_breaker_slow_calls(self):
+        """
+        Slow calls count as failures
+        """
+        breaker = CircuitBreaker(failure_threshold=1, slow_call_threshold=1)
+        breaker.before_request()
+        breaker.record(True, latency=0.5)
+        self.assertEqual(breaker.state, CircuitBreaker.CLOSED)
+        breaker.before_request()
+        breaker.record(True, latency=2)
+        self.assertEqual(breaker.state, CircuitBreaker.OPEN)
+        self.assertEqual(breaker.last_latency, 2)
+        breaker.reset()
+        self.assertEqual(breaker.state, CircuitBreaker.CLOSED)
+
+    def test_circuit_breaker_registry(self):
+        """
+        Every host has its own circuit breaker
+        """
+        registry = CircuitBreakerRegistry(failure_threshold=1)
+        first = registry.get('https://lms.example.edu/grade/1')
+        self.assertIs(first, registry.get('https://lms.example.edu/grade/2'))
+        self.assertIsNot(first, registry.get('http://lms.example.edu/'))
+        first.record(False)
+        self.assertEqual(registry.states()['https://lms.example.edu'],
+                         CircuitBreaker.OPEN)
+        self.assertEqual(registry.states()['http://lms.example.edu'],
+                         CircuitBreaker.CLOSED)
+        registry.configure(enabled=False)
+        self.assertIsNone(registry.get('https://lms.example.edu/'))
+
+    def test_concurrency_limit_grows(self):
+        """
+        Limit grows while saturated with flat latency and stops growing
+        when latency rises
+        """
+        limiter = ConcurrencyLimiter(initial_limit=2, max_limit=4)
+        for _ in range(10):
+            markers = [limiter.acquire() for _ in range(int(limiter.limit))]
+            # Constant latency of 10ms
+            for marker in markers:
+                limiter.release(marker - 0.01, True)
+        self.assertEqual(limiter.stats()['limit'], 4)
+        self.assertEqual(limiter.stats()['in_flight'], 0)
+
+        limiter = ConcurrencyLimiter(initial_limit=1)
+        limiter.release(limiter.acquire(), True)
+        limiter.latency = limiter.min_latency = 0.01
+        limiter.release(limiter.acquire() - 1, True)
+        self.assertGreater(limiter.latency, 0.1)
+        limit = limiter.limit
+        limiter.release(limiter.acquire(), True)
+        self.assertEqual(limiter.limit, limit)
+
+    def test_concurrency_limit_backoff(self):
+        """
+        Overload halves the limit once per round of requests
+        """
+        limiter = ConcurrencyLimiter(initial_limit=8)
+        markers = [limiter.acquire() for _ in range(4)]
+        for marker in markers:
+            limiter.release(marker, False)
+        self.assertEqual(limiter.stats()['limit'], 4)
+
+        limiter.release(limiter.acquire(), False)
+        self.assertEqual(limiter.stats()['limit'], 2)
+        limiter.release(limiter.acquire(), None)
+        self.assertEqual(limiter.stats()['limit'], 2)
+        for _ in range(3):
+            limiter.release(limiter.acquire(), False)
+        self.assertEqual(limiter.stats()['limit'], 1)
+
+    def test_concurrency_limit_waits(self):
+        """
+        Requests over the limit wait for a free slot until deadline
+        """
+        limiter = ConcurrencyLimiter(initial_limit=1)
+        marker = limiter.acquire()
+        with self.assertRaises(LTIPostMessageException):
+            limiter.acquire(deadline=time.time() + 0.05)
+
+        acquired = []
+        thread = threading.Thread(
+            target=lambda: acquired.append(limiter.acquire()))
+        thread.start()
+        time.sleep(0.05)
+        self.assertEqual(acquired, [])
+        limiter.release(marker)
+        thread.join(1)
+        self.assertEqual(len(acquired), 1)
+        self.assertEqual(limiter.stats()['in_flight'], 1)
+
+    def test_token_bucket(self):
+        """
+        Requests beyond the burst wait for tokens at the configured rate
+        """
+        bucket = TokenBucket(rate=50, burst=2)
+        started = time.time()
+        waited = [bucket.acquire() for _ in range(6)]
+        self.assertEqual(waited[:2], [0, 0])
+        self.assertGreaterEqual(time.time() - started, 0.07)
+        with self.assertRaises(LTIPostMessageException):
+            bucket.acquire(deadline=time.time())
+        self.assertEqual(TokenBucket(rate=0.5).burst, 1)
+
+    def test_token_bucket_registry(self):
+        """
+        Consumers with a rate get a token bucket, recreated on change
+        """
+        consumers = {
+            "limited": {"secret": "secret", "rate": 10, "burst": 5},
+            "unlimited": {"secret": "secret"},
+        }
+        bucket = RATE_LIMITERS.get(consumers, "limited")
+        self.assertEqual((bucket.rate, bucket.burst), (10, 5))
+        self.assertIs(RATE_LIMITERS.get(consumers, "limited"), bucket)
+        self.assertIsNone(RATE_LIMITERS.get(consumers, "unlimited"))
+        consumers["limited"]["rate"] = 20
+        self.assertIsNot(RATE_LIMITERS.get(consumers, "limited"), bucket)
+        RATE_LIMITERS.clear()
+
+    def test_background_poster(self):
+        """
+        Posts ending within budget return their result, slower posts
+        report it to the callback
+        """
+        poster = BackgroundPoster(workers=2)
+        results = []
+        self.assertTrue(poster.run(lambda: True, 1, results.append))
+
+        def fail():
+            """ Post failing after delay """
+            time.sleep(0.1)
+            raise LTIPostMessageException("Post Message Failed")
+
+        with self.assertRaises(LTIPostMessageException):
+            poster.run(fail, 1, results.append)
+        self.assertEqual(poster.run(fail, 0.01, results.append),
+                         GRADE_PENDING)
+        self.assertEqual(poster.run(lambda: time.sleep(0.1) or True, 0.01,
+                                    results.append), GRADE_PENDING)
+        self.assertEqual(results, [])
+        poster.close()
+        self.assertEqual(sorted(results), [False, True])
+
+    def test_transport_interface(self):
+        """
+        Transports without request fail when they are created
+        """
+        class Incomplete(Transport):  # pylint: disable=abstract-method
+            """ Transport missing request """
+
+        with self.assertRaises(TypeError):
+            Incomplete()
+
+    def test_transport_pool_shared(self):
+        """
+        Shared pool gives all threads the same transport
+        """
+        consumers = {"key": {"secret": "secret"}}
+        with self.assertRaises(ValueError):
+            TransportPool(consumers, shared=True)
+        for shared in (False, True):
+            pool = TransportPool(consumers, factory=WarmRecordingTransport,
+                                 shared=shared)
+            transports = [pool.get("key")]
+            thread = threading.Thread(
+                target=lambda: transports.append(pool.get("key")))
+            thread.start()
+            thread.join()
+            self.assertEqual(transports[0] is transports[1], shared)
+
+    def test_connection_warmer(self):
+        """
+        Hosts are warmed in the background once per ttl
+        """
+        consumers = {"key": {"secret": "secret"}}
+        with self.assertRaises(ValueError):
+            ConnectionWarmer(TransportPool())
+        del WarmRecordingTransport.warmed[:]
+        warmer = ConnectionWarmer(TransportPool(
+            factory=WarmRecordingTransport, shared=True))
+        self.assertTrue(warmer.warm(consumers, "key", 'https://lms/a'))
+        self.assertFalse(warmer.warm(consumers, "key", 'https://lms/b'))
+        self.assertTrue(warmer.warm(consumers, "key", 'https://other/a'))
+        # Unknown consumer fails in the background and is tried again
+        self.assertTrue(warmer.warm(consumers, "unknown", 'https://lms/a'))
+        warmer.close()
+        self.assertTrue(warmer.warm(consumers, "unknown", 'https://lms/a'))
+        warmer.close()
+        self.assertEqual(sorted(WarmRecordingTransport.warmed),
+                         ['https://lms/a', 'https://other/a'])
+
+        warmer.ttl = -1
+        self.assertTrue(warmer.warm(consumers, "key", 'https://lms/a'))
+        warmer.close()
+
+    def test_consumer_timeouts(self):
+        """
+        Timeouts are read from consumer config
+        """
+        consumers = {
+            "none": {"secret": "secret"},
+            "both": {"secret": "secret", "timeout": 5},
+            "split": {"secret": "secret", "timeout": 5,
+                      "connect_timeout": 1},
+        }
+        self.assertEqual(consumer_timeouts(consumers, "none"), (None, None))
+        self.assertEqual(consumer_timeouts(consumers, "both"), (5, 5))
+        self.assertEqual(consumer_timeouts(consumers, "split"), (1, 5))
+        self.assertEqual(consumer_timeouts(consumers, "unknown"),
+                         (None, None))
+
+    def test_create_transport(self):
+        """
+        Transports get the client certificate of known consumers only
+        """
+        consumers = {'key': {'secret': 'secret', 'cert': 'cert.pem'},
+                     'nosecret': {'cert': 'cert.pem'}}
+        transport = create_transport(consumers, 'key',
+                                     factory=WarmRecordingTransport)
+        self.assertEqual(transport.cert, 'cert.pem')
+        for key in ('nosecret', 'unknown'):
+            with self.assertRaises(LTIException):
+                create_transport(consumers, key)
+        with self.assertRaises(LTIException):
+            create_transport(None, 'key')
@@ -0,0 +1,113 @@
+# -*- coding: utf-8 -*-
+"""
+Test pylti/urllib3.py module
+"""
+from __future__ import absolute_import
+import socket
+import ssl
+import time
+import unittest
+
+from pylti.common import (
+    TLS_CONTEXTS,
+    LTITimeoutException,
+    LTITransportException,
+    generate_request_xml,
+    post_message,
+)
+from pylti.fake_lms import FakeLMS
+from pylti.tests.util import TEST_SERVER_CERT
+from pylti.urllib3 import Urllib3Transport
+
+
+class TestUrllib3Transport(unittest.TestCase):
+    """
+    Tests for Urllib3Transport
+    """
+    consumers = {
+        "__consumer_key__": {"secret": "__lti_secret__"}
+    }
+
+    def test_post_message(self):
+        """
+        Signed outcome requests are accepted and connections reused.
+        """
+        transport = Urllib3Transport(maxsize=2)
+        with FakeLMS(self.consumers) as lms:
+            for score in (0.1, 0.2):
+                xml = generate_request_xml(u'message_id', 'replaceResult',
+                                           'sourced', score)
+                self.assertTrue(post_message(
+                    self.consumers, "__consumer_key__", lms.outcome_url,
+                    xml, transport=transport))
+            self.assertEqual(lms.grades, {'sourced': 0.2})
+            pool = transport.pool.connection_from_url(lms.url)
+            self.assertEqual(pool.num_connections, 1)
+        transport.close()
+
+    def test_timeout(self):
+        """
+        Read timeout raises LTITimeoutException.
+        """
+        with FakeLMS(latency=0.5) as lms:
+            started = time.time()
+            with self.assertRaises(LTITimeoutException):
+                Urllib3Transport().request(lms.outcome_url, 'POST', b'', {},
+                                           read_timeout=0.05)
+            self.assertLess(time.time() - started, 0.5)
+
+    def test_connection_error(self):
+        """
+        Refused connection raises LTITransportException.
+        """
+        sock = socket.socket()
+        sock.bind(('127.0.0.1', 0))
+        url = 'http://127.0.0.1:{}/'.format(sock.getsockname()[1])
+        sock.close()
+        with self.assertRaises(LTITransportException) as context:
+            Urllib3Transport().request(url, 'POST', b'', {})
+        self.assertNotIsInstance(context.exception, LTITimeoutException)
+
+    def test_warm(self):
+        """
+        Warmed connection is reused by the first request.
+        """
+        transport = Urllib3Transport()
+        with FakeLMS(self.consumers, connect_latency=0.2) as lms:
+            transport.warm(lms.outcome_url, timeout=1)
+            time.sleep(0.3)
+            started = time.time()
+            self.assertTrue(post_message(
+                self.consumers, "__consumer_key__", lms.outcome_url,
+                generate_request_xml(u'message_id', 'replaceResult',
+                                     'sourced', 0.5),
+                transport=transport))
+            self.assertLess(time.time() - started, 0.2)
+            self.assertEqual(lms.connection_count, 1)
+        transport.close()
+
+    def test_client_cert_tls(self):
+        """
+        Transports of a certificate share its SSL context and resume
+        TLS sessions.
+        """
+        server_context = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
+        server_context.load_cert_chain(TEST_SERVER_CERT)
+        server_context.verify_mode = ssl.CERT_REQUIRED
+        server_context.load_verify_locations(TEST_SERVER_CERT)
+        TLS_CONTEXTS.configure(cafile=TEST_SERVER_CERT)
+        try:
+            with FakeLMS(self.consumers, ssl_context=server_context) as lms:
+                for _ in range(2):
+                    transport = Urllib3Transport(cert=TEST_SERVER_CERT)
+                    self.assertIs(transport.pool.connection_pool_kw[
+                        'ssl_context'], TLS_CONTEXTS.get(TEST_SERVER_CERT))
+                    self.assertTrue(post_message(
+                        self.consumers, "__consumer_key__", lms.outcome_url,
+                        generate_request_xml(u'message_id', 'replaceResult',
+                                             'sourced', 0.5),
+                        transport=transport))
+                    transport.close()
+            self.assertEqual(lms.resumed_count, 1)
+        finally:
+            TLS_CONTEXTS.configure()
@@ -0,0 +1,176 @@
+# -*- coding: utf-8 -*-
+"""
+Test pylti/wsgi.py module
+"""
+from __future__ import absolute_import
+import unittest
+from io import BytesIO
+from wsgiref.util import setup_testing_defaults
+
+import mock
+import oauthlib.oauth1
+from flask import Flask, request
+
+from six.moves.urllib.parse import urlencode
+
+from pylti.common import verify_request_common
+from pylti.flask import lti
+from pylti.wsgi import LAUNCH_ENVIRON_KEY, LTIMiddleware
+
+
+def error_app(environ, start_response):
+    """
+    WSGI application answering invalid launches.
+    """
+    start_response('401 Unauthorized', [('Content-Type', 'text/plain')])
+    return [str(environ['pylti.error']).encode('utf-8')]
+
+
+class TestLTIMiddleware(unittest.TestCase):
+    """
+    Tests for LTIMiddleware
+    """
+    consumers = {
+        "__consumer_key__": {"secret": "__lti_secret__"}
+    }
+
+    def setUp(self):
+        """
+        Create app behind the middleware.
+        """
+        app = Flask(__name__)
+        app.config['TESTING'] = True
+        app.config['SERVER_NAME'] = 'localhost'
+        app.config['SECRET_KEY'] = 'you-will-never-guess'
+        app.config['PYLTI_CONFIG'] = {'consumers': self.consumers}
+        self.middleware = LTIMiddleware(app.wsgi_app, self.consumers,
+                                        paths=['/launch', '/view'],
+                                        capture_custom=True)
+        app.wsgi_app = self.middleware
+        self.calls = []
+
+        @app.route("/launch", methods=['POST'])
+        def launch():  # pylint: disable=unused-variable
+            """
+            Return user_id and custom parameter of the launch.
+            """
+            self.calls.append(request.form.get('user_id'))
+            context = request.environ[LAUNCH_ENVIRON_KEY]
+            return u'{} {}'.format(context.user_id,
+                                   context.get('custom_color'))
+
+        @app.route("/view", methods=['POST'])
+        @lti(request='initial', app=app)
+        def view(lti):  # pylint: disable=unused-variable,redefined-outer-name
+            """
+            Return user_id of the LTI session.
+            """
+            return lti.user_id
+
+        self.app = app.test_client()
+
+    def launch(self, path, secret='__lti_secret__', **kwargs):
+        """
+        POST a launch form signed in its body.
+        """
+        params = {'lti_message_type': u'basic-lti-launch-request',
+                  'user_id': u'student', 'custom_color': u'blue',
+                  'roles': u'Learner'}
+        client = oauthlib.oauth1.Client(
+            '__consumer_key__', client_secret=secret,
+            signature_type=oauthlib.oauth1.SIGNATURE_TYPE_BODY)
+        _, headers, body = client.sign(
+            'http://localhost' + path, http_method='POST',
+            body=urlencode(params),
+            headers={'Content-Type': 'application/x-www-form-urlencoded'})
+        return self.app.post(path, data=body, headers=headers, **kwargs)
+
+    def test_verified_launch(self):
+        """
+        Verified launches reach the app with their launch context.
+        """
+        response = self.launch('/launch')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.data.decode('utf-8'), u'student blue')
+        # The form can still be read by the application
+        self.assertEqual(self.calls, [u'student'])
+
+    def test_flask_trusts_middleware(self):
+        """
+        The Flask wrapper does not verify launches again.
+        """
+        with mock.patch('pylti.flask.verify_request_common',
+                        wraps=verify_request_common) as verify:
+            response = self.launch('/view')
+        self.assertEqual(response.data.decode('utf-8'), u'student')
+        self.assertEqual(verify.call_count, 0)
+
+    def test_rejected_launch(self):
+        """
+        Invalid launches never reach the app.
+        """
+        response = self.launch('/launch', secret='wrong')
+        self.assertEqual(response.status_code, 403)
+        self.assertEqual(self.calls, [])
+
+        self.middleware.error = error_app
+        response = self.launch('/launch', secret='wrong')
+        self.assertEqual(response.status_code, 401)
+        self.assertIn(b'OAuth error', response.data)
+
+        response = self.app.post(
+            '/launch', data=b'user_id=\xff\xfe',
+            content_type='application/x-www-form-urlencoded')
+        self.assertEqual(response.status_code, 400)
+
+        self.middleware.max_size = 10
+        self.assertEqual(self.launch('/launch').status_code, 413)
+        self.assertEqual(self.calls, [])
+
+    def test_other_requests(self):
+        """
+        Requests to other paths and methods are passed on.
+        """
+        self.assertEqual(self.launch('/other').status_code, 404)
+        self.assertEqual(self.app.get('/launch').status_code, 405)
+
+    def test_any_path(self):
+        """
+        Without launch paths, forms that are no launches reach the app
+        untouched whatever their size.
+        """
+        received = []
+
+        def echo_app(environ, start_response):
+            """
+            Record the body read from the environ.
+            """
+            received.append(environ['wsgi.input'].read())
+            start_response('200 OK', [('Content-Type', 'text/plain')])
+            return [b'ok']
+
+        middleware = LTIMiddleware(echo_app, self.consumers)
+        essay = b'essay=' + b'a' * 70000
+        for body, length in ((essay, str(len(essay))), (essay, None),
+                             (b'essay=\xff', '7'),
+                             (b'lti_message_type=x', None)):
+            environ = {'REQUEST_METHOD': 'POST', 'PATH_INFO': '/submit',
+                       'CONTENT_TYPE': 'application/x-www-form-urlencoded',
+                       'wsgi.input': BytesIO(body)}
+            if length is not None:
+                environ['CONTENT_LENGTH'] = length
+            setup_testing_defaults(environ)
+            statuses = []
+            middleware(environ,
+                       lambda status, headers: statuses.append(status))
+            self.assertEqual(statuses, ['200 OK'])
+            self.assertEqual(received.pop(), body)
+
+        environ = {'REQUEST_METHOD': 'POST', 'PATH_INFO': '/submit',
+                   'CONTENT_TYPE': 'application/x-www-form-urlencoded',
+                   'CONTENT_LENGTH': '18',
+                   'wsgi.input': BytesIO(b'lti_message_type=x')}
+        setup_testing_defaults(environ)
+        statuses = []
+        middleware(environ, lambda status, headers: statuses.append(status))
+        self.assertEqual(statuses, ['403 Forbidden'])
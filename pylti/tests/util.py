@@ -5,6 +5,14 @@ Test pylti/test_common.py module
 
 
 import os
+from xml.etree import ElementTree as etree
+
+from pylti.common import (
+    ConnectionWarmer,
+    LTITransportException,
+    Transport,
+    TransportPool,
+)
 
 
 TEST_DATA_ROOT = os.path.join(
@@ -13,3 +21,72 @@ TEST_DATA_ROOT = os.path.join(
 )
 
 TEST_CLIENT_CERT = os.path.join(TEST_DATA_ROOT, 'certs', 'snakeoil.pem')
+
+# Self-signed certificate with key for localhost and 127.0.0.1
+TEST_SERVER_CERT = os.path.join(TEST_DATA_ROOT, 'certs', 'localhost.pem')
+
+
+def generate_request_xml_etree(message_identifier_id, operation,
+                               lis_result_sourcedid, score):
+    # pylint: disable=too-many-locals
+    """
+    ElementTree implementation of
+    :py:func:`pylti.common.generate_request_xml`, used as the reference
+    for parity tests and benchmarks.
+    """
+    root = etree.Element(u'imsx_POXEnvelopeRequest',
+                         xmlns=u'http://www.imsglobal.org/services/'
+                               u'ltiv1p1/xsd/imsoms_v1p0')
+
+    header = etree.SubElement(root, 'imsx_POXHeader')
+    header_info = etree.SubElement(header, 'imsx_POXRequestHeaderInfo')
+    version = etree.SubElement(header_info, 'imsx_version')
+    version.text = 'V1.0'
+    message_identifier = etree.SubElement(header_info,
+                                          'imsx_messageIdentifier')
+    message_identifier.text = message_identifier_id
+    body = etree.SubElement(root, 'imsx_POXBody')
+    xml_request = etree.SubElement(body, '%s%s' % (operation, 'Request'))
+    record = etree.SubElement(xml_request, 'resultRecord')
+
+    guid = etree.SubElement(record, 'sourcedGUID')
+
+    sourcedid = etree.SubElement(guid, 'sourcedId')
+    sourcedid.text = lis_result_sourcedid
+    if score is not None:
+        result = etree.SubElement(record, 'result')
+        result_score = etree.SubElement(result, 'resultScore')
+        language = etree.SubElement(result_score, 'language')
+        language.text = 'en'
+        text_string = etree.SubElement(result_score, 'textString')
+        text_string.text = score.__str__()
+    return "<?xml version='1.0' encoding='utf-8'?>\n{}".format(
+        etree.tostring(root, encoding='utf-8').decode('utf-8'))
+
+
+class WarmRecordingTransport(Transport):
+    """
+    Transport recording urls it was asked to warm.
+    """
+    thread_safe = True
+    warmed = []
+
+    def __init__(self, cert=None):
+        self.cert = cert
+
+    def request(self, url, method, body, headers, connect_timeout=None,
+                read_timeout=None):
+        # pylint: disable=too-many-arguments
+        raise LTITransportException("WarmRecordingTransport does not send")
+
+    def warm(self, url, timeout=None):
+        WarmRecordingTransport.warmed.append(url)
+
+
+def recording_warmer():
+    """
+    Connection warmer recording warmed urls in
+    ``WarmRecordingTransport.warmed``.
+    """
+    return ConnectionWarmer(TransportPool(factory=WarmRecordingTransport,
+                                          shared=True))
@@ -0,0 +1,1029 @@
+# -*- coding: utf-8 -*-
+"""
+Outcome request transports and the resilience around them: circuit
+breakers, concurrency and rate limits, client certificate SSL contexts,
+connection pools and warming, and background grade posting
+"""
+
+from __future__ import absolute_import
+
+import abc
+import atexit
+import logging
+import math
+import socket
+import ssl
+import threading
+import time
+import weakref
+from multiprocessing.pool import ThreadPool
+
+import httplib2
+from six import add_metaclass
+from six.moves import http_client
+from six.moves.urllib.parse import urlparse
+
+from .exceptions import (
+    LTICircuitOpenException,
+    LTIException,
+    LTIPostMessageException,
+    LTITimeoutException,
+    LTITransportException,
+)
+
+log = logging.getLogger('pylti.transport')  # pylint: disable=invalid-name
+
+# Returned by post_grade/post_grade2 when the consumer did not answer
+# within the latency budget and the post continues in the background
+GRADE_PENDING = u'pending'
+
+# Monotonic clock where available, used for durations and timeouts
+_clock = getattr(time, 'monotonic', time.time)  # pylint: disable=invalid-name
+
+
+class CircuitBreaker(object):
+    """
+    Circuit breaker of a single outcome service host.
+
+    The circuit opens after ``failure_threshold`` consecutive failures;
+    connection errors, 5xx responses and, when ``slow_call_threshold`` is
+    set, responses slower than that many seconds count as failures.
+    While open, requests fail fast with LTICircuitOpenException.  After
+    ``reset_timeout`` seconds the circuit is half-open and lets up to
+    ``half_open_calls`` trial requests through; a successful trial closes
+    the circuit, a failed one opens it again.
+    """
+    CLOSED = 'closed'
+    OPEN = 'open'
+    HALF_OPEN = 'half-open'
+
+    def __init__(self, failure_threshold=5, reset_timeout=30.0,
+                 slow_call_threshold=None, half_open_calls=1):
+        """
+        :param failure_threshold: consecutive failures opening the circuit
+        :param reset_timeout: seconds before trial requests are allowed
+        :param slow_call_threshold: seconds after which a call is a failure
+        :param half_open_calls: concurrent trial requests when half-open
+        """
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.slow_call_threshold = slow_call_threshold
+        self.half_open_calls = half_open_calls
+        self.failures = 0
+        self.last_latency = None
+        self._state = self.CLOSED
+        self._opened_at = None
+        self._trials = 0
+        self._lock = threading.Lock()
+
+    @property
+    def state(self):
+        """
+        Current state, one of CLOSED, OPEN and HALF_OPEN
+
+        :return: state
+        """
+        with self._lock:
+            if (self._state == self.OPEN and
+                    _clock() - self._opened_at >= self.reset_timeout):
+                return self.HALF_OPEN
+            return self._state
+
+    def before_request(self, host=None):
+        """
+        Reserve permission to send request
+
+        :param host: host name used in error message
+        :exception: LTICircuitOpenException if the circuit is open
+        """
+        with self._lock:
+            if self._state == self.CLOSED:
+                return
+            if (self._state == self.OPEN and
+                    _clock() - self._opened_at >= self.reset_timeout):
+                self._state = self.HALF_OPEN
+                self._trials = 0
+            if (self._state == self.HALF_OPEN and
+                    self._trials < self.half_open_calls):
+                self._trials += 1
+                return
+        raise LTICircuitOpenException(
+            "Outcome service {} is unavailable".format(host or ''))
+
+    def record(self, success, latency=None):
+        """
+        Record result of a request let through by before_request
+
+        :param success: request succeeded
+        :param latency: request duration in seconds
+        """
+        if latency is not None:
+            self.last_latency = latency
+            if (self.slow_call_threshold is not None and
+                    latency > self.slow_call_threshold):
+                success = False
+        with self._lock:
+            if self._state == self.HALF_OPEN:
+                self._trials -= 1
+            if success:
+                self.failures = 0
+                self._state = self.CLOSED
+                return
+            self.failures += 1
+            if (self._state == self.HALF_OPEN or
+                    self.failures >= self.failure_threshold):
+                if self._state != self.OPEN:
+                    log.warning("Opening circuit after %d failures",
+                                self.failures)
+                self._state = self.OPEN
+                self._opened_at = _clock()
+
+    def reset(self):
+        """
+        Close the circuit
+        """
+        with self._lock:
+            self.failures = 0
+            self._state = self.CLOSED
+
+
+class HostRegistry(object):
+    """
+    Per host objects of outcome service hosts, created on first use with
+    the registry settings by ``factory``.
+    """
+    factory = None
+
+    def __init__(self, enabled=True, **settings):
+        """
+        :param enabled: use the registry for outcome requests
+        :param settings: ``factory`` arguments
+        """
+        self.enabled = enabled
+        self.settings = settings
+        self._items = {}
+        self._lock = threading.Lock()
+
+    def configure(self, enabled=True, **settings):
+        """
+        Change settings and forget existing per host objects
+
+        :param enabled: use the registry for outcome requests
+        :param settings: ``factory`` arguments
+        """
+        with self._lock:
+            self.enabled = enabled
+            self.settings = settings
+            self._items = {}
+
+    @staticmethod
+    def host(url):
+        """
+        Host key of outcome service url
+
+        :param url: outcome service url
+        :return: scheme and network location
+        """
+        parts = urlparse(url)
+        return u'{}://{}'.format(parts.scheme, parts.netloc)
+
+    def get(self, url):
+        """
+        Object for host of url
+
+        :param url: outcome service url
+        :return: ``factory`` instance or None if disabled
+        """
+        if not self.enabled:
+            return None
+        host = self.host(url)
+        item = self._items.get(host)
+        if item is None:
+            with self._lock:
+                item = self._items.get(host)
+                if item is None:
+                    item = self._items[host] = self.factory(**self.settings)
+        return item
+
+    def _snapshot(self):
+        """
+        Known hosts and their objects
+
+        :return: list of (host, object)
+        """
+        with self._lock:
+            return list(self._items.items())
+
+
+class CircuitBreakerRegistry(HostRegistry):
+    """
+    Circuit breakers of all outcome service hosts, created on first use
+    with the registry settings.
+    """
+    factory = CircuitBreaker
+
+    def states(self):
+        """
+        State of every known host
+
+        :return: dict mapping host to circuit state
+        """
+        return dict((host, breaker.state)
+                    for host, breaker in self._snapshot())
+
+
+# Circuit breakers used by all outcome requests of this process
+CIRCUIT_BREAKERS = CircuitBreakerRegistry()
+
+
+class ConcurrencyLimiter(object):
+    """
+    Adaptive limit of concurrent requests to a single outcome service host.
+
+    The limit grows additively, by ``increase`` per ``limit`` successful
+    requests, while all allowed requests are in use and the smoothed
+    latency stays within ``latency_tolerance`` times the lowest latency
+    seen.  Timeouts, 429 and 5xx responses multiply the limit by
+    ``backoff``, at most once per round of requests started after the
+    previous decrease.  Requests over the limit wait for a free slot.
+    """
+    # pylint: disable=too-many-instance-attributes
+
+    def __init__(self, initial_limit=8, min_limit=1, max_limit=64,
+                 increase=1.0, backoff=0.5, latency_tolerance=2.0,
+                 smoothing=0.2):
+        """
+        :param initial_limit: concurrent requests allowed at first
+        :param min_limit: lowest limit
+        :param max_limit: highest limit
+        :param increase: limit growth per round of successful requests
+        :param backoff: factor applied to the limit on overload
+        :param latency_tolerance: smoothed to lowest latency ratio above
+            which the limit stops growing
+        :param smoothing: weight of a new sample in the smoothed latency
+        """
+        # pylint: disable=too-many-arguments
+        self.min_limit = min_limit
+        self.max_limit = max_limit
+        self.increase = increase
+        self.backoff = backoff
+        self.latency_tolerance = latency_tolerance
+        self.smoothing = smoothing
+        self.limit = float(initial_limit)
+        self.in_flight = 0
+        self.latency = None
+        self.min_latency = None
+        self._decreased_at = None
+        self._condition = threading.Condition()
+
+    def acquire(self, deadline=None):
+        """
+        Wait for a free slot
+
+        :param deadline: absolute time.time() by which a slot is needed
+        :return: start marker to pass to release
+        :exception: LTIPostMessageException if deadline passed
+        """
+        with self._condition:
+            while self.in_flight >= int(self.limit):
+                self._condition.wait(_remaining_timeout(None, deadline))
+            self.in_flight += 1
+            return _clock()
+
+    def release(self, started, success=None):
+        """
+        Free slot taken by acquire and adapt the limit
+
+        :param started: start marker returned by acquire
+        :param success: True if the host answered normally, False if it
+            signalled overload and None if the result says nothing about
+            the host's load
+        """
+        now = _clock()
+        with self._condition:
+            saturated = self.in_flight >= int(self.limit)
+            self.in_flight -= 1
+            if success:
+                self._sample(now - started)
+                if saturated and not self._latency_rising():
+                    self.limit = min(self.max_limit,
+                                     self.limit + self.increase / self.limit)
+            elif success is False and (self._decreased_at is None or
+                                       started >= self._decreased_at):
+                self.limit = max(self.min_limit, self.limit * self.backoff)
+                self._decreased_at = now
+                log.info("Outcome service overloaded, concurrency limit %d",
+                         int(self.limit))
+            self._condition.notify_all()
+
+    def _sample(self, latency):
+        """
+        Add latency sample, called with the lock held
+        """
+        if self.latency is None:
+            self.latency = self.min_latency = latency
+            return
+        self.latency += self.smoothing * (latency - self.latency)
+        # Let the baseline follow lasting latency changes slowly
+        self.min_latency = min(
+            latency,
+            self.min_latency + self.smoothing / 10 * (latency -
+                                                      self.min_latency))
+
+    def _latency_rising(self):
+        """
+        Smoothed latency exceeds tolerance, called with the lock held
+        """
+        return (self.min_latency is not None and
+                self.latency > self.min_latency * self.latency_tolerance)
+
+    def stats(self):
+        """
+        Current limit and observed latency
+
+        :return: dict with ``limit``, ``in_flight``, ``latency`` and
+            ``min_latency`` in seconds
+        """
+        with self._condition:
+            return {'limit': int(self.limit), 'in_flight': self.in_flight,
+                    'latency': self.latency,
+                    'min_latency': self.min_latency}
+
+
+class ConcurrencyLimiterRegistry(HostRegistry):
+    """
+    Adaptive concurrency limiters of all outcome service hosts, created
+    on first use with the registry settings.
+    """
+    factory = ConcurrencyLimiter
+
+    def stats(self):
+        """
+        Limit and latency of every known host
+
+        :return: dict mapping host to :py:meth:`ConcurrencyLimiter.stats`
+        """
+        return dict((host, limiter.stats())
+                    for host, limiter in self._snapshot())
+
+
+# Concurrency limiters used by outcome requests of this process, once
+# enabled with CONCURRENCY_LIMITERS.configure()
+CONCURRENCY_LIMITERS = ConcurrencyLimiterRegistry(enabled=False)
+
+
+class TokenBucket(object):
+    """
+    Token bucket limiting the rate of outcome requests to ``rate`` per
+    second with bursts of up to ``burst`` requests.  Requests without
+    a token wait for one instead of failing, in order of arrival.
+    """
+
+    def __init__(self, rate, burst=None):
+        """
+        :param rate: tokens added per second
+        :param burst: most tokens kept, ``rate`` rounded up by default
+        """
+        self.rate = float(rate)
+        self.burst = burst if burst is not None else max(1, math.ceil(rate))
+        self._tokens = float(self.burst)
+        self._updated = _clock()
+        self._lock = threading.Lock()
+
+    def acquire(self, deadline=None):
+        """
+        Take a token, waiting until one is available
+
+        :param deadline: absolute time.time() by which the token is needed
+        :return: seconds waited
+        :exception: LTIPostMessageException if no token is available
+            before deadline
+        """
+        with self._lock:
+            now = _clock()
+            self._tokens = min(self.burst, self._tokens +
+                               (now - self._updated) * self.rate)
+            self._updated = now
+            wait = max(0.0, (1 - self._tokens) / self.rate)
+            if deadline is not None and time.time() + wait > deadline:
+                raise LTIPostMessageException(
+                    "Outcome request deadline exceeded")
+            # Tokens go negative to reserve them for waiting requests
+            self._tokens -= 1
+        if wait:
+            time.sleep(wait)
+        return wait
+
+
+class TokenBucketRegistry(object):
+    """
+    Token buckets of consumers with a ``rate`` (and optionally ``burst``)
+    in their configuration.
+    """
+
+    def __init__(self):
+        self._buckets = {}
+        self._lock = threading.Lock()
+
+    def get(self, consumers, lti_key):
+        """
+        Token bucket of consumer
+
+        :param consumers: consumers from config
+        :param lti_key: key to find appropriate consumer
+        :return: :py:class:`TokenBucket` or None if not rate limited
+        """
+        config = (consumers or {}).get(lti_key) or {}
+        rate = config.get('rate')
+        if not rate:
+            return None
+        settings = (rate, config.get('burst'))
+        entry = self._buckets.get(lti_key)
+        if entry is None or entry[0] != settings:
+            with self._lock:
+                entry = self._buckets.get(lti_key)
+                if entry is None or entry[0] != settings:
+                    entry = self._buckets[lti_key] = (
+                        settings, TokenBucket(*settings))
+        return entry[1]
+
+    def clear(self):
+        """
+        Forget all token buckets
+        """
+        with self._lock:
+            self._buckets = {}
+
+
+# Token buckets used by all outcome requests of this process
+RATE_LIMITERS = TokenBucketRegistry()
+
+
+@add_metaclass(abc.ABCMeta)
+class Transport(object):
+    """
+    Interface of HTTP transports sending signed outcome requests.
+
+    Implementations send the request exactly as given, keeping header
+    names as they are, and raise LTITimeoutException when a timeout
+    expires and LTITransportException for other connection errors.
+    Transports that may be used by several threads at once set
+    ``thread_safe``.
+    """
+    thread_safe = False
+
+    @abc.abstractmethod
+    def request(self, url, method, body, headers, connect_timeout=None,
+                read_timeout=None):
+        """
+        Send request
+
+        :param url: request url
+        :param method: HTTP method
+        :param body: encoded request body
+        :param headers: request headers, including Authorization
+        :param connect_timeout: seconds to establish connection or None
+        :param read_timeout: seconds per socket operation or None
+        :return: (response, content), response has HTTP ``status``
+        """
+        # pylint: disable=too-many-arguments
+
+    def warm(self, url, timeout=None):
+        """
+        Open a connection to the host of url to be reused by the next
+        request, if the transport keeps connections
+
+        :param url: outcome service url
+        :param timeout: seconds to establish connection or None
+        """
+        pass
+
+    def close(self):
+        """
+        Close open connections
+        """
+        pass
+
+
+# TLS session resumption needs ssl.SSLSession, available since Python 3.6
+_TLS_SESSIONS = hasattr(ssl, 'SSLSession')  # pylint: disable=invalid-name
+
+
+class _ResumingSSLSocket(ssl.SSLSocket):
+    """
+    SSL socket handing its TLS session to its context when closed
+    """
+
+    def _real_close(self):
+        # pylint: disable=protected-access
+        if (isinstance(self.context, _ResumingSSLContext) and
+                self.server_hostname and self._sslobj is not None):
+            self.context.remember(self.server_hostname, self)
+        super(_ResumingSSLSocket, self)._real_close()
+
+
+class _ResumingSSLContext(ssl.SSLContext):
+    """
+    Client SSL context resuming the last TLS session of every host, so
+    that new connections skip the full handshake and certificate
+    exchange.
+    """
+    sslsocket_class = _ResumingSSLSocket
+
+    def __init__(self, *args, **kwargs):
+        # pylint: disable=unused-argument
+        super(_ResumingSSLContext, self).__init__()
+        self._sessions = {}
+        self._sockets = {}
+        self._session_lock = threading.Lock()
+
+    def wrap_socket(self, sock, *args, **kwargs):
+        # pylint: disable=arguments-differ
+        host = kwargs.get('server_hostname')
+        if (_TLS_SESSIONS and host and not kwargs.get('server_side') and
+                kwargs.get('session') is None):
+            kwargs['session'] = self.session(host)
+        ssl_sock = super(_ResumingSSLContext, self).wrap_socket(
+            sock, *args, **kwargs)
+        if _TLS_SESSIONS and host:
+            with self._session_lock:
+                self._sockets[host] = weakref.ref(ssl_sock)
+        return ssl_sock
+
+    def remember(self, host, ssl_sock):
+        """
+        Keep TLS session of socket for new connections to host
+
+        :param host: server host name
+        :param ssl_sock: connected SSL socket
+        """
+        session = getattr(ssl_sock, 'session', None)
+        if session is not None:
+            with self._session_lock:
+                self._sessions[host] = session
+
+    def session(self, host):
+        """
+        Last TLS session of host, taken from its last socket while open
+
+        :param host: server host name
+        :return: ssl.SSLSession or None
+        """
+        with self._session_lock:
+            ref = self._sockets.get(host)
+        ssl_sock = ref() if ref is not None else None
+        if ssl_sock is not None:
+            self.remember(host, ssl_sock)
+        with self._session_lock:
+            return self._sessions.get(host)
+
+
+class TLSContextCache(object):
+    """
+    SSL contexts of client certificates, created on first use and shared
+    by all outcome connections of the certificate, so the certificate
+    is loaded once and TLS sessions are resumed.
+    """
+
+    def __init__(self, cafile=None):
+        """
+        :param cafile: CA certificates to verify servers with, the
+            httplib2 bundle by default
+        """
+        self.cafile = cafile
+        self._contexts = {}
+        self._lock = threading.Lock()
+
+    def configure(self, cafile=None):
+        """
+        Change CA certificates and forget existing contexts
+
+        :param cafile: CA certificates to verify servers with
+        """
+        with self._lock:
+            self.cafile = cafile
+            self._contexts = {}
+
+    def get(self, cert, key=None):
+        """
+        SSL context presenting client certificate
+
+        :param cert: client certificate file, with key unless ``key``
+        :param key: private key file
+        :return: ssl.SSLContext
+        """
+        context = self._contexts.get((cert, key))
+        if context is None:
+            with self._lock:
+                context = self._contexts.get((cert, key))
+                if context is None:
+                    context = self._contexts[(cert, key)] = (
+                        self._create(cert, key))
+        return context
+
+    def _create(self, cert, key):
+        """
+        New verifying client context, called with the lock held
+        """
+        context = _ResumingSSLContext(
+            getattr(ssl, 'PROTOCOL_TLS_CLIENT', ssl.PROTOCOL_SSLv23))
+        context.verify_mode = ssl.CERT_REQUIRED
+        context.check_hostname = True
+        context.load_verify_locations(self.cafile or httplib2.CA_CERTS)
+        context.load_cert_chain(cert, key)
+        log.debug("Loaded client certificate %s", cert)
+        return context
+
+
+# SSL contexts of client certificates used by all outcome requests
+TLS_CONTEXTS = TLSContextCache()
+
+
+class _LTIHTTPSConnection(httplib2.HTTPSConnectionWithTimeout):
+    """
+    httplib2 HTTPS connection taking the SSL context of its client
+    certificate from TLS_CONTEXTS instead of building one per connection
+    """
+
+    def __init__(self, host, port=None, key_file=None, cert_file=None,
+                 timeout=None, proxy_info=None, ca_certs=None,
+                 disable_ssl_certificate_validation=False, **kwargs):
+        # pylint: disable=too-many-arguments, non-parent-init-called
+        # pylint: disable=super-init-not-called
+        if cert_file is None or disable_ssl_certificate_validation:
+            super(_LTIHTTPSConnection, self).__init__(
+                host, port=port, key_file=key_file, cert_file=cert_file,
+                timeout=timeout, proxy_info=proxy_info, ca_certs=ca_certs,
+                disable_ssl_certificate_validation=(
+                    disable_ssl_certificate_validation), **kwargs)
+            return
+        http_client.HTTPSConnection.__init__(
+            self, host, port=port, timeout=timeout,
+            context=TLS_CONTEXTS.get(cert_file, key_file))
+        self.disable_ssl_certificate_validation = False
+        self.ca_certs = ca_certs or httplib2.CA_CERTS
+        if proxy_info and not isinstance(proxy_info, httplib2.ProxyInfo):
+            proxy_info = proxy_info('https')
+        self.proxy_info = proxy_info
+        self.key_file = key_file
+        self.cert_file = cert_file
+        self.key_password = kwargs.get('key_password')
+
+
+class _LTIHttp(httplib2.Http):
+    """
+    httplib2 client that keeps the Authorization header capitalized, as
+    some LTI consumers only accept the capitalized header, and that
+    applies a separate timeout to established connections.
+    """
+    read_timeout = None
+
+    def _conn_request(self, conn, request_uri, method, body, headers):
+        # pylint: disable=too-many-arguments
+        conn.timeout = self.timeout
+        if conn.sock is None:
+            conn.connect()
+        if conn.sock is not None:
+            conn.sock.settimeout(self.read_timeout)
+        return super(_LTIHttp, self)._conn_request(
+            conn, request_uri, method, body, headers)
+
+    def _normalize_headers(self, headers):
+        """ This function patches Authorization header """
+        ret = super(_LTIHttp, self)._normalize_headers(headers)
+        if 'authorization' in ret:
+            ret['Authorization'] = ret.pop('authorization')
+        return ret
+
+
+class Httplib2Transport(Transport):
+    """
+    Default transport built on httplib2.  Connections are kept open and
+    reused; the transport is not thread safe, use one per thread as
+    :py:class:`TransportPool` does.
+    """
+
+    def __init__(self, cert=None):
+        """
+        :param cert: client certificate file with key, its SSL context is
+            shared through TLS_CONTEXTS
+        """
+        self.http = _LTIHttp()
+        self._connection_type = None
+        if cert:
+            self.http.add_certificate(key=cert, cert=cert, domain='')
+            log.debug("cert %s", cert)
+            if _TLS_SESSIONS:
+                self._connection_type = _LTIHTTPSConnection
+
+    def request(self, url, method, body, headers, connect_timeout=None,
+                read_timeout=None):
+        # pylint: disable=too-many-arguments
+        self.http.timeout = connect_timeout
+        self.http.read_timeout = read_timeout
+        try:
+            connection_type = None
+            if url.startswith('https:'):
+                connection_type = self._connection_type
+            return self.http.request(url, method, body=body,
+                                     headers=headers,
+                                     connection_type=connection_type)
+        except socket.timeout:
+            raise LTITimeoutException("Outcome request timed out")
+        except (socket.error, httplib2.HttpLib2Error) as err:
+            raise LTITransportException(
+                "Outcome request failed: {}".format(err))
+
+    def close(self):
+        for conn in list(self.http.connections.values()):
+            conn.close()
+        self.http.connections.clear()
+
+
+def consumer_timeouts(consumers, lti_key):
+    """
+    Outcome request timeouts configured for consumer.  ``timeout`` sets
+    both timeouts, ``connect_timeout`` and ``read_timeout`` override it.
+
+    :param consumers: consumers from config
+    :param lti_key: key to find appropriate consumer
+    :return: (connect_timeout, read_timeout), None means no timeout
+    """
+    config = (consumers or {}).get(lti_key) or {}
+    timeout = config.get('timeout')
+    return (config.get('connect_timeout', timeout),
+            config.get('read_timeout', timeout))
+
+
+def _remaining_timeout(timeout, deadline):
+    """
+    Timeout shortened so it does not run past deadline
+
+    :param timeout: configured timeout or None
+    :param deadline: absolute time.time() deadline or None
+    :return: timeout in seconds or None
+    :exception: LTIPostMessageException if deadline passed
+    """
+    if deadline is None:
+        return timeout
+    remaining = deadline - time.time()
+    if remaining <= 0:
+        raise LTIPostMessageException("Outcome request deadline exceeded")
+    return remaining if timeout is None else min(timeout, remaining)
+
+
+def create_transport(consumers, lti_key, factory=None):
+    """
+    Create transport for posting to LTI consumer, using the consumer's
+    client certificate if it has one.
+
+    :param consumers: consumers from config
+    :param lti_key: key to find appropriate consumer
+    :param factory: transport class or factory called with ``cert``,
+        :py:class:`Httplib2Transport` by default
+    :return: :py:class:`Transport`
+    :exception: LTIException if consumer is unknown
+    """
+    consumer = (consumers or {}).get(lti_key)
+    if not consumer or not consumer.get('secret'):
+        raise LTIException("Unknown consumer {}".format(lti_key))
+    return (factory or Httplib2Transport)(cert=consumer.get('cert'))
+
+
+class TransportPool(object):
+    """
+    Keeps one transport per consumer key for every thread, so that
+    threads posting to the same consumer reuse their connections.  With
+    ``shared`` a single transport per consumer key serves all threads,
+    which needs a thread safe transport such as
+    :py:class:`pylti.urllib3.Urllib3Transport`.
+    """
+
+    def __init__(self, consumers=None, factory=None, shared=False):
+        """
+        :param consumers: consumers from config
+        :param factory: transport factory, see :py:func:`create_transport`
+        :param shared: share transports between threads
+        :exception: ValueError for shared pools of transports that are
+            not ``thread_safe``
+        """
+        if shared and not getattr(factory or Httplib2Transport,
+                                  'thread_safe', False):
+            raise ValueError("Shared transport pools need a thread safe "
+                             "transport")
+        self.consumers = consumers
+        self.factory = factory
+        self.shared = shared
+        self._local = threading.local()
+        self._shared = {}
+        self._created = []
+        self._lock = threading.Lock()
+
+    def get(self, lti_key, consumers=None):
+        """
+        Transport of the current thread for consumer key
+
+        :param lti_key: key to find appropriate consumer
+        :param consumers: consumers from config, if not given to the pool
+        :return: :py:class:`Transport`
+        """
+        if self.shared:
+            transports = self._shared
+        else:
+            transports = getattr(self._local, 'transports', None)
+            if transports is None:
+                transports = self._local.transports = {}
+        transport = transports.get(lti_key)
+        if transport is None:
+            with self._lock:
+                transport = transports.get(lti_key)
+                if transport is None:
+                    transport = transports[lti_key] = create_transport(
+                        consumers or self.consumers, lti_key, self.factory)
+                    self._created.append(transport)
+        return transport
+
+    def close(self):
+        """
+        Close the connections of every transport of the pool
+        """
+        with self._lock:
+            created, self._created = self._created, []
+        for transport in created:
+            transport.close()
+
+
+class ConnectionWarmer(object):
+    """
+    Opens connections to outcome service hosts in the background when
+    an LTI launch arrives, so that the first grade post of the launch
+    reuses a connection that already went through DNS, TCP and TLS
+    setup.  Hosts are warmed again after ``ttl`` seconds as idle
+    connections are eventually closed by the server.
+    """
+
+    def __init__(self, transport_pool, workers=2, timeout=5, ttl=60):
+        """
+        :param transport_pool: shared :py:class:`TransportPool` used for
+            grade posts
+        :param workers: concurrent warming connections
+        :param timeout: seconds to establish a connection
+        :param ttl: seconds before a host is warmed again
+        """
+        if not transport_pool.shared:
+            raise ValueError("Connection warming needs a shared "
+                             "transport pool")
+        self.transport_pool = transport_pool
+        self.workers = workers
+        self.timeout = timeout
+        self.ttl = ttl
+        self._warmed = {}
+        self._lock = threading.Lock()
+        self._pool = None
+
+    def warm(self, consumers, lti_key, url):
+        """
+        Schedule warming of the consumer's connection to host of url
+
+        :param consumers: consumers from config
+        :param lti_key: key to find appropriate consumer
+        :param url: outcome service url
+        :return: True if warming was scheduled, False if host is warm
+        """
+        key = (lti_key, HostRegistry.host(url))
+        now = _clock()
+        with self._lock:
+            warmed_at = self._warmed.get(key)
+            if warmed_at is not None and now - warmed_at < self.ttl:
+                return False
+            self._warmed[key] = now
+            if self._pool is None:
+                self._pool = ThreadPool(self.workers)
+            pool = self._pool
+        pool.apply_async(self._warm, (consumers, lti_key, url))
+        return True
+
+    def close(self):
+        """
+        Wait for scheduled warming and stop worker threads
+        """
+        with self._lock:
+            pool, self._pool = self._pool, None
+        if pool is not None:
+            pool.close()
+            pool.join()
+
+    def _warm(self, consumers, lti_key, url):
+        """
+        Open connection, failures are only logged
+        """
+        try:
+            self.transport_pool.get(lti_key, consumers).warm(
+                url, self.timeout)
+            log.debug("Warmed connection to %s", url)
+        except Exception:  # pylint: disable=broad-except
+            log.info("Warming connection to %s failed", url, exc_info=True)
+            with self._lock:
+                self._warmed.pop((lti_key, HostRegistry.host(url)), None)
+
+
+class _BudgetedCall(object):
+    """
+    Call run by a worker thread whose result is waited for at most the
+    latency budget
+    """
+
+    def __init__(self, function, callback=None):
+        self.function = function
+        self.callback = callback
+        self._condition = threading.Condition()
+        self._done = False
+        self._pending = False
+        self._result = None
+        self._error = None
+
+    def __call__(self):
+        try:
+            result, error = self.function(), None
+        except Exception as err:  # pylint: disable=broad-except
+            result, error = None, err
+        with self._condition:
+            self._done = True
+            self._result = result
+            self._error = error
+            pending = self._pending
+            self._condition.notify_all()
+        if pending:
+            if error is not None:
+                log.warning("Background grade post failed: %s", error)
+            if self.callback is not None:
+                self.callback(error is None and bool(result))
+
+    def wait(self, budget):
+        """
+        Result of the call if it ends within budget
+
+        :param budget: seconds to wait
+        :return: call result or GRADE_PENDING
+        :exception: exception raised by the call
+        """
+        end = _clock() + budget
+        with self._condition:
+            while not self._done:
+                remaining = end - _clock()
+                if remaining <= 0:
+                    self._pending = True
+                    return GRADE_PENDING
+                self._condition.wait(remaining)
+        if self._error is not None:
+            raise self._error
+        return self._result
+
+
+class BackgroundPoster(object):
+    """
+    Worker threads running grade posts with a latency budget, which
+    finish posts that ran over their budget in the background.  Posts
+    still running when the process exits are waited for.
+    """
+
+    def __init__(self, workers=16):
+        """
+        :param workers: concurrent posts
+        """
+        self.workers = workers
+        self._pool = None
+        self._lock = threading.Lock()
+
+    def run(self, function, budget, callback=None):
+        """
+        Run post, waiting at most budget seconds for its result
+
+        :param function: post returning its result or raising
+        :param budget: seconds to wait for the result
+        :param callback: called with True or False when a post that
+            returned GRADE_PENDING ends
+        :return: result of function or GRADE_PENDING
+        :exception: exception raised by function within budget
+        """
+        call = _BudgetedCall(function, callback)
+        with self._lock:
+            if self._pool is None:
+                self._pool = ThreadPool(self.workers)
+                atexit.register(self.close)
+            self._pool.apply_async(call)
+        return call.wait(budget)
+
+    def close(self):
+        """
+        Wait for running posts and stop worker threads
+        """
+        with self._lock:
+            pool, self._pool = self._pool, None
+        if pool is not None:
+            pool.close()
+            pool.join()
+
+
+# Worker threads of all grade posts with a latency budget
+BACKGROUND_POSTS = BackgroundPoster()
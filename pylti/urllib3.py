@@ -0,0 +1,80 @@
+# -*- coding: utf-8 -*-
+"""
+    PyLTI outcome transport built on urllib3 connection pools
+
+Needs urllib3, installed with ``pip install PyLTI[urllib3]``.
+"""
+from __future__ import absolute_import
+import logging
+
+import urllib3
+from urllib3.exceptions import (
+    HTTPError,
+    NewConnectionError,
+    TimeoutError as Urllib3Timeout,
+)
+
+from .exceptions import LTITimeoutException, LTITransportException
+from .transport import TLS_CONTEXTS, Transport
+
+log = logging.getLogger('pylti.urllib3')  # pylint: disable=invalid-name
+
+
+class Urllib3Transport(Transport):
+    """
+    Outcome transport sending requests through a urllib3 PoolManager.
+    Unlike the default transport it is thread safe, so a single
+    transport can also be shared between threads.  Use it for all
+    requests of a reader with::
+
+        ResultsReader(consumers, transport_factory=Urllib3Transport)
+    """
+    thread_safe = True
+
+    def __init__(self, cert=None, **pool_kwargs):
+        """
+        :param cert: client certificate file with key, its SSL context is
+            shared through :py:data:`pylti.transport.TLS_CONTEXTS`
+        :param pool_kwargs: arguments of urllib3.PoolManager, e.g.
+            ``maxsize`` connections kept per host
+        """
+        if cert:
+            pool_kwargs.setdefault('ssl_context', TLS_CONTEXTS.get(cert))
+            log.debug("cert %s", cert)
+        self.pool = urllib3.PoolManager(**pool_kwargs)
+
+    def request(self, url, method, body, headers, connect_timeout=None,
+                read_timeout=None):
+        # pylint: disable=too-many-arguments
+        try:
+            response = self.pool.urlopen(
+                method, url, body=body, headers=headers, retries=False,
+                redirect=False,
+                timeout=urllib3.Timeout(connect=connect_timeout,
+                                        read=read_timeout))
+        except NewConnectionError as err:
+            raise LTITransportException(
+                "Outcome request failed: {}".format(err))
+        except Urllib3Timeout:
+            raise LTITimeoutException("Outcome request timed out")
+        except HTTPError as err:
+            raise LTITransportException(
+                "Outcome request failed: {}".format(err))
+        return response, response.data
+
+    def warm(self, url, timeout=None):
+        # pylint: disable=protected-access
+        pool = self.pool.connection_from_url(url)
+        conn = pool._get_conn()
+        try:
+            if conn.sock is None:
+                conn.timeout = timeout
+                conn.connect()
+        except Exception:
+            conn.close()
+            raise
+        finally:
+            pool._put_conn(conn)
+
+    def close(self):
+        self.pool.clear()
@@ -0,0 +1,142 @@
+# -*- coding: utf-8 -*-
+"""
+    PyLTI WSGI middleware verifying launches before the application
+"""
+from __future__ import absolute_import
+
+import logging
+from io import BytesIO
+from wsgiref.util import request_uri
+
+from six.moves.urllib.parse import parse_qsl
+
+from .common import (
+    LTIException,
+    LaunchContext,
+    create_oauth_server,
+    verify_request_common,
+)
+
+log = logging.getLogger('pylti.wsgi')  # pylint: disable=invalid-name
+
+# WSGI environ key of the LaunchContext of a verified launch
+LAUNCH_ENVIRON_KEY = 'pylti.launch'
+
+# Launch forms larger than this are rejected without reading them
+MAX_LAUNCH_SIZE = 64 * 1024
+
+
+def _respond(start_response, status, message):
+    """
+    Plain text response
+
+    :return: WSGI response body
+    """
+    body = message.encode('utf-8')
+    start_response(status, [('Content-Type', 'text/plain; charset=utf-8'),
+                            ('Content-Length', str(len(body)))])
+    return [body]
+
+
+class LTIMiddleware(object):
+    """
+    WSGI middleware verifying LTI launch POSTs to ``paths`` before they
+    reach the application.  Invalid launches are answered with 403 by
+    the middleware, or by the ``error`` WSGI application; forms that are
+    not UTF-8 are answered with 400.  Verified launches are passed on
+    with their :py:class:`pylti.common.LaunchContext` under
+    :py:data:`LAUNCH_ENVIRON_KEY` in the environ; the Flask ``lti``
+    wrapper then trusts them without verifying again.
+
+    Usage::
+
+        app.wsgi_app = LTIMiddleware(app.wsgi_app, consumers,
+                                     paths=['/launch'])
+    """
+    # pylint: disable=too-few-public-methods
+
+    def __init__(self, app, consumers, paths=None, error=None,
+                 max_size=MAX_LAUNCH_SIZE, capture_custom=False,
+                 nonce_store=None):
+        """
+        :param app: WSGI application
+        :param consumers: consumers from config
+        :param paths: launch paths, or None for every POST that carries
+            an lti_message_type; forms without a Content-Length, larger
+            than ``max_size`` or not UTF-8 then pass on unverified
+        :param error: WSGI application answering invalid launches, the
+            LTIException is in the environ under ``pylti.error``
+        :param max_size: largest launch form in bytes
+        :param capture_custom: keep custom_* parameters in the context
+        :param nonce_store: store of seen nonces like
+            :py:class:`pylti.session.MemoryNonceStore`, rejecting
+            replayed launches
+        """
+        # pylint: disable=too-many-arguments
+        self.app = app
+        self.consumers = consumers
+        self.paths = frozenset(paths) if paths is not None else None
+        self.error = error
+        self.max_size = max_size
+        self.capture_custom = capture_custom
+        self.nonce_store = nonce_store
+        self._oauth_server = create_oauth_server(consumers)
+
+    def __call__(self, environ, start_response):
+        if environ.get('REQUEST_METHOD') != 'POST' or (
+                self.paths is not None and
+                environ.get('PATH_INFO') not in self.paths):
+            return self.app(environ, start_response)
+        if not environ.get('CONTENT_TYPE', '').startswith(
+                'application/x-www-form-urlencoded'):
+            return self.app(environ, start_response)
+        content_length = environ.get('CONTENT_LENGTH')
+        try:
+            length = int(content_length or 0)
+        except ValueError:
+            length = -1
+        if self.paths is None and not (
+                content_length and 0 <= length <= self.max_size):
+            # Without launch paths, forms of unknown or too large size
+            # are not read and pass on untouched
+            return self.app(environ, start_response)
+        if not 0 <= length <= self.max_size:
+            log.info('Rejected launch of %s bytes', length)
+            return _respond(start_response, '413 Request Entity Too Large',
+                            u'LTI launch too large')
+
+        body = environ['wsgi.input'].read(length) if length else b''
+        # Let the application read the form again
+        environ['wsgi.input'] = BytesIO(body)
+        try:
+            params = dict(parse_qsl(body.decode('utf-8'),
+                                    keep_blank_values=True))
+        except UnicodeDecodeError:
+            if self.paths is None:
+                return self.app(environ, start_response)
+            log.info('Rejected launch that is not UTF-8')
+            return _respond(start_response, '400 Bad Request',
+                            u'LTI launch is not UTF-8')
+        if self.paths is None and 'lti_message_type' not in params:
+            return self.app(environ, start_response)
+
+        headers = dict((name, value) for name, value in environ.items()
+                       if name.startswith('HTTP_'))
+        if 'HTTP_AUTHORIZATION' in environ:
+            headers['Authorization'] = environ['HTTP_AUTHORIZATION']
+        try:
+            verify_request_common(self.consumers, request_uri(environ),
+                                  'POST', headers, params,
+                                  oauth_server=self._oauth_server,
+                                  nonce_store=self.nonce_store)
+        except LTIException as lti_exception:
+            log.debug('launch verification failed')
+            if self.error is None:
+                return _respond(start_response, '403 Forbidden',
+                                u'LTI launch verification failed')
+            environ['pylti.error'] = lti_exception
+            return self.error(environ, start_response)
+
+        environ[LAUNCH_ENVIRON_KEY] = LaunchContext.from_params(
+            params, self.capture_custom)
+        return self.app(environ, start_response)